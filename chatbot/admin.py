@@ -6,7 +6,7 @@ from django.db.models import QuerySet
 from django.http import HttpRequest
 from import_export import resources
 
-from chatbot.models import Chatbot, Question, Realm, Text
+from chatbot.models import Chatbot, IndexJob, IndexShard, Question, Realm, Text
 
 
 # Register your models here.
@@ -73,6 +73,27 @@ class TextAdmin(RestrictedAdminMixin, admin.ModelAdmin):
     user_relation = "realm__users"
 
 
+class IndexShardInline(admin.TabularInline):
+    """Shards of an index job."""
+
+    model = IndexShard
+    extra = 0
+    can_delete = False
+    readonly_fields = ["status", "first_id", "last_id", "text_count", "attempts", "error"]
+
+
+@admin.register(IndexJob)
+class IndexJobAdmin(RestrictedAdminMixin, admin.ModelAdmin):
+    """Admin for the progress of distributed indexing."""
+
+    list_display = ["realm", "status", "distributed", "indexed_count", "text_count", "created_at", "updated_at"]
+    list_filter = ["status", "distributed", "realm"]
+    readonly_fields = ["realm", "status", "distributed", "shard_count", "finished_shards", "text_count",
+                       "indexed_count", "checkpoint_id", "error", "finished_at"]
+    inlines = [IndexShardInline]
+    user_relation = "realm__users"
+
+
 class QuestionResource(resources.ModelResource):
     class Meta:
         model = Question
@@ -1,13 +1,52 @@
 """App configuration."""
 import logging
+import os
 import sys
+import threading
+from typing import Sequence
 
 from django.apps import AppConfig
 from django.conf import settings
+from django.db import DatabaseError
 from pymilvus import MilvusException, connections
 
 logger = logging.getLogger(__name__)
 
+# Programs serving requests, management commands and Celery workers don't warm collections
+SERVER_PROGRAMS = {"gunicorn", "uvicorn", "daphne", "hypercorn"}
+
+
+def should_warm(argv: Sequence[str]) -> bool:
+    """Indicate whether the process serves requests and warming collections is enabled."""
+    if not settings.MILVUS_WARM_COLLECTIONS or not argv:
+        return False
+    program = os.path.basename(argv[0])
+    if program in SERVER_PROGRAMS:
+        return True
+    # The autoreloader of runserver serves from a child process
+    return (program == "manage.py" and argv[1:2] == ["runserver"]
+            and (os.environ.get("RUN_MAIN") == "true" or "--noreload" in argv))
+
+
+def warm_realm_collections() -> None:
+    """Load the Milvus collections of all realms used by a chatbot, and the shared collections."""
+    from chatbot.collections import warm_collections
+    from chatbot.models import Chatbot, Realm
+
+    try:
+        realms = Realm.objects.filter(
+            vector_backend__in=[Realm.Backend.MILVUS, Realm.Backend.MILVUS_SHARED],
+            pk__in=Chatbot.objects.values("realm"),
+        ).only("slug", "collection_suffix", "vector_backend", "embedding_dim")
+        names = list(dict.fromkeys(
+            realm.collection if realm.vector_backend == Realm.Backend.MILVUS else
+            f"{settings.MILVUS_SHARED_COLLECTION}_{realm.embedding_dim}" for realm in realms
+        ))
+    except DatabaseError as e:
+        logger.warning("Couldn't list realms to warm: {}".format(e))
+        return
+    warm_collections(names)
+
 
 class ChatbotConfig(AppConfig):
     """App configuration."""
@@ -16,12 +55,18 @@ class ChatbotConfig(AppConfig):
     name = 'chatbot'
 
     def ready(self) -> None:
-        """Connect to milvus."""
+        """Connect to milvus and load the collections of active realms in the background."""
+        from chatbot import signals  # noqa: F401
+
         if sys.argv[0].endswith('mypy'):
             return
         try:
             connections.connect(host=settings.MILVUS_HOST)
         except MilvusException as e:
             logger.warning("Couldn't connect to Milvus: {}".format(e))
+            return super().ready()
+
+        if should_warm(sys.argv):
+            threading.Thread(target=warm_realm_collections, name="warm-collections", daemon=True).start()
 
         return super().ready()
@@ -0,0 +1,385 @@
+"""Vector backends storing the embeddings of a realm."""
+import json
+import re
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from chatbot import collections
+from chatbot.models import CollectionIndex, Realm
+from chatbot.store import EmbeddingStore
+
+
+class SearchResult(NamedTuple):
+    """Ids and (squared L2) distances of the closest entries, closest first."""
+
+    ids: List[int]
+    distances: List[float]
+
+
+class TextAttributes(NamedTuple):
+    """Scalar fields of a text that backends with filters store next to its embedding."""
+
+    internal: bool = False
+    url: str = ""
+    page: int = 0
+
+
+class SearchFilter(NamedTuple):
+    """Restricts a search to texts whose scalar fields match."""
+
+    exclude_urls: Tuple[str, ...] = ()
+    internal: Optional[bool] = None
+
+    def __bool__(self) -> bool:
+        """Indicate whether the filter excludes anything."""
+        return bool(self.exclude_urls) or self.internal is not None
+
+    def expression(self) -> str:
+        """Return the filter as a boolean expression of Milvus."""
+        parts = []
+        if self.internal is not None:
+            parts.append(f"internal == {str(self.internal).lower()}")
+        if self.exclude_urls:
+            parts.append(f"url not in {json.dumps(list(self.exclude_urls))}")
+        return " and ".join(parts)
+
+    def matches(self, attributes: Any) -> bool:
+        """Indicate whether a text, or anything with its attributes, passes the filter."""
+        if self.internal is not None and attributes.internal != self.internal:
+            return False
+        return attributes.url not in self.exclude_urls
+
+
+class VectorBackend(ABC):
+    """Interface every vector backend implements, entries are addressed by the collection name.
+
+    Backends that support filters store the attributes of texts and apply a filter during
+    the search, the others ignore both.
+    """
+
+    supports_filters = False
+
+    @abstractmethod
+    def exists(self, name: str) -> bool:
+        """Indicate whether the collection exists."""
+
+    @abstractmethod
+    def create(self, name: str, dim: int) -> None:
+        """Create an empty collection for embeddings of the given dimension."""
+
+    @abstractmethod
+    def insert(self, name: str, ids: Sequence[int], embeddings: Sequence[np.ndarray],
+               attributes: Optional[Sequence[TextAttributes]] = None) -> None:
+        """Insert the embeddings with their text ids."""
+
+    @abstractmethod
+    def delete(self, name: str, ids: Sequence[int]) -> None:
+        """Remove the entries with the given text ids."""
+
+    def upsert(self, name: str, ids: Sequence[int], embeddings: Sequence[np.ndarray],
+               attributes: Optional[Sequence[TextAttributes]] = None) -> None:
+        """Insert the embeddings, replacing entries with the same text ids, so it can safely be repeated."""
+        self.delete(name, ids)
+        self.insert(name, ids, embeddings, attributes)
+
+    @abstractmethod
+    def existing_ids(self, name: str, ids: Sequence[int]) -> Set[int]:
+        """Return which of the text ids have an entry in the collection."""
+
+    @abstractmethod
+    def search(
+        self, name: str, embedding: np.ndarray, n: int = 5, where: Optional[SearchFilter] = None
+    ) -> SearchResult:
+        """Search the n entries closest to the embedding."""
+
+    @abstractmethod
+    def build_index(self, name: str, force: bool = False) -> None:
+        """Prepare the collection for searching after inserts, with force from scratch."""
+
+    @abstractmethod
+    def drop(self, name: str) -> None:
+        """Drop the collection and all its entries."""
+
+    @abstractmethod
+    def count(self, name: str) -> int:
+        """Return the number of entries in the collection."""
+
+
+class MilvusBackend(VectorBackend):
+    """Backend storing the embeddings in a Milvus collection with an HNSW index."""
+
+    def exists(self, name: str) -> bool:
+        """Indicate whether the collection exists."""
+        return collections.collection_exists(name)
+
+    def create(self, name: str, dim: int) -> None:
+        """Create an empty collection for embeddings of the given dimension."""
+        collections.create_collection(name, dim)
+
+    def insert(self, name: str, ids: Sequence[int], embeddings: Sequence[np.ndarray],
+               attributes: Optional[Sequence[TextAttributes]] = None) -> None:
+        """Insert the embeddings with their text ids."""
+        collections.insert_embeddings_into(list(ids), list(embeddings), name)
+
+    def delete(self, name: str, ids: Sequence[int]) -> None:
+        """Remove the entries with the given text ids."""
+        collections.delete_embeddings_from(list(ids), name)
+
+    def existing_ids(self, name: str, ids: Sequence[int]) -> Set[int]:
+        """Return which of the text ids have an entry in the collection."""
+        return set(collections.query_ids(list(ids), name))
+
+    def search(
+        self, name: str, embedding: np.ndarray, n: int = 5, where: Optional[SearchFilter] = None
+    ) -> SearchResult:
+        """Search the n entries closest to the embedding."""
+        hits = collections.search_in_collection(embedding, name, n=n)
+        return SearchResult(list(hits.ids), list(hits.distances))
+
+    def build_index(self, name: str, force: bool = False) -> None:
+        """Index new entries, rebuilding the HNSW index only when needed.
+
+        The index is rebuilt from scratch when forced, when it is missing or has other
+        parameters, or when the collection grew by MILVUS_REBUILD_GROWTH since the last
+        rebuild. Otherwise the inserts are flushed and Milvus indexes the new segments
+        in the background, so the collection stays loaded and searches are served
+        throughout. A fragmented collection is compacted, which is online as well.
+        """
+        entities = collections.count_entries(name, flush=True)
+        last = CollectionIndex.objects.filter(name=name).first()
+        grown = last is not None and entities > last.entities * (1 + settings.MILVUS_REBUILD_GROWTH)
+
+        if force or grown or not settings.MILVUS_INCREMENTAL_INDEX or not collections.has_current_index(name):
+            collections.build_index(name)
+            CollectionIndex.objects.update_or_create(name=name, defaults={"entities": entities})
+            return
+
+        if last is None:
+            CollectionIndex.objects.create(name=name, entities=entities)
+        if collections.fragmentation(name) > settings.MILVUS_COMPACT_FRAGMENTATION:
+            collections.compact(name)
+
+    def drop(self, name: str) -> None:
+        """Drop the collection and all its entries."""
+        collections.drop_collection(name)
+        CollectionIndex.objects.filter(name=name).delete()
+
+    def count(self, name: str) -> int:
+        """Return the number of entries in the collection."""
+        return collections.count_entries(name, flush=True)
+
+
+class LocalBackend(VectorBackend):
+    """Backend doing an exact brute-force search with NumPy in the web process.
+
+    Every collection is an append-only :class:`~chatbot.store.EmbeddingStore` below
+    ``settings.LOCAL_VECTOR_ROOT``, which all workers map from the same files.
+    """
+
+    def __init__(self) -> None:
+        """Create a backend without any opened stores."""
+        self._lock = threading.Lock()
+        self._stores: Dict[str, EmbeddingStore] = {}
+
+    def _path(self, name: str) -> Path:
+        return Path(settings.LOCAL_VECTOR_ROOT) / name
+
+    def _store(self, name: str) -> EmbeddingStore:
+        path = self._path(name)
+        with self._lock:
+            store = self._stores.get(str(path))
+            if store is None:
+                store = self._stores[str(path)] = EmbeddingStore(path)
+        if not store.exists():
+            raise ValueError(f"Collection with name {name} does not exist!")
+        return store
+
+    def exists(self, name: str) -> bool:
+        """Indicate whether the collection exists."""
+        return EmbeddingStore(self._path(name)).exists()
+
+    def create(self, name: str, dim: int) -> None:
+        """Create an empty collection for embeddings of the given dimension."""
+        EmbeddingStore.create(self._path(name), dim, settings.LOCAL_VECTOR_DTYPE)
+
+    def insert(self, name: str, ids: Sequence[int], embeddings: Sequence[np.ndarray],
+               attributes: Optional[Sequence[TextAttributes]] = None) -> None:
+        """Append the embeddings with their text ids, replacing older entries of the same ids."""
+        self._store(name).append(ids, embeddings)
+
+    def delete(self, name: str, ids: Sequence[int]) -> None:
+        """Remove the entries with the given text ids."""
+        self._store(name).delete(ids)
+
+    def upsert(self, name: str, ids: Sequence[int], embeddings: Sequence[np.ndarray],
+               attributes: Optional[Sequence[TextAttributes]] = None) -> None:
+        """Insert the embeddings, appending already replaces entries with the same ids."""
+        self.insert(name, ids, embeddings)
+
+    def existing_ids(self, name: str, ids: Sequence[int]) -> Set[int]:
+        """Return which of the text ids have an entry in the collection."""
+        live = self._store(name).live_ids()
+        wanted = np.asarray(ids, dtype=np.int64)
+        return set(wanted[np.isin(wanted, live)].tolist())
+
+    def search(
+        self, name: str, embedding: np.ndarray, n: int = 5, where: Optional[SearchFilter] = None
+    ) -> SearchResult:
+        """Search the n entries closest to the embedding."""
+        ids, distances = self._store(name).search(embedding, n)
+        return SearchResult(ids.tolist(), distances.tolist())
+
+    def build_index(self, name: str, force: bool = False) -> None:
+        """Compact the store once enough entries were deleted, the search itself is exact."""
+        store = self._store(name)
+        if store.deleted_ratio() > (0 if force else settings.LOCAL_VECTOR_COMPACT_RATIO):
+            store.compact()
+
+    def drop(self, name: str) -> None:
+        """Drop the collection and all its entries."""
+        with self._lock:
+            self._stores.pop(str(self._path(name)), None)
+        shutil.rmtree(self._path(name), ignore_errors=True)
+
+    def count(self, name: str) -> int:
+        """Return the number of entries in the collection."""
+        if not self.exists(name):
+            return 0
+        return len(self._store(name))
+
+
+class SharedMilvusBackend(MilvusBackend):
+    """Backend storing the embeddings of many realms in one Milvus collection, a partition each.
+
+    There is a shared collection per dimension, named by MILVUS_SHARED_COLLECTION and the
+    dimension, so all realms are loaded and indexed together instead of one small collection
+    each. The scalar fields of the texts are stored next to their embeddings, so searches
+    are filtered by Milvus.
+
+    Ids are only unique within a partition, e.g. the question collections of chatbots are
+    partitions holding question ids next to the text ids of realms. Every insert, delete,
+    query and search is therefore restricted to the partition of the name.
+    """
+
+    supports_filters = True
+
+    def __init__(self) -> None:
+        """Create a backend that doesn't know the partitions yet."""
+        self._lock = threading.Lock()
+        self._partitions: Dict[str, str] = {}
+
+    @staticmethod
+    def _partition(name: str) -> str:
+        return re.sub(r"[^0-9a-zA-Z_]", "_", name)
+
+    @staticmethod
+    def _collection_name(dim: int) -> str:
+        return f"{settings.MILVUS_SHARED_COLLECTION}_{dim}"
+
+    def _locate(self, name: str) -> Optional[str]:
+        """Return the name of the shared collection holding the partition, None if there is none."""
+        with self._lock:
+            collection_name = self._partitions.get(name)
+        if collection_name is not None:
+            return collection_name
+
+        prefix = f"{settings.MILVUS_SHARED_COLLECTION}_"
+        for candidate in collections.list_collections():
+            if candidate.startswith(prefix) and collections.has_partition(candidate, self._partition(name)):
+                with self._lock:
+                    self._partitions[name] = candidate
+                return candidate
+        return None
+
+    def _require(self, name: str) -> str:
+        collection_name = self._locate(name)
+        if collection_name is None:
+            raise ValueError(f"Partition with name {name} does not exist!")
+        return collection_name
+
+    def exists(self, name: str) -> bool:
+        """Indicate whether the partition exists."""
+        return self._locate(name) is not None
+
+    def create(self, name: str, dim: int) -> None:
+        """Create the partition, and the shared collection of the dimension if needed."""
+        collection_name = self._collection_name(dim)
+        if not collections.collection_exists(collection_name):
+            collections.create_shared_collection(collection_name, dim)
+        collections.create_partition(collection_name, self._partition(name))
+        with self._lock:
+            self._partitions[name] = collection_name
+
+    def insert(self, name: str, ids: Sequence[int], embeddings: Sequence[np.ndarray],
+               attributes: Optional[Sequence[TextAttributes]] = None) -> None:
+        """Insert the embeddings with their text ids and attributes, entries without attributes get defaults."""
+        rows = list(attributes) if attributes is not None else [TextAttributes()] * len(ids)
+        fields: List[List[Any]] = [
+            [row.internal for row in rows],
+            [row.url for row in rows],
+            [row.page for row in rows],
+        ]
+        collections.insert_embeddings_into(
+            list(ids), list(embeddings), self._require(name), self._partition(name), fields
+        )
+
+    def delete(self, name: str, ids: Sequence[int]) -> None:
+        """Remove the entries with the given text ids from the partition."""
+        collections.delete_embeddings_from(list(ids), self._require(name), self._partition(name))
+
+    def existing_ids(self, name: str, ids: Sequence[int]) -> Set[int]:
+        """Return which of the text ids have an entry in the partition."""
+        return set(collections.query_ids(list(ids), self._require(name), self._partition(name)))
+
+    def search(
+        self, name: str, embedding: np.ndarray, n: int = 5, where: Optional[SearchFilter] = None
+    ) -> SearchResult:
+        """Search the n entries of the partition closest to the embedding that pass the filter."""
+        hits = collections.search_in_collection(
+            embedding, self._require(name), n=n, partition_name=self._partition(name),
+            expr=where.expression() if where else None,
+        )
+        return SearchResult(list(hits.ids), list(hits.distances))
+
+    def build_index(self, name: str, force: bool = False) -> None:
+        """Flush the inserts and make sure the shared collection has an index.
+
+        Milvus indexes the new segments in the background. The index is shared with the other
+        realms, so it isn't rebuilt for one of them, also not with force.
+        """
+        collection_name = self._require(name)
+        collections.count_entries(collection_name, flush=True)
+        collections.ensure_index(collection_name)
+
+    def drop(self, name: str) -> None:
+        """Drop the partition, the other realms in the shared collection keep being searched."""
+        collection_name = self._locate(name)
+        if collection_name is not None:
+            collections.drop_partition(collection_name, self._partition(name))
+        with self._lock:
+            self._partitions.pop(name, None)
+
+    def count(self, name: str) -> int:
+        """Return the number of entries in the partition."""
+        collection_name = self._locate(name)
+        if collection_name is None:
+            return 0
+        return collections.count_entries(collection_name, flush=True, partition_name=self._partition(name))
+
+
+BACKENDS: Dict[str, VectorBackend] = {
+    Realm.Backend.MILVUS: MilvusBackend(),
+    Realm.Backend.MILVUS_SHARED: SharedMilvusBackend(),
+    Realm.Backend.LOCAL: LocalBackend(),
+}
+
+
+def get_backend(realm: Realm) -> VectorBackend:
+    """Return the vector backend configured for the realm."""
+    return BACKENDS[realm.vector_backend]
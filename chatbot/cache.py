@@ -0,0 +1,111 @@
+"""Two-tier cache with an in-process LRU in front of Redis."""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from chatbot import metrics
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds to skip Redis after it failed, so an outage doesn't add a timeout to every request
+REDIS_BACKOFF = 30
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text for cache keys, ignoring case, punctuation and whitespace."""
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+
+class TwoTierCache:
+    """Cache bytes in an LRU of this process and in Redis shared by all workers.
+
+    Values found in Redis are copied into the LRU. Counters named ``<namespace>.hit``,
+    ``<namespace>.local_hit``, ``<namespace>.redis_hit`` and ``<namespace>.miss``
+    are kept in :mod:`chatbot.metrics`.
+    """
+
+    def __init__(self, namespace: str, maxsize: int, timeout: int) -> None:
+        """Create a cache whose entries expire after timeout seconds."""
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Tuple[float, bytes]] = OrderedDict()
+        self._redis_down_until = 0.0
+
+    def _redis_key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def _redis_available(self) -> bool:
+        return bool(settings.REDIS_URL) and time.monotonic() >= self._redis_down_until
+
+    def _redis_failed(self, error: Exception) -> None:
+        logger.warning("Redis unavailable for cache %s: %s", self.namespace, error)
+        self._redis_down_until = time.monotonic() + REDIS_BACKOFF
+
+    def get_local(self, key: str) -> Optional[bytes]:
+        """Return the value from the LRU of this process."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set_local(self, key: str, value: bytes) -> None:
+        """Store the value in the LRU of this process."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Return the cached value or None."""
+        value = self.get_local(key)
+        if value is not None:
+            metrics.incr(f"{self.namespace}.hit")
+            metrics.incr(f"{self.namespace}.local_hit")
+            return value
+
+        if self._redis_available():
+            try:
+                value = await get_redis().get(self._redis_key(key))
+            except (RedisError, OSError) as e:
+                self._redis_failed(e)
+            if value is not None:
+                self.set_local(key, value)
+                metrics.incr(f"{self.namespace}.hit")
+                metrics.incr(f"{self.namespace}.redis_hit")
+                return value
+
+        metrics.incr(f"{self.namespace}.miss")
+        return None
+
+    async def set(self, key: str, value: bytes) -> None:
+        """Store the value in both tiers."""
+        self.set_local(key, value)
+        if self._redis_available():
+            try:
+                await get_redis().set(self._redis_key(key), value, ex=self.timeout)
+            except (RedisError, OSError) as e:
+                self._redis_failed(e)
+
+    def clear_local(self) -> None:
+        """Empty the LRU of this process."""
+        with self._lock:
+            self._entries.clear()
+
+    def hit_rate(self) -> float:
+        """Return the share of lookups answered by either tier."""
+        return metrics.hit_rate(self.namespace)
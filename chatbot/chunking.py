@@ -0,0 +1,150 @@
+"""Split documents into snippets of a target number of tokens on import.
+
+Documents are cut after sentences, preferably at the end of a paragraph, and the end of a
+snippet is repeated at the start of the next one. Sentences longer than the target are cut
+between words. Large inputs are split in a pool of processes.
+"""
+import functools
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, NamedTuple, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+from chatbot.tokenizer import count_tokens_batch, get_encoding
+
+# Whitespace after the end of a sentence or between paragraphs
+BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+
+WORD = re.compile(r'\S+\s*')
+
+
+class Chunk(NamedTuple):
+    """Snippet of a document and its token count."""
+
+    text: str
+    tokens: int
+
+
+# Piece of a document, its tokens and whether it ends a paragraph
+Unit = Tuple[str, int, bool]
+
+
+def _sentences(text: str) -> List[Tuple[str, bool]]:
+    """Split the text after sentences and paragraphs, keeping the whitespace."""
+    pieces = []
+    start = 0
+    for match in BOUNDARY.finditer(text):
+        pieces.append((text[start:match.end()], match.group().count('\n') >= 2))
+        start = match.end()
+    if start < len(text):
+        pieces.append((text[start:], True))
+    return pieces
+
+
+def _pack(units: List[Unit], target_tokens: int, overlap_tokens: int) -> List[List[Unit]]:
+    """Group the units into chunks of up to target_tokens, closing early before a paragraph that doesn't fit."""
+    # Tokens from each unit to the end of its paragraph
+    rest = [0] * len(units)
+    remaining = 0
+    for i in range(len(units) - 1, -1, -1):
+        if units[i][2]:
+            remaining = 0
+        remaining += units[i][1]
+        rest[i] = remaining
+
+    chunks: List[List[Unit]] = []
+    current: List[Unit] = []
+    size = 0
+    for i, unit in enumerate(units):
+        starts_paragraph = i == 0 or units[i - 1][2]
+        full = size + unit[1] > target_tokens
+        paragraph_break = starts_paragraph and size >= target_tokens // 2 and size + rest[i] > target_tokens
+        if current and (full or paragraph_break):
+            chunks.append(current)
+            overlap: List[Unit] = []
+            for previous in reversed(current):
+                if sum(u[1] for u in overlap) + previous[1] > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+            current = overlap
+            size = sum(u[1] for u in current)
+            while current and size + unit[1] > target_tokens:
+                size -= current.pop(0)[1]
+        current.append(unit)
+        size += unit[1]
+    chunks.append(current)
+    return chunks
+
+
+def _split(text: str, target_tokens: int, overlap_tokens: int, model: Optional[str]) -> List[Chunk]:
+    """Split a document longer than target_tokens."""
+    sentences = _sentences(text)
+    counts = count_tokens_batch([sentence for sentence, _ in sentences], model, memoize=False)
+
+    units: List[Unit] = []
+    for (sentence, ends_paragraph), count in zip(sentences, counts):
+        if count <= target_tokens:
+            units.append((sentence, count, ends_paragraph))
+            continue
+        words = WORD.findall(sentence)
+        word_units = [(word, tokens, False) for word, tokens in zip(words, count_tokens_batch(words, model, False))]
+        parts = [''.join(word for word, _, _ in part) for part in _pack(word_units, target_tokens, 0)]
+        units += [(part, count, False) for part, count in zip(parts, count_tokens_batch(parts, model, False))]
+        units[-1] = units[-1][:2] + (ends_paragraph, )
+
+    texts = [''.join(piece for piece, _, _ in chunk).strip() for chunk in _pack(units, target_tokens, overlap_tokens)]
+    texts = [text for text in texts if text]
+    return [Chunk(text, count) for text, count in zip(texts, count_tokens_batch(texts, model, memoize=False))]
+
+
+def chunk_texts(texts: Sequence[str], target_tokens: int, overlap_tokens: int = 0,
+                model: Optional[str] = None) -> List[List[Chunk]]:
+    """Split every text into chunks of about target_tokens, texts that fit stay unchanged (0 = don't split)."""
+    counts = count_tokens_batch(texts, model, memoize=False)
+    return [[Chunk(text, count)] if target_tokens <= 0 or count <= target_tokens else _split(
+        text, target_tokens, overlap_tokens, model) for text, count in zip(texts, counts)]
+
+
+class Chunker:
+    """Split batches of documents, in a pool of processes if more than one is used."""
+
+    def __init__(self,
+                 target_tokens: Optional[int] = None,
+                 overlap_tokens: Optional[int] = None,
+                 processes: Optional[int] = None,
+                 model: Optional[str] = None) -> None:
+        """Configure the chunker, with the IMPORT_* settings as defaults."""
+        self.target_tokens = settings.IMPORT_CHUNK_TOKENS if target_tokens is None else target_tokens
+        self.overlap_tokens = settings.IMPORT_CHUNK_OVERLAP if overlap_tokens is None else overlap_tokens
+        self.processes = processes or settings.IMPORT_PROCESSES or os.cpu_count() or 1
+        self.model = model or settings.TOKENIZER_DEFAULT_MODEL
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> 'Chunker':
+        """Start the pool."""
+        # Load the encoding before forking, so the workers don't load it again
+        get_encoding(self.model)
+        if self.processes > 1:
+            self._pool = ProcessPoolExecutor(self.processes)
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Stop the pool."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def chunk(self, documents: Sequence[str]) -> List[List[Chunk]]:
+        """Return the chunks of each document."""
+        split = functools.partial(chunk_texts,
+                                  target_tokens=self.target_tokens,
+                                  overlap_tokens=self.overlap_tokens,
+                                  model=self.model)
+        if self._pool is None:
+            return split(documents)
+
+        size = max(1, -(-len(documents) // (self.processes * 4)))
+        slices = [documents[i:i + size] for i in range(0, len(documents), size)]
+        return [chunks for result in self._pool.map(split, slices) for chunks in result]
@@ -1,19 +1,288 @@
-"""Methods for working with milvius database."""
-from typing import List, cast
+"""Methods for working with milvius database.
+
+Collection handles are kept in a process-wide registry, so a question only costs the
+search RPC: the schema is described once per process and a collection is loaded once,
+until it is dropped, its index is rebuilt or it is released to stay within the budget
+of loaded collections shared by all processes.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, cast
 
 import numpy as np
+from django.conf import settings
 from pymilvus import (
     Collection,
     CollectionSchema,
     DataType,
     FieldSchema,
     Hits,
+    MilvusException,
     utility,
 )
+from pymilvus.client.types import LoadState
+from redis.exceptions import RedisError
+
+from chatbot import metrics
+from core.redis import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_collections: Dict[str, Collection] = {}
+
+HNSW_PARAMS = {
+    'M': 64,
+    'efConstruction': 128,
+}
+
+INDEX_PARAMS = {
+    'metric_type': 'L2',
+    'index_type': 'HNSW',
+    'params': HNSW_PARAMS,
+}
+
+
+def get_collection(collection_name: str) -> Collection:
+    """Return the cached handle of an existing collection."""
+    with _lock:
+        collection = _collections.get(collection_name)
+    if collection is None:
+        collection = Collection(name=collection_name)
+        with _lock:
+            collection = _collections.setdefault(collection_name, collection)
+    return collection
+
+
+def _dim(collection: Collection) -> int:
+    return cast(int, next(field.params['dim'] for field in collection.schema.fields
+                          if field.dtype == DataType.FLOAT_VECTOR))
+
+
+def estimate_memory(collection: Collection) -> int:
+    """Estimate the bytes a loaded collection takes up in Milvus, vectors plus HNSW graph."""
+    return cast(int, collection.num_entities) * (_dim(collection) * 4 + HNSW_PARAMS['M'] * 2 * 8)
+
+
+# KEYS: last search per collection, estimated bytes per collection
+# ARGV: collection, time, its bytes, max count, max bytes, pinned collections...
+# Records the search and removes and returns the least recently searched collections over the budget.
+ACQUIRE_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+local max_count = tonumber(ARGV[4])
+local max_bytes = tonumber(ARGV[5])
+local pinned = {}
+for i = 6, #ARGV do
+    pinned[ARGV[i]] = true
+end
+local count = redis.call('ZCARD', KEYS[1])
+local total = 0
+for _, size in ipairs(redis.call('HVALS', KEYS[2])) do
+    total = total + tonumber(size)
+end
+local victims = {}
+for _, name in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    if not ((max_count > 0 and count > max_count) or (max_bytes > 0 and total > max_bytes)) then
+        break
+    end
+    if name ~= ARGV[1] and not pinned[name] then
+        total = total - tonumber(redis.call('HGET', KEYS[2], name) or '0')
+        count = count - 1
+        redis.call('ZREM', KEYS[1], name)
+        redis.call('HDEL', KEYS[2], name)
+        table.insert(victims, name)
+    end
+end
+return victims
+"""
+
+SEARCHED_KEY = 'milvus:loaded:searched'
+BYTES_KEY = 'milvus:loaded:bytes'
+
+# Seconds between updates of the last search of a collection in Redis
+TOUCH_INTERVAL = 5
+
+
+class LoadedCollections:
+    """Collections loaded for searching, released least recently searched first.
+
+    Milvus loads and releases a collection for the whole server, so with Redis the
+    budget and the last search of every collection are shared by all processes and
+    evictions are decided atomically in Redis. Without Redis, a process only releases
+    collections that it loaded itself. Pinned collections are never released. The
+    budget is a maximum number of loaded collections and a maximum of their estimated
+    memory, 0 disables either limit.
+    """
+
+    def __init__(self, max_count: int = 0, max_bytes: int = 0, pinned: Iterable[str] = ()) -> None:
+        """Create an empty manager with the given budget."""
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self._lock = threading.Lock()
+        # Collections known to be loaded, with their size and last update in Redis
+        self._loaded: OrderedDict[str, int] = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self._owned: Set[str] = set()
+
+    def __contains__(self, collection_name: str) -> bool:
+        """Indicate whether the collection is loaded."""
+        return collection_name in self._loaded
+
+    def acquire(self, collection_name: str) -> Collection:
+        """Return the collection loaded for searching and mark it as most recently used."""
+        with self._lock:
+            if collection_name in self._loaded:
+                self._loaded.move_to_end(collection_name)
+                metrics.incr('milvus.load.hit')
+                touch = time.monotonic() - self._touched.get(collection_name, 0) > TOUCH_INTERVAL
+            else:
+                touch = None
+        if touch is not None:
+            if touch:
+                self._touch(collection_name)
+            return get_collection(collection_name)
+
+        metrics.incr('milvus.load.miss')
+        collection = get_collection(collection_name)
+        owned = self._is_released(collection_name)
+        collection.load()
+        size = estimate_memory(collection)
+
+        with self._lock:
+            self._loaded[collection_name] = size
+            self._loaded.move_to_end(collection_name)
+            self._touched[collection_name] = time.monotonic()
+            if owned:
+                self._owned.add(collection_name)
+
+        victims = self._shared_victims(collection_name, size)
+        if victims is None:
+            with self._lock:
+                victims = self._over_budget(collection_name)
+        for victim in victims:
+            self.discard(victim, shared=False)
+            self._release(victim)
+        return collection
+
+    @staticmethod
+    def _is_released(collection_name: str) -> bool:
+        try:
+            return bool(utility.load_state(collection_name) != LoadState.Loaded)
+        except MilvusException:
+            return False
+
+    def _touch(self, collection_name: str) -> None:
+        with self._lock:
+            self._touched[collection_name] = time.monotonic()
+        if not settings.REDIS_URL:
+            return
+        try:
+            get_sync_redis().zadd(SEARCHED_KEY, {collection_name: time.time()}, xx=True)
+        except RedisError as e:
+            logger.warning("Couldn't record search of collection %s: %s", collection_name, e)
+
+    def _shared_victims(self, collection_name: str, size: int) -> Optional[List[str]]:
+        """Record the load in Redis and return the collections to release, None without Redis."""
+        if not settings.REDIS_URL:
+            return None
+        try:
+            victims = get_sync_redis().eval(ACQUIRE_SCRIPT, 2, SEARCHED_KEY, BYTES_KEY, collection_name, time.time(),
+                                            size, self.max_count, self.max_bytes, *sorted(self.pinned))
+        except RedisError as e:
+            logger.warning("Couldn't share the budget of loaded collections: %s", e)
+            return None
+        return [name.decode() if isinstance(name, bytes) else name for name in victims]
+
+    def _over_budget(self, keep: str) -> List[str]:
+        """Return the least recently used collections loaded by this process exceeding the budget."""
+        victims = []
+        candidates = [name for name in self._loaded if name in self._owned and name not in self.pinned and name != keep]
+        count = len(self._loaded)
+        total = sum(self._loaded.values())
+        for name in candidates:
+            too_many = self.max_count and count > self.max_count
+            too_large = self.max_bytes and total > self.max_bytes
+            if not (too_many or too_large):
+                break
+            count -= 1
+            total -= self._loaded[name]
+            victims.append(name)
+        return victims
+
+    def _release(self, collection_name: str) -> None:
+        metrics.incr('milvus.load.evict')
+        try:
+            get_collection(collection_name).release()
+        except MilvusException as e:
+            logger.warning("Couldn't release collection %s: %s", collection_name, e)
+
+    def discard(self, collection_name: str, shared: bool = True) -> None:
+        """Forget that the collection is loaded, without releasing it."""
+        with self._lock:
+            self._loaded.pop(collection_name, None)
+            self._touched.pop(collection_name, None)
+            self._owned.discard(collection_name)
+        if shared and settings.REDIS_URL:
+            try:
+                with get_sync_redis().pipeline() as pipe:
+                    pipe.zrem(SEARCHED_KEY, collection_name)
+                    pipe.hdel(BYTES_KEY, collection_name)
+                    pipe.execute()
+            except RedisError as e:
+                logger.warning("Couldn't forget collection %s: %s", collection_name, e)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters and the collections this process knows to be loaded."""
+        with self._lock:
+            loaded = dict(self._loaded)
+        return {
+            'hits': metrics.get('milvus.load.hit'),
+            'misses': metrics.get('milvus.load.miss'),
+            'evictions': metrics.get('milvus.load.evict'),
+            'loaded': loaded,
+            'loaded_bytes': sum(loaded.values()),
+            'pinned': sorted(self.pinned),
+        }
+
+
+loaded_collections = LoadedCollections(
+    max_count=settings.MILVUS_MAX_LOADED_COLLECTIONS,
+    max_bytes=settings.MILVUS_MAX_LOADED_BYTES,
+    pinned=settings.MILVUS_PINNED_COLLECTIONS,
+)
+
+
+def load_collection(collection_name: str) -> Collection:
+    """Return the handle of the collection after making sure it is loaded for searching."""
+    return loaded_collections.acquire(collection_name)
+
+
+def invalidate_collection(collection_name: str) -> None:
+    """Forget the cached handle and load state of the collection."""
+    with _lock:
+        _collections.pop(collection_name, None)
+    loaded_collections.discard(collection_name)
+
+
+def warm_collections(collection_names: Iterable[str]) -> None:
+    """Load the pinned and the given collections, so the first search doesn't have to wait for it."""
+    for name in [*loaded_collections.pinned, *collection_names]:
+        try:
+            if collection_exists(name):
+                load_collection(name)
+        except MilvusException as e:
+            logger.warning("Couldn't load collection %s: %s", name, e)
 
 
 def collection_exists(collection_name: str) -> bool:
     """Indicate whether the collection exists or not."""
+    if collection_name in _collections:
+        return True
     value = utility.has_collection(collection_name)
     assert isinstance(value, bool)
     return value
@@ -25,13 +294,15 @@ def list_collections() -> List[str]:
     return cast(list[str], value)
 
 
-def count_entries(collection_name: str, flush: bool = False) -> int:
-    """Return number of elements in collection."""
+def count_entries(collection_name: str, flush: bool = False, partition_name: Optional[str] = None) -> int:
+    """Return number of elements in collection, or in one of its partitions."""
     if not collection_exists(collection_name):
         return 0
-    collection = Collection(collection_name)
+    collection = get_collection(collection_name)
     if flush:
         collection.flush()
+    if partition_name is not None:
+        return cast(int, collection.partition(partition_name).num_entities)
     return cast(int, collection.num_entities)
 
 
@@ -48,56 +319,166 @@ def create_collection(collection_name: str, dim: int = 1536) -> Collection:
     schema = CollectionSchema(fields=[text_id, text_embedding])
     collection = Collection(name=collection_name, schema=schema)
 
+    with _lock:
+        _collections[collection_name] = collection
+    return collection
+
+
+def create_shared_collection(collection_name: str, dim: int = 1536) -> Collection:
+    """Create a collection for the texts of many realms, one partition each, with their scalar fields."""
+    fields = [
+        FieldSchema(name="text_id", dtype=DataType.INT64, is_primary=True),
+        FieldSchema(name="internal", dtype=DataType.BOOL),
+        FieldSchema(name="url", dtype=DataType.VARCHAR, max_length=2048),
+        FieldSchema(name="page", dtype=DataType.INT64),
+        FieldSchema(name="text_embedding", dtype=DataType.FLOAT_VECTOR, dim=dim),
+    ]
+    collection = Collection(name=collection_name, schema=CollectionSchema(fields=fields))
+
+    with _lock:
+        _collections[collection_name] = collection
     return collection
 
 
+def has_partition(collection_name: str, partition_name: str) -> bool:
+    """Indicate whether the collection has the partition."""
+    return cast(bool, get_collection(collection_name).has_partition(partition_name))
+
+
+def create_partition(collection_name: str, partition_name: str) -> None:
+    """Create the partition if the collection doesn't have it yet."""
+    collection = get_collection(collection_name)
+    if not collection.has_partition(partition_name):
+        collection.create_partition(partition_name)
+
+
+def drop_partition(collection_name: str, partition_name: str) -> None:
+    """Release and drop the partition, the other partitions of the collection stay loaded."""
+    partition = get_collection(collection_name).partition(partition_name)
+    if partition is None:
+        return
+    partition.release()
+    partition.drop()
+
+
 def insert_embeddings_into(ids: List[int], embeddings: List[np.ndarray],
-                           collection_name: str) -> None:
-    """Insert ids with given embeddings into the collection with name realm."""
-    if not utility.has_collection(collection_name):
+                           collection_name: str, partition_name: Optional[str] = None,
+                           fields: Optional[List[List[Any]]] = None) -> None:
+    """Insert ids with given embeddings and the columns of further fields into the collection with name realm."""
+    if not collection_exists(collection_name):
         raise ValueError(
             f"Collection with name {collection_name} does not exist!")
-    collection = Collection(name=collection_name)
-    collection.insert([ids, embeddings])
+    collection = get_collection(collection_name)
+    collection.insert([ids, *(fields or []), embeddings], partition_name=partition_name)
+
+
+def delete_embeddings_from(ids: List[int], collection_name: str, partition_name: Optional[str] = None) -> None:
+    """Delete the entries with the given ids from the collection."""
+    if not ids:
+        return
+    if partition_name is None and collection_name.startswith(f"{settings.MILVUS_SHARED_COLLECTION}_"):
+        raise ValueError(f"Entries of the shared collection {collection_name} are only deleted by partition.")
+    collection = get_collection(collection_name)
+    collection.delete(f"text_id in {[int(pk) for pk in ids]}", partition_name=partition_name)
+
+
+def query_ids(ids: List[int], collection_name: str, partition_name: Optional[str] = None) -> List[int]:
+    """Return which of the ids have an entry in the collection."""
+    if not ids:
+        return []
+    # Only collections with an index can be loaded for querying
+    ensure_index(collection_name)
+    results = load_collection(collection_name).query(
+        f"text_id in {[int(pk) for pk in ids]}",
+        output_fields=['text_id'],
+        partition_names=[partition_name] if partition_name else None,
+        consistency_level='Strong',
+    )
+    return [row['text_id'] for row in results]
 
 
 def drop_collection(collection_name: str) -> None:
     """Drop collection with the given name."""
+    invalidate_collection(collection_name)
     utility.drop_collection(collection_name)
 
 
-def search_in_collection(embedding, collection_name: str, n: int = 5) -> Hits:
-    """Search n close elements to the embedding in the given collection."""
-    collection = Collection(name=collection_name)
-    collection.load()
-
+def search_in_collection(embedding, collection_name: str, n: int = 5, partition_name: Optional[str] = None,
+                         expr: Optional[str] = None) -> Hits:
+    """Search n close elements to the embedding in the given collection, optionally filtered by an expression."""
     search_params = {'metric_type': 'L2', 'params': {'ef': n * 2}}
 
-    results = collection.search(
-        [embedding],
-        anns_field='text_embedding',
-        param=search_params,
-        limit=n,
-    )
+    def search() -> List[Hits]:
+        return load_collection(collection_name).search(
+            [embedding],
+            anns_field='text_embedding',
+            param=search_params,
+            limit=n,
+            expr=expr,
+            partition_names=[partition_name] if partition_name else None,
+        )
+
+    try:
+        results = search()
+    except MilvusException:
+        # Another process may have released or dropped the collection, start over once
+        invalidate_collection(collection_name)
+        results = search()
 
     return cast(Hits, results[0])
 
 
+def index_params(collection_name: str) -> Optional[Dict[str, Any]]:
+    """Return the parameters of the index of the collection, None if it has none."""
+    collection = get_collection(collection_name)
+    if not collection.has_index():
+        return None
+    params = dict(collection.index().params)
+    if isinstance(params.get('params'), str):
+        params['params'] = json.loads(params['params'])
+    return params
+
+
+def has_current_index(collection_name: str) -> bool:
+    """Indicate whether the collection is indexed with the current parameters."""
+    params = index_params(collection_name)
+    if params is None:
+        return False
+    return (params.get('index_type') == INDEX_PARAMS['index_type']
+            and params.get('metric_type') == INDEX_PARAMS['metric_type']
+            and {key: int(value) for key, value in params.get('params', {}).items()} == HNSW_PARAMS)
+
+
+def ensure_index(collection_name: str) -> None:
+    """Create the index if the collection has none, new segments are then indexed by Milvus in the background."""
+    collection = get_collection(collection_name)
+    if not collection.has_index():
+        collection.create_index(field_name="text_embedding", index_params=INDEX_PARAMS)
+
+
+def fragmentation(collection_name: str) -> float:
+    """Return the share of segments that are less than half full, 0 if the collection isn't loaded."""
+    if collection_name not in loaded_collections:
+        return 0.0
+    segments = utility.get_query_segment_info(collection_name)
+    if len(segments) < 2:
+        return 0.0
+    full = settings.MILVUS_SEGMENT_SIZE * 1024**2 // (_dim(get_collection(collection_name)) * 4)
+    return sum(1 for segment in segments if segment.num_rows < full / 2) / len(segments)
+
+
+def compact(collection_name: str) -> None:
+    """Merge small segments and purge deleted entries, the collection keeps serving searches."""
+    get_collection(collection_name).compact()
+
+
 def build_index(collection_name: str) -> None:
-    """Build the index of this collection."""
-    collection = Collection(collection_name)
+    """Build the index of this collection from scratch, the collection can't be searched meanwhile."""
+    collection = get_collection(collection_name)
 
     collection.release()
+    invalidate_collection(collection_name)
     collection.drop_index()
 
-    index_params = {
-        'metric_type': 'L2',
-        'index_type': 'HNSW',
-        'params': {
-            'M': 64,
-            'efConstruction': 128,
-        }
-    }
-
     collection.create_index(field_name="text_embedding",
-                            index_params=index_params)
+                            index_params=INDEX_PARAMS)
@@ -1,19 +1,59 @@
 """Completion engine."""
-from typing import cast
+from typing import Any, AsyncIterator, Dict, List, cast
 
 import backoff
 import openai
 import openai.error
-from asyncio_redis_rate_limit import RateLimiter, RateLimitError, RateSpec
-from redis.asyncio import Redis as AsyncRedis
 
+from chatbot import limits
 from chatbot.models import Chatbot
+from chatbot.tokenizer import count_tokens
 from usage.services import astore_charge
 
+RETRY_ERRORS = (openai.error.RateLimitError, openai.error.TryAgain)
+
+# Tokens OpenAI adds to every chat message for its formatting
+MESSAGE_OVERHEAD = 4
+
+
+def build_messages(prompt: str, context: str, question: str, chatbot: Chatbot) -> List[Dict[str, str]]:
+    """Build the chat messages sent to the model."""
+    messages = [
+        {"role": "system", "content": prompt},
+    ]
+
+    if not chatbot.skip_context:
+        messages.append({"role": "system", "content": context})
+
+    messages.append({"role": "user", "content": question})
+    return messages
+
+
+def count_prompt_tokens(messages: List[Dict[str, str]], model: str) -> int:
+    """Count the tokens of the messages as OpenAI does for the prompt."""
+    return sum(count_tokens(message["content"], model) + MESSAGE_OVERHEAD for message in messages)
+
+
+async def _create_completion(messages: List[Dict[str, str]], prompt_tokens: int, chatbot: Chatbot,
+                             stream: bool = False) -> Any:
+    """Request a completion, waiting for the rate limit of the key and model."""
+    await limits.acquire(chatbot.openai_key, chatbot.model, prompt_tokens + chatbot.max_tokens)
+    return await openai.ChatCompletion.acreate(
+        messages=messages,
+        api_key=chatbot.openai_key,
+        model=chatbot.model,
+        max_tokens=chatbot.max_tokens,
+        temperature=chatbot.temperature,
+        presence_penalty=chatbot.presence_penality,
+        frequency_penalty=chatbot.frequency_penality,
+        user=chatbot.slug,
+        stream=stream,
+    )
+
 
 @backoff.on_exception(
     backoff.constant,
-    (RateLimitError, openai.error.RateLimitError, openai.error.TryAgain),
+    RETRY_ERRORS,
     max_time=60,
     interval=8,
 )
@@ -21,32 +61,45 @@ async def generate_completion(
     prompt: str, context: str, question: str, chatbot: Chatbot
 ) -> str:
     """Generate completion using the prompt and settings from the chatbot."""
-    redis = AsyncRedis.from_url("redis://redis:6379")
-    async with RateLimiter(
-        unique_key="openai_completion",
-        rate_spec=RateSpec(requests=60, seconds=60),
-        backend=redis,
-        cache_prefix="openai_completion",
-    ):
-        messages = [
-            {"role": "system", "content": prompt},
-        ]
-
-        if not chatbot.skip_context:
-            messages.append({"role": "system", "content": context})
-
-        messages.append({"role": "user", "content": question})
-        response = await openai.ChatCompletion.acreate(
-            messages=messages,
-            api_key=chatbot.openai_key,
-            model=chatbot.model,
-            max_tokens=chatbot.max_tokens,
-            temperature=chatbot.temperature,
-            presence_penalty=chatbot.presence_penality,
-            frequency_penalty=chatbot.frequency_penality,
-            user=chatbot.slug,
-        )
+    messages = build_messages(prompt, context, question, chatbot)
+    prompt_tokens = count_prompt_tokens(messages, chatbot.model)
+    response = await _create_completion(messages, prompt_tokens, chatbot)
 
     await astore_charge(chatbot.openai_org, response)
+    estimate = prompt_tokens + chatbot.max_tokens
+    await limits.adjust(chatbot.openai_key, chatbot.model, response["usage"]["total_tokens"] - estimate)
 
     return cast(str, response["choices"][0]["message"]["content"])
+
+
+@backoff.on_exception(
+    backoff.constant,
+    RETRY_ERRORS,
+    max_time=60,
+    interval=8,
+)
+async def _open_stream(messages: List[Dict[str, str]], prompt_tokens: int, chatbot: Chatbot) -> Any:
+    return await _create_completion(messages, prompt_tokens, chatbot, stream=True)
+
+
+async def stream_completion(
+    prompt: str, context: str, question: str, chatbot: Chatbot
+) -> AsyncIterator[str]:
+    """Generate completion like generate_completion, yielding the parts of the answer as they arrive.
+
+    Streamed responses don't report their usage, so the charge is counted with the tokenizer.
+    """
+    messages = build_messages(prompt, context, question, chatbot)
+    prompt_tokens = count_prompt_tokens(messages, chatbot.model)
+    response = await _open_stream(messages, prompt_tokens, chatbot)
+
+    parts = []
+    async for chunk in response:
+        content = chunk["choices"][0]["delta"].get("content")
+        if content:
+            parts.append(content)
+            yield content
+
+    tokens = prompt_tokens + count_tokens("".join(parts), chatbot.model, memoize=False)
+    await astore_charge(chatbot.openai_org, {"model": chatbot.model, "usage": {"total_tokens": tokens}})
+    await limits.adjust(chatbot.openai_key, chatbot.model, tokens - prompt_tokens - chatbot.max_tokens)
@@ -1,22 +1,128 @@
 """Methods for creating embeddings from texts."""
+import asyncio
+import hashlib
 import logging
 import textwrap
-from typing import List
+import weakref
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+import backoff
 import numpy as np
 import openai
-from transformers import GPT2Tokenizer
+import openai.error
+from django.conf import settings
 
-from usage.services import store_charge
-
-tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+from chatbot import metrics
+from chatbot.cache import TwoTierCache, normalize_text
+from chatbot.models import StoredEmbedding
+from chatbot.tokenizer import count_tokens, count_tokens_batch
+from usage.services import astore_charge, store_charge
 
 logger = logging.getLogger(__name__)
 
+query_embeddings = TwoTierCache(
+    'embedding',
+    maxsize=settings.EMBEDDING_CACHE_SIZE,
+    timeout=settings.EMBEDDING_CACHE_TIMEOUT,
+)
+
+
+BatchKey = Tuple[str, str, str, str]
+
+# Tokens sent to OpenAI per request, longer texts are split into parts
+MAX_TOKENS = 6000
+
+
+class EmbeddingBatcher:
+    """Collect concurrent embedding requests and send them to OpenAI as one batch.
+
+    The first request for an api key, model, user and organization opens a batch that is
+    sent after ``EMBEDDING_BATCH_WINDOW`` seconds or once it holds ``EMBEDDING_BATCH_SIZE``
+    texts. Every caller waits for its own vector from the shared response.
+    """
+
+    def __init__(self, window: float, max_size: int) -> None:
+        """Create a batcher for the running event loop."""
+        self.window = window
+        self.max_size = max_size
+        self._pending: Dict[BatchKey, List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[BatchKey, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str, openai_key: str, embedding_model: str, user: str, org_id: str) -> np.ndarray:
+        """Return the embedding of the text once the batch it was added to is answered."""
+        loop = asyncio.get_running_loop()
+        key = (openai_key, embedding_model, user, org_id)
+        future: asyncio.Future = loop.create_future()
+
+        batch = self._pending.setdefault(key, [])
+        batch.append((text, future))
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+
+        return await future
+
+    def _flush(self, key: BatchKey) -> None:
+        """Close the batch of the key and send it in a task."""
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._send(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, key: BatchKey, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        openai_key, embedding_model, user, org_id = key
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        metrics.incr('embedding.batch.requests')
+        metrics.incr('embedding.batch.inputs', len(batch))
+        try:
+            response = await openai.Embedding.acreate(
+                api_key=openai_key,
+                input=texts,
+                model=embedding_model,
+                user=user,
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
 
-def count_tokens(text: str) -> int:
-    """Count tokens in given text."""
-    return len(tokenizer(text)['input_ids'])
+        embeddings = {
+            texts[data['index']]: np.array(data['embedding'], dtype=np.float32)
+            for data in response['data']
+        }
+        for text, future in batch:
+            if not future.done():
+                future.set_result(embeddings[text])
+
+        try:
+            await astore_charge(org_id, response)
+        except Exception:
+            logger.exception("Couldn't store charge of embedding batch")
+
+
+_batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, EmbeddingBatcher]" = weakref.WeakKeyDictionary()
+
+
+def get_batcher() -> EmbeddingBatcher:
+    """Return the embedding batcher of the running event loop."""
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = EmbeddingBatcher(settings.EMBEDDING_BATCH_WINDOW, settings.EMBEDDING_BATCH_SIZE)
+    return batcher
+
+
+def query_cache_key(text: str, embedding_model: str) -> str:
+    """Return the cache key of the embedding of a query."""
+    digest = hashlib.sha256(normalize_text(text).encode()).hexdigest()
+    return f'{embedding_model}:{digest}'
 
 
 async def single_embedding(text: str,
@@ -24,24 +130,26 @@ async def single_embedding(text: str,
                            embedding_model: str,
                            user: str,
                            org_id: str = '') -> np.ndarray:
-    """Generate a single embedding with model and api key of the realm."""
-    response = await openai.Embedding.acreate(
-        api_key=openai_key,
-        input=text,
-        model=embedding_model,
-        user=user,
-    )
-    store_charge(org_id, response)
+    """Generate a single embedding with model and api key of the realm.
+
+    Embeddings are cached by model and normalized text, only misses are charged.
+    """
+    key = query_cache_key(text, embedding_model)
+    cached = await query_embeddings.get(key)
+    if cached is not None:
+        return np.frombuffer(cached, dtype=settings.EMBEDDING_CACHE_DTYPE).astype(np.float32)
 
-    return np.array(response['data'][0]['embedding'])
+    embedding = await get_batcher().embed(text, openai_key, embedding_model, user, org_id)
+    await query_embeddings.set(key, embedding.astype(settings.EMBEDDING_CACHE_DTYPE).tobytes())
+    return embedding
 
 
-def _chunk_text(texts: List[str], max_tokens=6000) -> List[List[str]]:
+def _chunk_text(texts: List[str], max_tokens=MAX_TOKENS, model: Optional[str] = None) -> List[List[str]]:
     """Generate a list of lists where each inner list contains texts that together are shorter than max_tokens."""
     chunks: List[List[str]] = [[]]
     current_length = 0
-    for sentence in texts:
-        length = count_tokens(sentence)
+    lengths = count_tokens_batch(texts, model, memoize=False)
+    for sentence, length in zip(texts, lengths):
         if current_length + length < max_tokens:
             current_length += length
             chunks[-1].append(sentence)
@@ -53,7 +161,7 @@ def _chunk_text(texts: List[str], max_tokens=6000) -> List[List[str]]:
             chunks += [[
                 part
             ] for part in textwrap.wrap(sentence, width=sentence_length)]
-            current_length = count_tokens(chunks[-1][0])
+            current_length = count_tokens(chunks[-1][0], model, memoize=False)
             continue
 
         chunks.append([sentence])
@@ -61,15 +169,109 @@ def _chunk_text(texts: List[str], max_tokens=6000) -> List[List[str]]:
     return chunks
 
 
+@backoff.on_exception(
+    backoff.expo,
+    (openai.error.RateLimitError, openai.error.TryAgain, openai.error.ServiceUnavailableError),
+    max_time=300,
+)
+def _create_embeddings(**kwargs: Any) -> Any:
+    """Request embeddings, backing off while the rate limit of the key is exceeded."""
+    return openai.Embedding.create(**kwargs)
+
+
+def content_hash(text: str) -> str:
+    """Return the hash identifying the exact content of a text."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def load_embeddings(embedding_model: str, hashes: List[str], batch_size: int = 1000) -> Dict[str, np.ndarray]:
+    """Return the stored embeddings of the content hashes that have one."""
+    embeddings = {}
+    for start in range(0, len(hashes), batch_size):
+        rows = StoredEmbedding.objects.filter(
+            model=embedding_model,
+            content_hash__in=hashes[start:start + batch_size],
+        ).values_list('content_hash', 'embedding')
+        for digest, data in rows:
+            embeddings[digest] = np.frombuffer(data, dtype=np.float32)
+    return embeddings
+
+
+def save_embeddings(embedding_model: str, embeddings: Dict[str, np.ndarray]) -> None:
+    """Store embeddings by content hash, embeddings stored meanwhile are kept."""
+    StoredEmbedding.objects.bulk_create(
+        [
+            StoredEmbedding(
+                model=embedding_model,
+                content_hash=digest,
+                embedding=np.asarray(embedding, dtype=np.float32).tobytes(),
+            ) for digest, embedding in embeddings.items()
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
 def batch_embedding(texts: List[str],
                     openai_key: str,
                     embedding_model: str,
                     user: str,
                     org_id: str = '') -> np.ndarray:
-    """Generate batch of embeddings for provided texts."""
+    """Generate batch of embeddings for provided texts.
+
+    Texts are looked up in the embedding store by model and content hash first, only the
+    missing ones are sent to OpenAI and stored afterwards.
+    """
+    if not settings.EMBEDDING_STORE:
+        return _request_embeddings(texts, openai_key, embedding_model, user, org_id)
+
+    hashes = [content_hash(text) for text in texts]
+    stored = load_embeddings(embedding_model, list(set(hashes)))
+    missing = list(dict.fromkeys(text for text, digest in zip(texts, hashes) if digest not in stored))
+    metrics.incr('embedding.store.hits', len(texts) - len(missing))
+    metrics.incr('embedding.store.misses', len(missing))
+
+    if missing:
+        embeddings = _request_embeddings(missing, openai_key, embedding_model, user, org_id)
+        created = {content_hash(text): embedding for text, embedding in zip(missing, embeddings)}
+        save_embeddings(embedding_model, created)
+        stored.update(created)
+
+    return np.array([stored[digest] for digest in hashes])
+
+
+def _request_embeddings(texts: List[str], openai_key: str, embedding_model: str, user: str,
+                        org_id: str) -> np.ndarray:
+    """Request one embedding per text from OpenAI in chunks below the token limit.
+
+    Texts over the limit are requested on their own and get the normalized mean of the
+    embeddings of their parts.
+    """
+    lengths = count_tokens_batch(texts, embedding_model, memoize=False)
+    fitting = [text for text, length in zip(texts, lengths) if length <= MAX_TOKENS]
+    embeddings = _embed_chunks(fitting, openai_key, embedding_model, user, org_id)
+    if len(embeddings) != len(fitting):
+        raise ValueError(f'Got {len(embeddings)} embeddings for {len(fitting)} texts')
+
+    results = []
+    remaining = iter(embeddings)
+    for text, length in zip(texts, lengths):
+        if length <= MAX_TOKENS:
+            results.append(next(remaining))
+            continue
+        mean = np.mean(_embed_chunks([text], openai_key, embedding_model, user, org_id), axis=0)
+        results.append(mean / np.linalg.norm(mean))
+
+    return np.array(results)
+
+
+def _embed_chunks(texts: List[str], openai_key: str, embedding_model: str, user: str, org_id: str) -> List[Any]:
+    """Request the embeddings of the texts and of the parts of texts over the token limit."""
     results = []
-    for chunk in _chunk_text(texts):
-        response = openai.Embedding.create(
+    for chunk in _chunk_text(texts, MAX_TOKENS, embedding_model):
+        if not chunk:
+            continue
+        response = _create_embeddings(
             api_key=openai_key,
             input=chunk,
             model=embedding_model,
@@ -77,5 +279,4 @@ def batch_embedding(texts: List[str],
         )
         store_charge(org_id, response)
         results += [data['embedding'] for data in response['data']]
-
-    return np.array(results)
+    return results
@@ -0,0 +1,98 @@
+"""Rate limits of OpenAI, counted per API key and model in Redis.
+
+Every key and model has its own budget of requests and tokens per minute, so a
+busy bot only waits for its own key and never for the others.
+"""
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from typing import Tuple
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from chatbot import metrics
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+WINDOW = 60
+
+# KEYS: request and token counters of the current window
+# ARGV: requests per minute, tokens per minute, tokens of this request, ttl
+# A request larger than the whole token budget is let through once the window is empty.
+ACQUIRE_SCRIPT = """
+local requests = tonumber(redis.call('GET', KEYS[1]) or '0')
+local tokens = tonumber(redis.call('GET', KEYS[2]) or '0')
+local cost = tonumber(ARGV[3])
+if requests >= tonumber(ARGV[1]) or (tokens > 0 and tokens + cost > tonumber(ARGV[2])) then
+    return 0
+end
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('INCRBY', KEYS[2], cost)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+
+class CapacityExceeded(Exception):
+    """The key had no capacity left for the request within the maximum wait."""
+
+
+def get_limits(model: str) -> Tuple[int, int]:
+    """Return the requests and tokens per minute allowed for the model."""
+    limit = settings.OPENAI_RATE_LIMITS.get(model, settings.OPENAI_DEFAULT_RATE_LIMIT)
+    requests, tokens = limit.split("/")
+    return int(requests), int(tokens)
+
+
+def _keys(api_key: str, model: str, window: int) -> Tuple[str, str]:
+    """Return the counter keys, the API key itself is never stored."""
+    digest = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    prefix = f"openai:{digest}:{model}:{window}"
+    return f"{prefix}:requests", f"{prefix}:tokens"
+
+
+async def acquire(api_key: str, model: str, tokens: int) -> None:
+    """Wait until the key has capacity for a request of the given tokens and count it.
+
+    Raises CapacityExceeded after OPENAI_RATE_LIMIT_WAIT seconds. If Redis is
+    unavailable the request is let through and OpenAI limits it on its own.
+    """
+    if not settings.REDIS_URL:
+        return
+
+    rpm, tpm = get_limits(model)
+    deadline = time.monotonic() + settings.OPENAI_RATE_LIMIT_WAIT
+    while True:
+        now = time.time()
+        window = int(now // WINDOW)
+        try:
+            granted = await get_redis().eval(ACQUIRE_SCRIPT, 2, *_keys(api_key, model, window), rpm, tpm, tokens,
+                                             WINDOW * 2)
+        except (RedisError, OSError) as e:
+            logger.warning("Couldn't check OpenAI rate limit: %s", e)
+            return
+        if granted:
+            return
+
+        metrics.incr("openai.throttled")
+        # Spread the waiting requests over the start of the next window
+        wait = (window + 1) * WINDOW - now + random.uniform(0, 1)
+        if time.monotonic() + wait > deadline:
+            raise CapacityExceeded(f"No capacity left for {model} within {settings.OPENAI_RATE_LIMIT_WAIT}s")
+        await asyncio.sleep(wait)
+
+
+async def adjust(api_key: str, model: str, tokens: int) -> None:
+    """Correct the counted tokens of the current window once the real usage is known."""
+    if not settings.REDIS_URL or not tokens:
+        return
+    _, key = _keys(api_key, model, int(time.time() // WINDOW))
+    try:
+        await get_redis().incrby(key, tokens)
+    except (RedisError, OSError) as e:
+        logger.warning("Couldn't adjust OpenAI rate limit: %s", e)
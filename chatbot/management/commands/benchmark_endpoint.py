@@ -0,0 +1,84 @@
+"""Measure throughput of an endpoint served by the ASGI application at several concurrency levels."""
+import asyncio
+import statistics
+import time
+from typing import Any, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+
+
+async def _request(application: Any, path: str, query: str) -> Tuple[int, float]:
+    """Send a GET request to the application, return the status and seconds until the response is complete."""
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    status = 0
+    done = asyncio.Event()
+
+    async def receive() -> dict:
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message: dict) -> None:
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body' and not message.get('more_body'):
+            done.set()
+
+    start = time.perf_counter()
+    await application(scope, receive, send)
+    await done.wait()
+    return status, time.perf_counter() - start
+
+
+async def _run(application: Any, path: str, query: str, concurrency: int,
+               requests: int) -> Tuple[float, List[float], int]:
+    """Send the requests with the given number in flight, return the duration, latencies and errors."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited() -> Tuple[int, float]:
+        async with semaphore:
+            return await _request(application, path, query)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited() for _ in range(requests)))
+    duration = time.perf_counter() - start
+    errors = sum(1 for status, _ in results if status >= 400)
+    return duration, sorted(latency for _, latency in results), errors
+
+
+class Command(BaseCommand):
+    """Command to benchmark an endpoint in-process, without a server or network in between."""
+
+    help = "Benchmark an endpoint of core.asgi at increasing concurrency."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Add arguments."""
+        parser.add_argument('path', type=str, help="e.g. /bot/<slug>/name/")
+        parser.add_argument('--query', type=str, default='', help="query string, e.g. question=Hello")
+        parser.add_argument('--concurrency', type=str, default='1,10,50,100')
+        parser.add_argument('--requests', type=int, default=500, help="requests per concurrency level")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """Run the benchmark and print requests per second and latency percentiles."""
+        from core.asgi import application
+
+        levels = [int(level) for level in options['concurrency'].split(',')]
+        self.stdout.write(f"{'concurrency':>11} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'errors':>6}")
+
+        for level in levels:
+            duration, latencies, errors = asyncio.run(
+                _run(application, options['path'], options['query'], level, options['requests']))
+            p50 = statistics.median(latencies) * 1000
+            p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+            self.stdout.write(f"{level:>11} {len(latencies) / duration:>9.1f} {p50:>8.1f} {p95:>8.1f} {errors:>6}")
@@ -0,0 +1,56 @@
+"""Measure loading time and throughput of the tokenizer."""
+import time
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from chatbot import tokenizer
+from chatbot.models import Text
+
+SAMPLE = ("The chatbot answers questions with the help of texts from websites and documents. "
+          "Öffnungszeiten: Montag bis Freitag, 08:00–17:00 Uhr. ")
+
+
+class Command(BaseCommand):
+    """Command to benchmark the tokenizer."""
+
+    help = "Benchmark loading the tokenizer and counting tokens, one text at a time and in batches."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Add arguments."""
+        parser.add_argument('--model', type=str, default=None)
+        parser.add_argument('--realm', type=str, default=None, help="count texts of this realm instead of a sample")
+        parser.add_argument('--count', type=int, default=2000, help="number of texts")
+
+    def _texts(self, realm: str, count: int) -> List[str]:
+        if realm:
+            return list(Text.objects.filter(realm__slug=realm).values_list('content', flat=True)[:count])
+        return [f"{i} {SAMPLE * (1 + i % 8)}" for i in range(count)]
+
+    def _report(self, name: str, seconds: float, tokens: int) -> None:
+        self.stdout.write(f"{name:<12} {seconds * 1000:>9.1f} ms {tokens / seconds:>12.0f} tokens/s")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """Run the benchmark."""
+        start = time.perf_counter()
+        encoding = tokenizer.get_encoding(options['model'])
+        self.stdout.write(f"Loaded encoding {encoding.name} in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        texts = self._texts(options['realm'], options['count'])
+        if not texts:
+            self.stdout.write("No texts to count.")
+            return
+
+        start = time.perf_counter()
+        tokens = sum(len(encoding.encode(text)) for text in texts)
+        self._report("single", time.perf_counter() - start, tokens)
+
+        start = time.perf_counter()
+        tokenizer.count_tokens_batch(texts, options['model'], memoize=False)
+        self._report("batch", time.perf_counter() - start, tokens)
+
+        tokenizer.counts.clear()
+        tokenizer.count_tokens_batch(texts, options['model'])
+        start = time.perf_counter()
+        tokenizer.count_tokens_batch(texts, options['model'])
+        self._report("memoized", time.perf_counter() - start, tokens)
@@ -1,7 +1,7 @@
 """Clear index."""
 from django.core.management.base import BaseCommand
 
-from chatbot.collections import drop_collection
+from chatbot.backends import get_backend
 from chatbot.models import Realm, Text
 
 
@@ -14,5 +14,6 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         """Start indexing the realm."""
-        drop_collection(options['realm'])
-        Text.objects.filter(realm=Realm.objects.get(slug=options['realm'])).update(indexed=False)
+        realm = Realm.objects.get(slug=options['realm'])
+        get_backend(realm).drop(realm.collection)
+        Text.objects.filter(realm=realm).update(indexed=False)
@@ -1,12 +1,45 @@
 """Import texts into database."""
-import json
-from typing import Any, List
+import csv
+import gzip
+import io
+import itertools
+import sys
+import time
+from typing import IO, Any, Dict, Iterator, List, Set
 
-from django.core.management.base import BaseCommand, CommandParser
+import orjson
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connection, transaction
+from django.utils import timezone
 
+from chatbot.chunking import Chunk, Chunker
+from chatbot.embeddings import content_hash
 from chatbot.models import Realm, Text
 
-BATCH_SIZE = 1024
+BATCH_SIZE = 10_000
+
+# Hashes looked up per query when checking for texts already in the realm
+LOOKUP_SIZE = 900
+
+COPY_COLUMNS = ('realm_id', 'content', 'url', 'page', 'internal', 'created_at', 'indexed', 'token_count',
+                'content_hash')
+
+
+def open_input(path: str) -> IO[bytes]:
+    """Open a jsonl file for reading, decompressing gzip and zstd files and reading '-' from stdin."""
+    if path == '-':
+        # Closing the file after the import leaves stdin open
+        return open(sys.stdin.buffer.fileno(), 'rb', closefd=False)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith(('.zst', '.zstd')):
+        try:
+            import zstandard
+        except ImportError:
+            raise CommandError('zstandard is required to import .zst files')
+        # The decompressing reader doesn't read lines by itself
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return open(path, 'rb')
 
 
 class Command(BaseCommand):
@@ -16,39 +49,123 @@ class Command(BaseCommand):
         """Create a new command."""
         super().__init__(*args, **kwargs)
         self.batch: List[Text] = []
+        self.seen: Set[str] = set()
 
     help = "Import texts into database"
 
-    def _process_line(self, line: str) -> None:
-        data = json.loads(line)
+    def _read_lines(self, f: IO[bytes]) -> Iterator[Dict[str, Any]]:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
+
+    def _process_batch(self, lines: List[Dict[str, Any]]) -> None:
+        for data, chunks in zip(lines, self.chunker.chunk([data['text'] for data in lines])):
+            for chunk in chunks:
+                self._add_text(data, chunk)
+        self._create_db()
+
+    def _add_text(self, data: Dict[str, Any], chunk: Chunk) -> None:
+        digest = content_hash(chunk.text)
+
+        if not self.keep_duplicates:
+            # Duplicates in earlier batches are found in the database
+            if digest in self.seen:
+                self.skipped += 1
+                return
+            self.seen.add(digest)
 
         self.batch.append(
             Text(
                 realm=self.realm,
-                content=data['text'],
+                content=chunk.text,
                 url=data['url'],
                 page=data['page'],
+                internal=data.get('internal', False),
+                token_count=chunk.tokens,
+                content_hash=digest,
             ))
 
-        if len(self.batch) > BATCH_SIZE:
-            self._create_db()
+    def _existing_hashes(self, hashes: List[str]) -> Set[str]:
+        existing: Set[str] = set()
+        for i in range(0, len(hashes), LOOKUP_SIZE):
+            existing.update(
+                Text.objects.filter(realm=self.realm,
+                                    content_hash__in=hashes[i:i + LOOKUP_SIZE]).values_list('content_hash', flat=True))
+        return existing
 
     def _create_db(self) -> None:
-        Text.objects.bulk_create(self.batch)
+        if not self.batch:
+            return
+        if not self.keep_duplicates:
+            existing = self._existing_hashes([text.content_hash for text in self.batch])
+            if existing:
+                count = len(self.batch)
+                self.batch = [text for text in self.batch if text.content_hash not in existing]
+                self.skipped += count - len(self.batch)
+
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                self._copy()
+            else:
+                Text.objects.bulk_create(self.batch)
+
+        self.imported += len(self.batch)
         self.batch = []
+        self.seen.clear()
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(f'{self.imported} texts imported, {self.skipped} duplicates skipped '
+                          f'({self.imported / max(elapsed, 1e-6):.0f} rows/s)')
+
+    def _copy(self) -> None:
+        buffer = io.StringIO()
+        # Quote every value, unquoted empty values are read as NULL
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        created_at = timezone.now().isoformat()
+        for text in self.batch:
+            writer.writerow((self.realm.pk, text.content, text.url, text.page, text.internal, created_at, False,
+                             text.token_count, text.content_hash))
+        buffer.seek(0)
+
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {Text._meta.db_table} ({", ".join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT csv)',
+                buffer,
+            )
 
     def add_arguments(self, parser: CommandParser) -> None:
         """Add arguments to the command."""
         parser.add_argument('realm', type=str)
-        parser.add_argument('path', type=str)
+        parser.add_argument('path', type=str, help="jsonl file, optionally .gz or .zst compressed, or - for stdin")
+        parser.add_argument('--batch_size', type=int, default=BATCH_SIZE, required=False)
+        parser.add_argument('--chunk_tokens',
+                            type=int,
+                            default=None,
+                            required=False,
+                            help="split texts into snippets of about this many tokens (0 = don't split)")
+        parser.add_argument('--chunk_overlap', type=int, default=None, required=False)
+        parser.add_argument('--processes', type=int, default=None, required=False, help="processes splitting texts")
+        parser.add_argument('--keep_duplicates',
+                            action='store_true',
+                            help="import texts whose content is already in the realm or the input")
 
     def handle(self, *args: Any, **options: Any) -> None:
         """Handle the command."""
         self.realm = Realm.objects.get(slug=options['realm'])
         self.batch = []
+        self.seen = set()
+        self.batch_size = options['batch_size']
+        self.keep_duplicates = options['keep_duplicates']
+        self.imported = 0
+        self.skipped = 0
+        self.started = time.monotonic()
         path: str = options.get('path', '')
 
-        with open(path) as f:
-            for line in f:
-                self._process_line(line)
-            self._create_db()
+        self.chunker = Chunker(options['chunk_tokens'], options['chunk_overlap'], options['processes'])
+
+        with open_input(path) as f, self.chunker:
+            lines = self._read_lines(f)
+            while batch := list(itertools.islice(lines, self.batch_size)):
+                self._process_batch(batch)
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(f'Imported {self.imported} texts in {elapsed:.1f}s, skipped {self.skipped} duplicates')
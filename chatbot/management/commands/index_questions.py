@@ -0,0 +1,18 @@
+"""Index the questions of a chatbot for the answer cache."""
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from chatbot.services import index_questions
+
+
+class Command(BaseCommand):
+    """Command to index questions."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Add arguments."""
+        parser.add_argument('bot', type=str)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """Start indexing the questions of the bot."""
+        index_questions(options['bot'])
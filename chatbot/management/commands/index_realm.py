@@ -2,9 +2,10 @@
 import argparse
 from typing import Any
 
-from django.core.management.base import BaseCommand, CommandParser
+from django.core.management.base import BaseCommand, CommandError, CommandParser
 
-from chatbot.services import index_realm
+from chatbot.models import IndexJob
+from chatbot.services import create_index_job, index_realm, retry_index_job
 
 
 class Command(BaseCommand):
@@ -15,16 +16,73 @@ class Command(BaseCommand):
         parser.add_argument('realm', type=str)
         parser.add_argument('--batch_size',
                             type=int,
-                            default=10_000,
+                            default=1000,
                             required=False)
+        parser.add_argument('--concurrency',
+                            type=int,
+                            default=None,
+                            required=False,
+                            help="batches embedded at the same time")
         parser.add_argument('--monitor', action=argparse.BooleanOptionalAction)
+        parser.add_argument('--rebuild_index',
+                            action='store_true',
+                            help="rebuild the index from scratch instead of extending it")
+        parser.add_argument('--distributed',
+                            action='store_true',
+                            help="split the texts into shards indexed by Celery workers")
+        parser.add_argument('--shard_size', type=int, default=None, required=False)
+        parser.add_argument('--retry_failed',
+                            action='store_true',
+                            help="queue the failed and skipped shards of the last distributed job again")
+        parser.add_argument('--status', action='store_true', help="show the progress of the last indexing job")
 
     def handle(self, *args: Any, **options: Any) -> None:
         """Start indexing the realm."""
-        if options['monitor']:
-            index_realm(options['realm'], 1, True)
-        else:
-            index_realm(
-                options['realm'],
-                options['batch_size'],
-            )
+        if options['distributed'] or options['retry_failed'] or options['status']:
+            self._distributed(options)
+            return
+
+        try:
+            if options['monitor']:
+                index_realm(options['realm'], 1, True, rebuild=options['rebuild_index'])
+            else:
+                index_realm(
+                    options['realm'],
+                    options['batch_size'],
+                    concurrency=options['concurrency'],
+                    rebuild=options['rebuild_index'],
+                )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+    def _distributed(self, options: Any) -> None:
+        from chatbot.tasks import dispatch_index_job
+
+        jobs = IndexJob.objects.filter(realm__slug=options['realm']).order_by('-created_at')
+
+        if options['status']:
+            job = jobs.first()
+            if job is None:
+                raise CommandError("The realm was never indexed.")
+            if job.distributed:
+                detail = f"{job.finished_shards}/{job.shard_count} shards"
+            else:
+                detail = f"checkpoint at text {job.checkpoint_id}"
+            self.stdout.write(f"{job}: {job.indexed_count}/{job.text_count} texts, {detail} {job.error}")
+            return
+
+        if options['retry_failed']:
+            job = jobs.filter(distributed=True).first()
+            if job is None or job.status != IndexJob.Status.FAILED:
+                raise CommandError("The last job of the realm didn't fail.")
+            dispatch_index_job(job, retry_index_job(job))
+            self.stdout.write(f"Queued the unfinished shards of {job} again.")
+            return
+
+        try:
+            job = create_index_job(options['realm'], options['shard_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        dispatch_index_job(job)
+        self.stdout.write(f"Queued {job.shard_count} shards with {job.text_count} texts, "
+                          f"follow the progress with --status.")
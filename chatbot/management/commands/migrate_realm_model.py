@@ -0,0 +1,43 @@
+"""Re-embed a realm with another embedding model without downtime."""
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from chatbot.models import Realm
+from chatbot.services import migrate_realm_model
+from chatbot.tasks import drop_collections
+
+
+class Command(BaseCommand):
+    """Command to switch a realm to another embedding model."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Add arguments."""
+        parser.add_argument('realm', type=str)
+        parser.add_argument('model', type=str)
+        parser.add_argument('dim', type=int)
+        parser.add_argument('--batch_size', type=int, default=1000, required=False)
+        parser.add_argument('--concurrency', type=int, default=None, required=False)
+        parser.add_argument('--keep_old', action='store_true', help="keep the replaced collections")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """Build the new collections, switch the realm and drop the old ones later."""
+        try:
+            replaced = migrate_realm_model(
+                options['realm'],
+                options['model'],
+                options['dim'],
+                options['batch_size'],
+                options['concurrency'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        realm = Realm.objects.get(slug=options['realm'])
+        self.stdout.write(f"Realm {realm} switched to {realm.embedding_model} in {realm.collection}.")
+        if options['keep_old']:
+            self.stdout.write(f"Kept {', '.join(replaced)}.")
+            return
+        drop_collections.apply_async((realm.pk, replaced), countdown=settings.REALM_MIGRATION_GRACE)
+        self.stdout.write(f"Dropping {', '.join(replaced)} in {settings.REALM_MIGRATION_GRACE} seconds.")
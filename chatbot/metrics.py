@@ -0,0 +1,39 @@
+"""Process-wide counters, e.g. for cache hits and misses."""
+import threading
+from collections import Counter
+from typing import Dict
+
+_lock = threading.Lock()
+_counters: Counter = Counter()
+
+
+def incr(name: str, amount: int = 1) -> None:
+    """Increase the counter with the given name."""
+    with _lock:
+        _counters[name] += amount
+
+
+def get(name: str) -> int:
+    """Return the current value of a counter."""
+    with _lock:
+        return _counters[name]
+
+
+def snapshot() -> Dict[str, int]:
+    """Return a copy of all counters of this process."""
+    with _lock:
+        return dict(sorted(_counters.items()))
+
+
+def hit_rate(prefix: str) -> float:
+    """Return the share of ``<prefix>.hit`` among hits and misses."""
+    with _lock:
+        hits, misses = _counters[f"{prefix}.hit"], _counters[f"{prefix}.miss"]
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+def hit_rates() -> Dict[str, float]:
+    """Return the hit rate of every counter pair ``<prefix>.hit`` and ``<prefix>.miss``."""
+    with _lock:
+        prefixes = {name.rsplit(".", 1)[0] for name in _counters if name.endswith((".hit", ".miss"))}
+    return {prefix: hit_rate(prefix) for prefix in sorted(prefixes)}
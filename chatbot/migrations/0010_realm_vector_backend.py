@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0009_chatbot_skip_context'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='realm',
+            name='vector_backend',
+            field=models.CharField(choices=[('milvus', 'Milvus'), ('local', 'Local (NumPy)')], default='milvus', max_length=20),
+        ),
+    ]
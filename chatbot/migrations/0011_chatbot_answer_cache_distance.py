@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0010_realm_vector_backend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='answer_cache_distance',
+            field=models.FloatField(default=0, help_text='Reuse the answer of an approved or frequently asked question whose embedding is at most this (squared L2) distance away, 0 disables the answer cache.'),
+        ),
+    ]
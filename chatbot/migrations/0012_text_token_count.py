@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0011_chatbot_answer_cache_distance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='truncate_context',
+            field=models.BooleanField(default=False, help_text="Cut the last text that doesn't fit into the context instead of leaving it out."),
+        ),
+        migrations.AddField(
+            model_name='text',
+            name='token_count',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
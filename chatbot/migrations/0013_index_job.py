@@ -0,0 +1,42 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0012_text_token_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'Running'), ('building', 'Building index'), ('done', 'Done'), ('failed', 'Failed')], default='running', max_length=20)),
+                ('shard_count', models.IntegerField(default=0)),
+                ('finished_shards', models.IntegerField(default=0)),
+                ('text_count', models.IntegerField(default=0)),
+                ('indexed_count', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('realm', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chatbot.realm')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IndexShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('text_count', models.IntegerField(default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='chatbot.indexjob')),
+            ],
+        ),
+    ]
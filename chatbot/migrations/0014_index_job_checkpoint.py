@@ -0,0 +1,34 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:41
+
+from django.db import migrations, models
+
+
+def mark_distributed(apps, schema_editor):
+    """Jobs before this migration were all run by workers."""
+    apps.get_model('chatbot', 'IndexJob').objects.update(distributed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0013_index_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexjob',
+            name='checkpoint_id',
+            field=models.BigIntegerField(blank=True, help_text='Highest id of the texts indexed so far', null=True),
+        ),
+        migrations.AddField(
+            model_name='indexjob',
+            name='distributed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='indexjob',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(mark_distributed, migrations.RunPython.noop),
+    ]
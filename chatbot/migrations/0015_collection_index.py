@@ -0,0 +1,22 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0014_index_job_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('entities', models.BigIntegerField(default=0)),
+                ('built_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
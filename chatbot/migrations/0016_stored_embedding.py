@@ -0,0 +1,27 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0015_collection_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('embedding', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='storedembedding',
+            constraint=models.UniqueConstraint(fields=('model', 'content_hash'), name='unique_stored_embedding'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0016_stored_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='realm',
+            name='collection_suffix',
+            field=models.CharField(blank=True, editable=False, help_text='Set when the realm switched to a collection embedded with another model.', max_length=100),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0017_realm_collection_suffix'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatbot',
+            name='excluded_sources',
+            field=models.TextField(blank=True, help_text='URLs whose texts are never used as context, one per line.'),
+        ),
+        migrations.AlterField(
+            model_name='realm',
+            name='vector_backend',
+            field=models.CharField(choices=[('milvus', 'Milvus'), ('milvus_shared', 'Milvus (shared collection)'), ('local', 'Local (NumPy)')], default='milvus', max_length=20),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.1 on 2026-10-18 18:53
+
+import hashlib
+
+from django.db import migrations, models, transaction
+
+
+def hash_contents(apps, schema_editor):
+    """Hash the content of the existing texts, in one statement on PostgreSQL and in batches by id otherwise."""
+    Text = apps.get_model('chatbot', 'Text')
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f"UPDATE {Text._meta.db_table} "
+                              "SET content_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex')")
+        return
+
+    texts = Text.objects.using(schema_editor.connection.alias).only('id', 'content').order_by('id')
+    last_id = 0
+    while batch := list(texts.filter(id__gt=last_id)[:1000]):
+        for text in batch:
+            text.content_hash = hashlib.sha256(text.content.encode()).hexdigest()
+        with transaction.atomic(using=schema_editor.connection.alias):
+            Text.objects.using(schema_editor.connection.alias).bulk_update(batch, ['content_hash'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    # Every batch of the backfill is committed on its own, instead of locking all texts until the end
+    atomic = False
+
+    dependencies = [
+        ('chatbot', '0018_shared_collection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='text',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.RunPython(hash_contents, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='text',
+            index=models.Index(fields=['realm', 'content_hash'], name='chatbot_tex_realm_i_5c1d6d_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-18 19:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0019_text_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexjob',
+            name='last_id',
+            field=models.BigIntegerField(blank=True, help_text='Highest id of the texts when the job started', null=True),
+        ),
+        migrations.AlterField(
+            model_name='indexjob',
+            name='checkpoint_id',
+            field=models.BigIntegerField(blank=True, help_text='Highest id up to which all texts of the job are indexed', null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.1 on 2026-10-18 19:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0020_index_job_last_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='realm',
+            name='pending_collection_suffix',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='realm',
+            name='pending_embedding_dim',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='realm',
+            name='pending_embedding_model',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+    ]
@@ -6,14 +6,37 @@ from django.db import models
 class Realm(models.Model):
     """Collects texts and configuration about generating embeddings."""
 
+    class Backend(models.TextChoices):
+        """Vector stores that can hold the embeddings of a realm."""
+
+        MILVUS = "milvus", "Milvus"
+        MILVUS_SHARED = "milvus_shared", "Milvus (shared collection)"
+        LOCAL = "local", "Local (NumPy)"
+
     openai_key = models.CharField(max_length=200)
     openai_org = models.CharField(max_length=200, blank=True)
     slug = models.SlugField(unique=True)
     embedding_model = models.CharField(max_length=100, default="text-embedding-ada-002")
     embedding_dim = models.IntegerField(default=1536)
+    vector_backend = models.CharField(max_length=20, choices=Backend.choices, default=Backend.MILVUS)
+    collection_suffix = models.CharField(
+        max_length=100,
+        blank=True,
+        editable=False,
+        help_text="Set when the realm switched to a collection embedded with another model.",
+    )
+    # Model and collection the realm is being migrated to, changed texts are synced into both collections
+    pending_embedding_model = models.CharField(max_length=100, blank=True, editable=False)
+    pending_embedding_dim = models.IntegerField(null=True, blank=True, editable=False)
+    pending_collection_suffix = models.CharField(max_length=100, blank=True, editable=False)
 
     users = models.ManyToManyField(get_user_model())
 
+    @property
+    def collection(self) -> str:
+        """Name of the collection holding the embeddings of the texts."""
+        return f"{self.slug}{self.collection_suffix}"
+
     def __str__(self) -> str:
         """Represent as a string."""
         return self.slug
@@ -46,6 +69,20 @@ class Chatbot(models.Model):
 
     skip_context = models.BooleanField(default=False)
 
+    answer_cache_distance = models.FloatField(
+        default=0,
+        help_text="Reuse the answer of an approved or frequently asked question whose embedding is "
+        "at most this (squared L2) distance away, 0 disables the answer cache.",
+    )
+    truncate_context = models.BooleanField(
+        default=False,
+        help_text="Cut the last text that doesn't fit into the context instead of leaving it out.",
+    )
+    excluded_sources = models.TextField(
+        blank=True,
+        help_text="URLs whose texts are never used as context, one per line.",
+    )
+
     def __str__(self) -> str:
         """Represent as a string."""
         return self.slug
@@ -65,12 +102,113 @@ class Text(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     indexed = models.BooleanField(default=False)
 
+    # Tokens of the content, counted on import and when indexing
+    token_count = models.IntegerField(null=True, blank=True, editable=False)
+    # SHA-256 of the content, to skip duplicates on import
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+
     def __str__(self) -> str:
         """Represent as a string."""
         return self.content
 
     class Meta:
         verbose_name = "Text"
+        indexes = [models.Index(fields=["realm", "content_hash"])]
+
+
+class StoredEmbedding(models.Model):
+    """Embedding of a text by a model, shared by all realms and kept when texts are deleted."""
+
+    model = models.CharField(max_length=100)
+    content_hash = models.CharField(max_length=64)
+    embedding = models.BinaryField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["model", "content_hash"], name="unique_stored_embedding"),
+        ]
+
+    def __str__(self) -> str:
+        """Represent as a string."""
+        return f"{self.model}:{self.content_hash}"
+
+
+class CollectionIndex(models.Model):
+    """Size of a Milvus collection when its index was last rebuilt from scratch."""
+
+    name = models.CharField(max_length=255, unique=True)
+    entities = models.BigIntegerField(default=0)
+    built_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        """Represent as a string."""
+        return self.name
+
+
+class IndexJob(models.Model):
+    """Indexing of a realm, either in one process or split into shards that Celery workers process in parallel.
+
+    The job is the checkpoint of the indexing, it is updated after every batch of texts and
+    by a heartbeat while it runs. updated_at is the last sign of life of the job.
+    """
+
+    class Status(models.TextChoices):
+        RUNNING = "running", "Running"
+        BUILDING = "building", "Building index"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+
+    realm = models.ForeignKey(Realm, models.CASCADE)
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.RUNNING)
+    distributed = models.BooleanField(default=False)
+
+    shard_count = models.IntegerField(default=0)
+    finished_shards = models.IntegerField(default=0)
+    text_count = models.IntegerField(default=0)
+    indexed_count = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    checkpoint_id = models.BigIntegerField(
+        null=True, blank=True, help_text="Highest id up to which all texts of the job are indexed"
+    )
+    last_id = models.BigIntegerField(null=True, blank=True, help_text="Highest id of the texts when the job started")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def progress(self) -> float:
+        """Share of the texts that are indexed."""
+        return self.indexed_count / self.text_count if self.text_count else 1.0
+
+    def __str__(self) -> str:
+        """Represent as a string."""
+        return f"{self.realm} ({self.get_status_display()}, {self.progress:.0%})"
+
+
+class IndexShard(models.Model):
+    """The un-indexed texts of a realm within a range of ids, indexed by one task."""
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+
+    job = models.ForeignKey(IndexJob, models.CASCADE, related_name="shards")
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.PENDING)
+
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    text_count = models.IntegerField(default=0)
+
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    def __str__(self) -> str:
+        """Represent as a string."""
+        return f"{self.first_id}-{self.last_id}"
 
 
 class Question(models.Model):
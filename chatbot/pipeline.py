@@ -0,0 +1,137 @@
+"""Staged producer/consumer pipeline running in threads.
+
+Every stage has its own workers and a bounded input queue, so a slow stage holds back
+the ones before it instead of letting batches pile up in memory, while all stages work
+at the same time.
+"""
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, List, Optional, Sequence
+
+from django.db import connections
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """A step of the pipeline, func turns the item of the previous stage into the item of the next one."""
+
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+
+
+@dataclass
+class StageStats:
+    """Work done by a stage, seconds are summed over its workers."""
+
+    name: str
+    items: int = 0
+    texts: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Texts per busy second of a worker."""
+        return self.texts / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        """Format as a line of the report."""
+        return (f"{self.name:<10} {self.items:>7} batches {self.texts:>9} texts "
+                f"{self.seconds:>9.1f}s {self.rate:>9.1f}/s")
+
+
+class Pipeline:
+    """Run items through the stages, returning statistics of every stage.
+
+    The first error of any stage stops the pipeline and is raised by ``run``.
+    ``size`` tells how many texts an item holds for the statistics.
+    """
+
+    def __init__(self, stages: Sequence[Stage], queue_size: int = 4, size: Callable[[Any], int] = len) -> None:
+        """Create a pipeline whose queues hold at most queue_size items."""
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.size = size
+        self.stats = [StageStats(stage.name) for stage in self.stages]
+        self._lock = threading.Lock()
+        self._failed = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def _fail(self, error: BaseException) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._failed.set()
+
+    def _put(self, target: "queue.Queue[Any]", item: Any) -> None:
+        while not self._failed.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, source: "queue.Queue[Any]") -> Any:
+        while not self._failed.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _work(self, index: int, queues: List["queue.Queue[Any]"], running: List[int]) -> None:
+        stage, stats = self.stages[index], self.stats[index]
+        output = queues[index + 1] if index + 1 < len(self.stages) else None
+        try:
+            while (item := self._get(queues[index])) is not _DONE:
+                start = time.perf_counter()
+                texts = self.size(item)
+                result = stage.func(item)
+                with self._lock:
+                    stats.items += 1
+                    stats.texts += texts
+                    stats.seconds += time.perf_counter() - start
+                if output is not None:
+                    self._put(output, result)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            connections.close_all()
+            with self._lock:
+                running[index] -= 1
+                last = running[index] == 0
+            if last and output is not None:
+                for _ in range(self.stages[index + 1].workers):
+                    self._put(output, _DONE)
+
+    def run(self, items: Iterable[Any]) -> List[StageStats]:
+        """Feed the items from this thread into the first stage and wait until all stages are done."""
+        queues: List["queue.Queue[Any]"] = [queue.Queue(self.queue_size) for _ in self.stages]
+        running = [stage.workers for stage in self.stages]
+        threads = [
+            threading.Thread(target=self._work, args=(index, queues, running), name=f"{stage.name}-{n}", daemon=True)
+            for index, stage in enumerate(self.stages)
+            for n in range(stage.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for item in items:
+                if self._failed.is_set():
+                    break
+                self._put(queues[0], item)
+        except BaseException as e:
+            self._fail(e)
+        for _ in range(self.stages[0].workers):
+            self._put(queues[0], _DONE)
+
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.stats
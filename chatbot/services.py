@@ -1,8 +1,25 @@
 """Functions implementing the functionality of the chatbots."""
-from typing import List, Optional, Tuple
-
+import contextlib
+import copy
+import functools
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
 import openai
 from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+from django.db.models import F, Max, Q, QuerySet
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from django_filters import filters
 from rest_framework import viewsets
 from rest_framework_datatables.django_filters.backends import (
@@ -12,23 +29,82 @@ from rest_framework_datatables.django_filters.filters import GlobalFilter
 from rest_framework_datatables.django_filters.filterset import (
     DatatablesFilterSet,
 )
+from redis.exceptions import RedisError
 from tqdm import tqdm
 
-from chatbot.collections import (
-    build_index,
-    collection_exists,
-    create_collection,
-    drop_collection,
-    insert_embeddings_into,
-    search_in_collection,
-)
-from chatbot.embeddings import batch_embedding, count_tokens, single_embedding
-from chatbot.models import Chatbot, Question, Realm, Text
+from chatbot import metrics
+from chatbot.backends import SearchFilter, SearchResult, TextAttributes, get_backend
+from chatbot.cache import TwoTierCache, normalize_text
+from chatbot.embeddings import batch_embedding, single_embedding
+from chatbot.models import Chatbot, IndexJob, IndexShard, Question, Realm, Text
+from chatbot.pipeline import Pipeline, Stage, StageStats
 from chatbot.serializers import QuestionSerializer
+from chatbot.singleflight import SingleFlight
+from chatbot.tokenizer import count_tokens, count_tokens_batch, truncate_tokens
+from core.redis import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+# Fields of a text needed to build the context and the response
+TEXT_FIELDS = ("id", "content", "url", "page", "internal", "token_count")
+
+
+def text_cache_key(pk: int) -> str:
+    """Return the cache key of a text, the version changes with TEXT_FIELDS."""
+    return f"chatbot:text:v2:{pk}"
+
+
+def _load_texts(ids: Sequence[int]) -> Dict[int, Text]:
+    """Load texts by id, reading through the cache if TEXT_CACHE_TIMEOUT is set."""
+    if not settings.TEXT_CACHE_TIMEOUT:
+        return {text.pk: text for text in Text.objects.filter(id__in=ids).only(*TEXT_FIELDS)}
+
+    cached = cache.get_many([text_cache_key(pk) for pk in ids])
+    texts = {
+        pk: Text.from_db(DEFAULT_DB_ALIAS, TEXT_FIELDS, values)
+        for pk in ids
+        if (values := cached.get(text_cache_key(pk))) is not None
+    }
+    missing = [pk for pk in ids if pk not in texts]
+    if missing:
+        rows = Text.objects.filter(id__in=missing).values_list(*TEXT_FIELDS)
+        cache.set_many({text_cache_key(row[0]): row for row in rows}, settings.TEXT_CACHE_TIMEOUT)
+        texts.update({row[0]: Text.from_db(DEFAULT_DB_ALIAS, TEXT_FIELDS, row) for row in rows})
+    return texts
+
+
+def hydrate_texts(ids: Sequence[int], distances: Sequence[float]) -> List[Text]:
+    """Return the texts in the order of the search result, each annotated with its distance.
+
+    Ids that no longer exist in the database are skipped.
+    """
+    texts = _load_texts(ids)
+    result = []
+    for pk, distance in zip(ids, distances):
+        if (text := texts.get(pk)) is not None:
+            text.distance = distance
+            result.append(text)
+    return result
 
 
-def get_distance(entry: Tuple[float, Text]) -> float:
-    return entry[0]
+_chatbots: Dict[str, Tuple[float, Chatbot]] = {}
+
+
+async def get_chatbot(slug: str) -> Optional[Chatbot]:
+    """Return the chatbot with its realm, cached in this process for CHATBOT_CACHE_TIMEOUT seconds."""
+    entry = _chatbots.get(slug)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+
+    chatbot = await Chatbot.objects.select_related("realm").filter(slug=slug).afirst()
+    if chatbot is not None and settings.CHATBOT_CACHE_TIMEOUT:
+        _chatbots[slug] = (time.monotonic() + settings.CHATBOT_CACHE_TIMEOUT, chatbot)
+    return chatbot
+
+
+def forget_chatbot(slug: str) -> None:
+    """Remove the chatbot from the cache of this process."""
+    _chatbots.pop(slug, None)
 
 
 async def find_question(question: str, bot: Chatbot) -> Optional[Question]:
@@ -37,6 +113,14 @@ async def find_question(question: str, bot: Chatbot) -> Optional[Question]:
     return query
 
 
+answer_flights = SingleFlight("answer_flight", timeout=settings.ANSWER_FLIGHT_TIMEOUT)
+
+
+def answer_flight_key(question: str, bot: Chatbot) -> str:
+    """Return the key under which identical questions to a bot share one answer while it is generated."""
+    return f"{bot.slug}:{hashlib.sha256(normalize_text(question).encode()).hexdigest()}"
+
+
 async def similair_questions(question: str):
     query = (
         Question.objects.all()
@@ -51,20 +135,35 @@ async def similair_questions(question: str):
     return [question async for question in query]
 
 
+moderation_verdicts = TwoTierCache(
+    "moderation",
+    maxsize=settings.MODERATION_CACHE_SIZE,
+    timeout=settings.MODERATION_CACHE_TIMEOUT,
+)
+
+
 async def is_input_flagged(text: str, bot: Chatbot) -> bool:
+    """Check the text with the moderation endpoint, verdicts are cached by normalized text."""
     if not bot.restricted:
         return False
 
+    key = hashlib.sha256(normalize_text(text).encode()).hexdigest()
+    verdict = await moderation_verdicts.get(key)
+    if verdict is not None:
+        return verdict == b"1"
+
     response = await openai.Moderation.acreate(
         input=text,
         api_key=bot.openai_key,
     )
-    return response["results"][0]["flagged"]
+    flagged = bool(response["results"][0]["flagged"])
+    await moderation_verdicts.set(key, b"1" if flagged else b"0")
+    return flagged
 
 
-async def find_texts(question: str, realm: Realm) -> List[Text]:
-    """Find texts realted to the question."""
-    question_embedding = await single_embedding(
+async def embed_question(question: str, realm: Realm) -> np.ndarray:
+    """Create the embedding of a question with the model of the realm."""
+    return await single_embedding(
         question,
         realm.openai_key,
         realm.embedding_model,
@@ -72,92 +171,459 @@ async def find_texts(question: str, realm: Realm) -> List[Text]:
         realm.openai_org,
     )
 
-    result = search_in_collection(question_embedding, realm.slug, n=20)
 
-    text_ids = result.ids
-    distances = result.distances
+def question_collection(bot: Chatbot, realm: Optional[Realm] = None) -> str:
+    """Return the name of the collection holding the embeddings of the questions asked to the bot."""
+    return f"{bot.slug}_questions{(realm or bot.realm).collection_suffix}"
 
-    texts: List[Text] = await sync_to_async(
-        lambda: [
-            text
-            for _, text in sorted(
-                zip(
-                    distances,
-                    Text.objects.filter(id__in=text_ids),
-                ),
-                key=get_distance,
+
+async def find_similar_question(embedding: Optional[np.ndarray], bot: Chatbot) -> Optional[Question]:
+    """Find an approved or frequently asked question within the answer cache distance of the bot."""
+    if not bot.answer_cache_distance or embedding is None:
+        return None
+
+    backend = get_backend(bot.realm)
+    name = question_collection(bot)
+
+    def search() -> Optional[SearchResult]:
+        # The existence check is an RPC too, so it runs in the thread with the search
+        return backend.search(name, embedding, n=5) if backend.exists(name) else None
+
+    result = await sync_to_async(search, thread_sensitive=False)()
+    if result is None:
+        metrics.incr("answer_cache.miss")
+        return None
+
+    candidates = [pk for pk, distance in zip(result.ids, result.distances) if distance <= bot.answer_cache_distance]
+
+    if candidates:
+        questions = {
+            question.pk: question
+            async for question in Question.objects.filter(pk__in=candidates, bot=bot).filter(
+                Q(approved=True) | Q(count__gte=settings.ANSWER_CACHE_MIN_COUNT)
             )
-        ]
-    )()
+        }
+        for pk in candidates:
+            if pk in questions:
+                metrics.incr("answer_cache.hit")
+                return questions[pk]
+
+    metrics.incr("answer_cache.miss")
+    return None
+
+
+def search_filter(bot: Chatbot) -> Optional[SearchFilter]:
+    """Return the filter of the texts the bot may use as context, None if it may use all."""
+    urls = tuple(url.strip() for url in bot.excluded_sources.splitlines() if url.strip())
+    return SearchFilter(exclude_urls=urls) if urls else None
+
+
+async def find_texts(
+    question: str, realm: Realm, embedding: Optional[np.ndarray] = None, where: Optional[SearchFilter] = None
+) -> List[Text]:
+    """Find texts realted to the question, closest first and with their distance in ``text.distance``.
+
+    Backends that can't filter the search fetch more texts, which are filtered here.
+    """
+    if embedding is None:
+        embedding = await embed_question(question, realm)
 
+    backend = get_backend(realm)
+    n = 20
+    post_filter = where if where and not backend.supports_filters else None
+    result = await sync_to_async(backend.search, thread_sensitive=False)(
+        realm.collection, embedding, n=n * settings.SEARCH_OVERFETCH if post_filter else n, where=where
+    )
+
+    texts = await sync_to_async(hydrate_texts)(result.ids, result.distances)
+    if post_filter:
+        texts = [text for text in texts if post_filter.matches(text)][:n]
     return texts
 
 
-def _format_context(texts: List[Text], max_tokens: int) -> str:
-    result = ""
+def _snippet_overhead(text: Text) -> int:
+    """Return an upper bound of the tokens around the content of a text in the context."""
+    # "[", "] " and the newline, every digit of the id counted as a token of its own
+    return 3 + len(str(text.id))
+
+
+def _format_context(texts: List[Text], max_tokens: int, truncate: bool = False, model: Optional[str] = None) -> str:
+    """Join the texts that fit into max_tokens, adding up their stored token counts."""
+    parts = []
+    used = 0
 
     for text in texts:
-        context = f"[{text.id}] {text.content}\n"
+        overhead = _snippet_overhead(text)
+        tokens = text.token_count if text.token_count is not None else count_tokens(text.content, model, memoize=False)
 
-        if count_tokens(result + context) > max_tokens:
-            return result
+        if used + overhead + tokens > max_tokens:
+            remaining = max_tokens - used - overhead
+            if truncate and remaining > 0:
+                parts.append(f"[{text.id}] {truncate_tokens(text.content, remaining, model)}\n")
+            break
 
-        result += context
+        parts.append(f"[{text.id}] {text.content}\n")
+        used += overhead + tokens
 
-    return result
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=1024)
+def count_template_tokens(template: str, model: str) -> int:
+    """Count the tokens of a prompt template, which only change when the bot is edited."""
+    return count_tokens(template, model, memoize=False)
 
 
 def generate_prompt_context(question: str, texts: List[Text], chatbot: Chatbot) -> str:
     """Generate an answer to the question using the texts and the configuration of the chatbot."""
-    prompt_length = count_tokens(chatbot.prompt_template) + count_tokens(question)
+    prompt_length = count_template_tokens(chatbot.prompt_template, chatbot.model)
+    prompt_length += count_tokens(question, chatbot.model)
 
     return _format_context(
-        texts, chatbot.model_max_tokens - prompt_length - chatbot.max_tokens
+        texts, chatbot.model_max_tokens - prompt_length - chatbot.max_tokens, chatbot.truncate_context, chatbot.model
     )
 
 
-def index_realm(slug: str, batch_size: int = 10_000, monitor: bool = False) -> None:
-    """Create embedding for each text in the realm and add it to the milvus index."""
-    realm = Realm.objects.get(slug=slug)
-
-    texts = Text.objects.filter(realm=realm, indexed=False)
-
-    if not collection_exists(realm.slug):
-        create_collection(realm.slug, realm.embedding_dim)
-
-    ids, contents = [], []
-
-    for text in tqdm(texts.iterator(), total=texts.count()):
-        ids.append(text.pk)
-        contents.append(text.content)
-        if len(ids) < batch_size:
-            continue
+def count_missing_tokens(texts: "QuerySet[Text]", batch_size: int = 1000) -> None:
+    """Store the token count of texts that were imported or indexed without one, a page of texts at a time."""
+    missing = texts.filter(token_count__isnull=True).only("id", "content").order_by("pk")
+    last_id = 0
+    while batch := list(missing.filter(pk__gt=last_id)[:batch_size]):
+        _store_token_counts(batch)
+        last_id = batch[-1].pk
+
+
+def _store_token_counts(texts: List[Text]) -> None:
+    for text, count in zip(texts, count_tokens_batch([text.content for text in texts], memoize=False)):
+        text.token_count = count
+    Text.objects.bulk_update(texts, ["token_count"])
+
+
+ACTIVE_JOB_STATUSES = (IndexJob.Status.RUNNING, IndexJob.Status.BUILDING)
+
+
+class IndexBatch(NamedTuple):
+    """Texts on their way through the indexing pipeline."""
+
+    ids: List[int]
+    contents: List[str]
+    attributes: List[TextAttributes]
+    embeddings: Optional[np.ndarray] = None
+    # Position of the batch in the order of ids
+    seq: int = 0
+
+
+def _read_batches(texts: "QuerySet[Text]", batch_size: int) -> Iterator[IndexBatch]:
+    """Read the texts in batches, ordered by id."""
+    batch = IndexBatch([], [], [])
+    rows = texts.order_by("id").values_list("id", "content", "internal", "url", "page").iterator()
+    for pk, content, internal, url, page in tqdm(rows, total=texts.count()):
+        batch.ids.append(pk)
+        batch.contents.append(content)
+        batch.attributes.append(TextAttributes(internal, url, page))
+        if len(batch.ids) >= batch_size:
+            yield batch
+            batch = IndexBatch([], [], [], seq=batch.seq + 1)
+    if batch.ids:
+        yield batch
+
+
+@contextlib.contextmanager
+def _heartbeat(job_id: int) -> Iterator[None]:
+    """Update the job every INDEX_JOB_HEARTBEAT seconds while the block runs, so it isn't taken over."""
+    stop = threading.Event()
+
+    def beat() -> None:
+        try:
+            while not stop.wait(settings.INDEX_JOB_HEARTBEAT):
+                IndexJob.objects.filter(pk=job_id).update(updated_at=timezone.now())
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"index-job-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def active_index_jobs(realm: Realm) -> "QuerySet[IndexJob]":
+    """Return the running jobs of the realm, after failing those without a heartbeat for INDEX_JOB_TIMEOUT seconds."""
+    now = timezone.now()
+    IndexJob.objects.filter(
+        realm=realm, status__in=ACTIVE_JOB_STATUSES, updated_at__lt=now - timedelta(seconds=settings.INDEX_JOB_TIMEOUT)
+    ).update(status=IndexJob.Status.FAILED, error="Taken over after the job stopped sending heartbeats", updated_at=now)
+    return IndexJob.objects.filter(realm=realm, status__in=ACTIVE_JOB_STATUSES)
+
+
+def reconcile_texts(realm: Realm, texts: "QuerySet[Text]", batch_size: int = 1000) -> Tuple[int, int]:
+    """Make the indexed flag of the texts agree with the entries in the vector backend.
+
+    Texts with an entry are marked as indexed, so they aren't embedded again, texts marked
+    as indexed without one are unmarked. Returns the number of texts marked and unmarked.
+    """
+    backend = get_backend(realm)
+    marked = unmarked = 0
+    rows = texts.order_by("id").values_list("id", "indexed").iterator(chunk_size=batch_size)
+    while chunk := list(itertools.islice(rows, batch_size)):
+        existing = backend.existing_ids(realm.collection, [pk for pk, _ in chunk])
+        missing = [pk for pk, indexed in chunk if indexed and pk not in existing]
+        found = [pk for pk, indexed in chunk if not indexed and pk in existing]
+        unmarked += Text.objects.filter(id__in=missing).update(indexed=False)
+        marked += Text.objects.filter(id__in=found).update(indexed=True)
+    return marked, unmarked
+
+
+def _index_texts(
+    realm: Realm, texts: "QuerySet[Text]", batch_size: int, concurrency: Optional[int] = None,
+    monitor: bool = False, job: Optional[IndexJob] = None, mark: bool = True
+) -> List[StageStats]:
+    """Embed the texts, upsert them into the vector backend and mark them as indexed.
+
+    Reading, embedding, inserting and marking texts as indexed run as a pipeline. Up to
+    concurrency batches (INDEX_EMBEDDING_CONCURRENCY by default) are embedded at the same
+    time, requests over the rate limit of the key are retried with backoff. Entries already
+    in the backend are replaced, so indexing the same texts can be repeated. The progress
+    is checkpointed to the job after every batch. Without mark, the indexed flags are left
+    alone, e.g. for a collection that isn't searched yet.
+    """
+    backend = get_backend(realm)
+
+    def embed(batch: IndexBatch) -> IndexBatch:
         if monitor:
-            print(contents[-1])
+            print(batch.contents[-1])
         embeddings = batch_embedding(
-            contents,
+            batch.contents,
             realm.openai_key,
             realm.embedding_model,
             realm.slug,
             realm.openai_org,
         )
-        insert_embeddings_into(ids, embeddings, realm.slug)
-        Text.objects.filter(id__in=ids).update(indexed=True)
-        ids, contents = [], []
+        return batch._replace(embeddings=embeddings)
+
+    def insert(batch: IndexBatch) -> IndexBatch:
+        assert batch.embeddings is not None
+        backend.upsert(realm.collection, batch.ids, list(batch.embeddings), batch.attributes)
+        return batch
+
+    # Batches finish out of order, the checkpoint only moves past batches whose predecessors are all marked
+    finished: Dict[int, int] = {}
+    next_seq = 0
+
+    def mark_indexed(batch: IndexBatch) -> None:
+        nonlocal next_seq
+        finished[batch.seq] = max(batch.ids)
+        checkpoint = None
+        while next_seq in finished:
+            checkpoint = finished.pop(next_seq)
+            next_seq += 1
+
+        with transaction.atomic():
+            Text.objects.filter(id__in=batch.ids).update(indexed=True)
+            if job is not None:
+                progress = {"indexed_count": F("indexed_count") + len(batch.ids), "updated_at": timezone.now()}
+                if checkpoint is not None:
+                    progress["checkpoint_id"] = Greatest(Coalesce("checkpoint_id", 0), checkpoint)
+                IndexJob.objects.filter(pk=job.pk).update(**progress)
+
+    stages = [
+        Stage("embed", embed, workers=concurrency or settings.INDEX_EMBEDDING_CONCURRENCY),
+        Stage("insert", insert),
+    ]
+    if mark:
+        stages.append(Stage("mark", mark_indexed))
+    pipeline = Pipeline(
+        stages,
+        queue_size=settings.INDEX_QUEUE_SIZE,
+        size=lambda batch: len(batch.ids),
+    )
+    return pipeline.run(_read_batches(texts, batch_size))
+
+
+def index_realm(
+    slug: str, batch_size: int = 1000, monitor: bool = False, concurrency: Optional[int] = None,
+    rebuild: bool = False
+) -> List[StageStats]:
+    """Create embedding for each text in the realm and add it to the vector backend.
+
+    The run is recorded as an index job. An interrupted run is resumed by running it again,
+    texts of the job past its checkpoint that reached the backend before the interruption are
+    reconciled instead of being embedded again. A job left running by a killed process is
+    taken over once it stopped sending heartbeats for INDEX_JOB_TIMEOUT seconds. The index
+    of the backend is only rebuilt from scratch with rebuild or when the backend considers
+    it necessary.
+    """
+    realm = Realm.objects.get(slug=slug)
+    backend = get_backend(realm)
+    job, resumed = _resume_index_job(realm)
+
+    with _heartbeat(job.pk):
+        if not backend.exists(realm.collection):
+            backend.create(realm.collection, realm.embedding_dim)
+
+        marked = 0
+        if resumed:
+            pending = Text.objects.filter(realm=realm, id__gt=job.checkpoint_id or 0)
+            if job.last_id is not None:
+                pending = pending.filter(id__lte=job.last_id)
+            marked, unmarked = reconcile_texts(realm, pending, batch_size)
+            print(f"Reconciled {marked} texts already in the index and {unmarked} texts missing from it.")
+
+        # Texts indexed before token counts were stored get them here too
+        count_missing_tokens(Text.objects.filter(realm=realm), batch_size)
+        texts = Text.objects.filter(realm=realm, indexed=False)
+        IndexJob.objects.filter(pk=job.pk).update(
+            indexed_count=F("indexed_count") + marked,
+            text_count=F("indexed_count") + marked + texts.count(),
+        )
 
-    if len(ids) > 0:
-        embeddings = batch_embedding(
-            contents,
-            realm.openai_key,
-            realm.embedding_model,
-            realm.slug,
-            realm.openai_org,
+        try:
+            stats = _index_texts(realm, texts, batch_size, concurrency, monitor, job)
+        except BaseException as e:
+            IndexJob.objects.filter(pk=job.pk).update(
+                status=IndexJob.Status.FAILED, error=str(e) or repr(e), updated_at=timezone.now()
+            )
+            raise
+        for stage in stats:
+            print(stage)
+
+        print("Building index.")
+        IndexJob.objects.filter(pk=job.pk).update(status=IndexJob.Status.BUILDING, updated_at=timezone.now())
+        backend.build_index(realm.collection, force=rebuild)
+    IndexJob.objects.filter(pk=job.pk).update(
+        status=IndexJob.Status.DONE, finished_at=timezone.now(), updated_at=timezone.now()
+    )
+    return stats
+
+
+def _resume_index_job(realm: Realm) -> Tuple[IndexJob, bool]:
+    """Return the unfinished job of an earlier run in a single process, or start a new one, and whether it resumed."""
+    if active_index_jobs(realm).exists():
+        raise ValueError(f"Realm {realm.slug} is already being indexed.")
+
+    job = (
+        IndexJob.objects.filter(realm=realm, distributed=False)
+        .exclude(status=IndexJob.Status.DONE)
+        .order_by("-created_at")
+        .first()
+    )
+    if job is None:
+        last_id = Text.objects.filter(realm=realm).aggregate(last_id=Max("id"))["last_id"]
+        return IndexJob.objects.create(realm=realm, last_id=last_id), False
+    IndexJob.objects.filter(pk=job.pk).update(status=IndexJob.Status.RUNNING, error="", updated_at=timezone.now())
+    return job, True
+
+
+def _split_ids(texts: "QuerySet[Text]", shard_size: int) -> Iterator[Tuple[int, int, int]]:
+    """Split the texts into ranges of ids holding shard_size texts, returning first id, last id and count."""
+    first, last, count = None, None, 0
+    for pk in texts.order_by("id").values_list("id", flat=True).iterator(chunk_size=10_000):
+        if first is None:
+            first = pk
+        last, count = pk, count + 1
+        if count >= shard_size:
+            yield first, last, count
+            first, count = None, 0
+    if first is not None and last is not None:
+        yield first, last, count
+
+
+def create_index_job(slug: str, shard_size: Optional[int] = None) -> IndexJob:
+    """Split the un-indexed texts of the realm into shards for distributed indexing."""
+    realm = Realm.objects.get(slug=slug)
+    if active_index_jobs(realm).exists():
+        raise ValueError(f"Realm {slug} is already being indexed.")
+
+    backend = get_backend(realm)
+    if not backend.exists(realm.collection):
+        backend.create(realm.collection, realm.embedding_dim)
+
+    texts = Text.objects.filter(realm=realm, indexed=False)
+    with transaction.atomic():
+        last_id = Text.objects.filter(realm=realm).aggregate(last_id=Max("id"))["last_id"]
+        job = IndexJob.objects.create(realm=realm, distributed=True, last_id=last_id)
+        shards = [
+            IndexShard(job=job, first_id=first, last_id=last, text_count=count)
+            for first, last, count in _split_ids(texts, shard_size or settings.INDEX_SHARD_SIZE)
+        ]
+        IndexShard.objects.bulk_create(shards)
+        job.shard_count = len(shards)
+        job.text_count = sum(shard.text_count for shard in shards)
+        if not shards:
+            job.status = IndexJob.Status.BUILDING
+        job.save()
+    return job
+
+
+def run_index_shard(shard_id: int) -> bool:
+    """Index the texts of the shard, return whether it was the last shard of its job to finish.
+
+    Texts indexed or inserted by an earlier attempt are skipped and entries are upserted,
+    so a shard can be retried or delivered twice.
+    """
+    shard = IndexShard.objects.select_related("job__realm").get(pk=shard_id)
+    if shard.status == IndexShard.Status.DONE or shard.job.status != IndexJob.Status.RUNNING:
+        return False
+    IndexShard.objects.filter(pk=shard.pk).update(attempts=F("attempts") + 1)
+
+    realm = shard.job.realm
+    texts = Text.objects.filter(realm=realm, indexed=False, id__range=(shard.first_id, shard.last_id))
+    with _heartbeat(shard.job_id):
+        if shard.attempts:
+            reconcile_texts(realm, texts, settings.INDEX_SHARD_BATCH_SIZE)
+        count_missing_tokens(Text.objects.filter(realm=realm, id__range=(shard.first_id, shard.last_id)))
+        _index_texts(realm, texts, settings.INDEX_SHARD_BATCH_SIZE)
+
+    with transaction.atomic():
+        if not IndexShard.objects.filter(pk=shard.pk).exclude(status=IndexShard.Status.DONE).update(
+            status=IndexShard.Status.DONE, error=""
+        ):
+            return False
+        IndexJob.objects.filter(pk=shard.job_id).update(
+            finished_shards=F("finished_shards") + 1,
+            indexed_count=F("indexed_count") + shard.text_count,
+            updated_at=timezone.now(),
+        )
+    return bool(
+        IndexJob.objects.filter(
+            pk=shard.job_id, status=IndexJob.Status.RUNNING, finished_shards=F("shard_count")
+        ).update(status=IndexJob.Status.BUILDING, updated_at=timezone.now())
+    )
+
+
+def fail_index_shard(shard_id: int, error: BaseException) -> None:
+    """Mark the shard and its job as failed after the last attempt."""
+    shard = IndexShard.objects.get(pk=shard_id)
+    IndexShard.objects.filter(pk=shard_id).update(status=IndexShard.Status.FAILED, error=str(error))
+    IndexJob.objects.filter(pk=shard.job_id, status=IndexJob.Status.RUNNING).update(
+        status=IndexJob.Status.FAILED, error=f"Shard {shard}: {error}", updated_at=timezone.now()
+    )
+
+
+def retry_index_job(job: IndexJob) -> List[int]:
+    """Set the failed shards of the job pending again and return the ids of all shards that aren't done.
+
+    Shards that ran while the job had failed were skipped and are still pending, they are queued again too.
+    """
+    with transaction.atomic():
+        shard_ids = list(job.shards.exclude(status=IndexShard.Status.DONE).values_list("id", flat=True))
+        IndexShard.objects.filter(id__in=shard_ids, status=IndexShard.Status.FAILED).update(
+            status=IndexShard.Status.PENDING, error=""
         )
-        insert_embeddings_into(ids, embeddings, realm.slug)
-        Text.objects.filter(id__in=ids).update(indexed=True)
+        IndexJob.objects.filter(pk=job.pk).update(status=IndexJob.Status.RUNNING, error="", updated_at=timezone.now())
+    return shard_ids
 
-    print("Building index.")
-    build_index(realm.slug)
+
+def finish_index_job(job_id: int) -> None:
+    """Build the index of the realm once all shards of the job are done."""
+    job = IndexJob.objects.select_related("realm").get(pk=job_id)
+    with _heartbeat(job_id):
+        get_backend(job.realm).build_index(job.realm.collection)
+    IndexJob.objects.filter(pk=job_id).update(
+        status=IndexJob.Status.DONE, finished_at=timezone.now(), updated_at=timezone.now()
+    )
 
 
 def reset_index(slug: str) -> None:
@@ -165,18 +631,239 @@ def reset_index(slug: str) -> None:
     realm = Realm.objects.get(slug=slug)
     Text.objects.filter(realm=realm).update(indexed=False)
 
-    drop_collection(realm.slug)
+    get_backend(realm).drop(realm.collection)
+
+
+def _sync_key(realm_id: int) -> str:
+    return f"text_sync:{realm_id}"
+
+
+def queue_text_sync(realm_id: int, text_id: int) -> None:
+    """Queue a changed or deleted text to be synced into the vector index by a worker.
+
+    Changes are collected for TEXT_SYNC_DELAY seconds, so a series of edits is embedded
+    in one batch. Without Redis every text is synced by a task of its own.
+    """
+    from chatbot.tasks import sync_realm_texts
+
+    if not settings.REDIS_URL:
+        sync_realm_texts.delay(realm_id, [text_id])
+        return
+
+    key = _sync_key(realm_id)
+    try:
+        client = get_sync_redis()
+        client.sadd(key, text_id)
+        scheduled = client.set(f"{key}:scheduled", 1, nx=True, ex=settings.TEXT_SYNC_DELAY * 10)
+    except RedisError:
+        logger.exception("Couldn't queue text %s to be synced", text_id)
+        return
+    if scheduled:
+        try:
+            sync_realm_texts.apply_async((realm_id, ), countdown=settings.TEXT_SYNC_DELAY)
+        except Exception:
+            # The text stays queued, the next change schedules the task again
+            client.delete(f"{key}:scheduled")
+            raise
+
+
+def sync_queued_texts(realm_id: int) -> None:
+    """Sync the texts queued for the realm in batches, putting a failed batch back into the queue."""
+    client = get_sync_redis()
+    key = _sync_key(realm_id)
+    # Texts changed from now on schedule another task
+    client.delete(f"{key}:scheduled")
+    while ids := client.spop(key, settings.TEXT_SYNC_BATCH_SIZE):
+        try:
+            sync_texts(realm_id, [int(pk) for pk in ids])
+        except Realm.DoesNotExist:
+            client.delete(key)
+            raise
+        except Exception:
+            client.sadd(key, *ids)
+            raise
+
+
+def sync_texts(realm_id: int, ids: List[int]) -> None:
+    """Upsert the texts that still exist into the index of the realm and delete the others from it.
+
+    Texts of realms that were never indexed are left to index_realm. While the realm is
+    migrated to another model, the new collection is synced first.
+    """
+    realm = Realm.objects.get(pk=realm_id)
+    backend = get_backend(realm)
+    if not backend.exists(realm.collection):
+        return
+
+    texts = Text.objects.filter(realm=realm, id__in=ids)
+    deleted = set(ids) - set(texts.values_list("id", flat=True))
+    count_missing_tokens(texts)
+
+    pending = _pending_realm(realm)
+    for target in [realm] if pending is None else [pending, realm]:
+        if deleted:
+            backend.delete(target.collection, sorted(deleted))
+        _index_texts(target, texts, settings.TEXT_SYNC_BATCH_SIZE, concurrency=1, mark=target is realm)
+
+
+def _with_model(realm: Realm, embedding_model: str, embedding_dim: int, collection_suffix: str) -> Realm:
+    """Return a copy of the realm embedding its texts with another model into another collection."""
+    shadow = copy.copy(realm)
+    shadow.embedding_model = embedding_model
+    shadow.embedding_dim = embedding_dim
+    shadow.collection_suffix = collection_suffix
+    return shadow
+
+
+def _pending_realm(realm: Realm) -> Optional[Realm]:
+    """Return the realm with the model and collection it is being migrated to, if it is."""
+    if not realm.pending_collection_suffix or realm.pending_embedding_dim is None:
+        return None
+    return _with_model(
+        realm, realm.pending_embedding_model, realm.pending_embedding_dim, realm.pending_collection_suffix
+    )
+
+
+def migrate_realm_model(
+    slug: str, embedding_model: str, embedding_dim: int, batch_size: int = 1000, concurrency: Optional[int] = None
+) -> List[str]:
+    """Re-embed the realm with another model without interrupting its chatbots, return the replaced collections.
+
+    The texts and the answer caches of the chatbots are embedded into new collections while
+    the realm keeps searching the current ones. Texts added meanwhile are caught up, texts
+    edited or deleted meanwhile are synced into both collections. Then the new collection
+    is validated by searching a sample of texts for themselves. Finally the realm is
+    switched to the new model and collections in one transaction. The replaced collections
+    are still needed by workers that cached the realm and have to be dropped later.
+    """
+    realm = Realm.objects.get(slug=slug)
+    if active_index_jobs(realm).exists():
+        raise ValueError(f"Realm {slug} is being indexed.")
+
+    suffix = "_" + re.sub(r"[^0-9a-zA-Z_]", "_", f"{embedding_model}_{int(time.time())}")
+    shadow = _with_model(realm, embedding_model, embedding_dim, suffix)
+    backend = get_backend(realm)
+    backend.create(shadow.collection, embedding_dim)
+    Realm.objects.filter(pk=realm.pk).update(
+        pending_embedding_model=embedding_model, pending_embedding_dim=embedding_dim, pending_collection_suffix=suffix
+    )
+
+    texts = Text.objects.filter(realm=realm)
+    try:
+        indexed_id = 0
+        while (last_id := texts.order_by("-id").values_list("id", flat=True).first() or 0) > indexed_id:
+            pending = texts.filter(id__gt=indexed_id, id__lte=last_id)
+            for stage in _index_texts(shadow, pending, batch_size, concurrency, mark=False):
+                print(stage)
+            indexed_id = last_id
+        backend.build_index(shadow.collection)
+        _validate_collection(shadow, texts.filter(id__lte=indexed_id))
+
+        bots = list(Chatbot.objects.filter(realm=realm).exclude(answer_cache_distance=0))
+        for bot in bots:
+            index_questions(bot.slug, batch_size, shadow)
+    except BaseException:
+        Realm.objects.filter(pk=realm.pk).update(
+            pending_embedding_model="", pending_embedding_dim=None, pending_collection_suffix=""
+        )
+        # The new collections aren't searched by anything, drop them
+        bots = list(Chatbot.objects.filter(realm=realm))
+        for name in [shadow.collection, *(question_collection(bot, shadow) for bot in bots)]:
+            if backend.exists(name):
+                backend.drop(name)
+        raise
+
+    with transaction.atomic():
+        Realm.objects.filter(pk=realm.pk).update(
+            embedding_model=embedding_model,
+            embedding_dim=embedding_dim,
+            collection_suffix=shadow.collection_suffix,
+            pending_embedding_model="",
+            pending_embedding_dim=None,
+            pending_collection_suffix="",
+        )
+        texts.filter(id__lte=indexed_id).update(indexed=True)
+        texts.filter(id__gt=indexed_id).update(indexed=False)
+    for bot in Chatbot.objects.filter(realm=realm):
+        forget_chatbot(bot.slug)
+
+    replaced = [realm.collection, *(question_collection(bot, realm) for bot in bots)]
+    return [name for name in replaced if backend.exists(name)]
+
+
+def _validate_collection(realm: Realm, texts: "QuerySet[Text]", sample_size: int = 5) -> None:
+    """Check the collection holds all texts and finds a random sample of them by their own content."""
+    backend = get_backend(realm)
+    count, expected = backend.count(realm.collection), texts.count()
+    if count < expected:
+        raise ValueError(f"Collection {realm.collection} holds {count} of {expected} texts.")
+
+    sample = list(texts.order_by("?").values_list("id", "content")[:sample_size])
+    if not sample:
+        return
+    ids, contents = zip(*sample)
+    embeddings = batch_embedding(list(contents), realm.openai_key, realm.embedding_model, realm.slug,
+                                 realm.openai_org)
+    for pk, embedding in zip(ids, embeddings):
+        if pk not in backend.search(realm.collection, embedding, n=5).ids:
+            raise ValueError(f"Collection {realm.collection} doesn't find text {pk} by its content.")
+
+
+def index_question(question: Question, embedding: np.ndarray, bot: Chatbot) -> None:
+    """Add the embedding of a question to the answer cache of the bot."""
+    backend = get_backend(bot.realm)
+    name = question_collection(bot)
+    if not backend.exists(name):
+        backend.create(name, bot.realm.embedding_dim)
+        backend.build_index(name)
+    backend.insert(name, [question.pk], [embedding])
 
 
 async def store_question(
-    question: str, answer: str, prompt: str, texts: List[Text], chatbot: Chatbot
-) -> None:
-    """Create a new question in the database."""
+    question: str,
+    answer: str,
+    prompt: str,
+    texts: List[Text],
+    chatbot: Chatbot,
+    embedding: Optional[np.ndarray] = None,
+) -> Question:
+    """Create a new question in the database, with its embedding for the answer cache if given."""
     question_obj = await Question.objects.acreate(
         question=question, answer=answer, bot=chatbot, prompt=prompt
     )
     await sync_to_async(question_obj.context.set)(texts)
 
+    if embedding is not None and chatbot.answer_cache_distance:
+        await sync_to_async(index_question, thread_sensitive=False)(question_obj, embedding, chatbot)
+
+    return question_obj
+
+
+def index_questions(slug: str, batch_size: int = 1000, realm: Optional[Realm] = None) -> None:
+    """Add the embeddings of all questions asked to the bot to its answer cache, optionally for another realm."""
+    bot = Chatbot.objects.select_related("realm").get(slug=slug)
+    realm = realm or bot.realm
+    backend = get_backend(realm)
+    name = question_collection(bot, realm)
+
+    if backend.exists(name):
+        backend.drop(name)
+    backend.create(name, realm.embedding_dim)
+
+    questions = Question.objects.filter(bot=bot).order_by("pk").values_list("pk", "question")
+    for start in tqdm(range(0, questions.count(), batch_size)):
+        ids, texts = zip(*questions[start:start + batch_size])
+        embeddings = batch_embedding(
+            list(texts),
+            realm.openai_key,
+            realm.embedding_model,
+            realm.slug,
+            realm.openai_org,
+        )
+        backend.insert(name, ids, list(embeddings))
+
+    backend.build_index(name)
+
 
 class GlobalCharFilter(GlobalFilter, filters.CharFilter):
     pass
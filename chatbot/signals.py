@@ -0,0 +1,112 @@
+"""Signal handlers keeping derived data of texts and chatbots up to date."""
+import logging
+from typing import Any
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from chatbot.backends import get_backend
+from chatbot.embeddings import content_hash
+from chatbot.models import Chatbot, Realm, Text
+from chatbot.services import forget_chatbot, queue_text_sync, text_cache_key
+from chatbot.tokenizer import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(pre_save, sender=Text)
+def count_text_tokens(sender: Any, instance: Text, update_fields: Any = None, **kwargs: Any) -> None:
+    """Count the tokens and hash the content of a text saved on its own, e.g. in the admin."""
+    if update_fields is None:
+        instance.token_count = count_tokens(instance.content, memoize=False)
+        instance.content_hash = content_hash(instance.content)
+
+
+def invalidate_cached_text(sender: Any, instance: Text, **kwargs: Any) -> None:
+    """Remove a changed or deleted text from the cache of search results."""
+    cache.delete(text_cache_key(instance.pk))
+
+
+def connect_text_cache(enabled: bool) -> None:
+    """Invalidate cached texts only while the cache is enabled, a post_delete receiver turns off fast deletes."""
+    for signal in (post_save, post_delete):
+        if enabled:
+            signal.connect(invalidate_cached_text, sender=Text, dispatch_uid="invalidate_cached_text")
+        else:
+            signal.disconnect(sender=Text, dispatch_uid="invalidate_cached_text")
+
+
+connect_text_cache(bool(settings.TEXT_CACHE_TIMEOUT))
+
+
+# Fields saved on their own by indexing, which don't change the entry in the index
+INDEX_FIELDS = {"indexed", "token_count"}
+
+
+def sync_text_index(sender: Any, instance: Text, update_fields: Any = None, origin: Any = None, **kwargs: Any) -> None:
+    """Queue an edited or deleted text to be updated in the vector index after the transaction.
+
+    Texts deleted together with their realm aren't synced, its collection is dropped instead.
+    """
+    if update_fields is not None and set(update_fields) <= INDEX_FIELDS:
+        return
+    if isinstance(origin, Realm) or getattr(origin, "model", None) is Realm:
+        return
+    # The primary key of a deleted instance is unset before the transaction commits
+    realm_id, pk = instance.realm_id, instance.pk
+    transaction.on_commit(lambda: _queue_text_sync(realm_id, pk))
+
+
+def _queue_text_sync(realm_id: int, pk: int) -> None:
+    """Queue the text after the commit, which can't be undone by an error of the broker anymore."""
+    try:
+        queue_text_sync(realm_id, pk)
+    except Exception:
+        logger.exception("Couldn't queue text %s to be synced", pk)
+
+
+def connect_text_sync(enabled: bool) -> None:
+    """Sync changed texts only while TEXT_SYNC is on, a post_delete receiver turns off fast deletes."""
+    for signal in (post_save, post_delete):
+        if enabled:
+            signal.connect(sync_text_index, sender=Text, dispatch_uid="sync_text_index")
+        else:
+            signal.disconnect(sender=Text, dispatch_uid="sync_text_index")
+
+
+connect_text_sync(settings.TEXT_SYNC)
+
+
+@receiver(setting_changed)
+def text_setting_changed(setting: str, value: Any, **kwargs: Any) -> None:
+    """Follow changes of TEXT_CACHE_TIMEOUT and TEXT_SYNC, e.g. in tests."""
+    if setting == "TEXT_CACHE_TIMEOUT":
+        connect_text_cache(bool(value))
+    elif setting == "TEXT_SYNC":
+        connect_text_sync(bool(value))
+
+
+@receiver(post_delete, sender=Realm)
+def drop_realm_collection(sender: Any, instance: Realm, **kwargs: Any) -> None:
+    """Drop the collection of a deleted realm after the transaction."""
+
+    def drop() -> None:
+        backend = get_backend(instance)
+        try:
+            if backend.exists(instance.collection):
+                backend.drop(instance.collection)
+        except Exception:
+            logger.exception("Couldn't drop the collection of the deleted realm %s", instance.slug)
+
+    transaction.on_commit(drop)
+
+
+@receiver(post_save, sender=Chatbot)
+@receiver(post_delete, sender=Chatbot)
+def invalidate_cached_chatbot(sender: Any, instance: Chatbot, **kwargs: Any) -> None:
+    """Remove a changed chatbot from the cache of this process, other workers see it after the timeout."""
+    forget_chatbot(instance.slug)
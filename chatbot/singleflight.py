@@ -0,0 +1,173 @@
+"""Coalescing of identical requests, within a process and across workers.
+
+The first request for a key becomes the leader and takes a lock in Redis. Requests
+for the same key, in this process or in other workers, wait for the leader to
+publish its result instead of doing the same work again.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, NamedTuple, Optional
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from chatbot import metrics
+from chatbot.cache import REDIS_BACKOFF
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Deletes the lock only if it is still held by the leader that took it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Flight(NamedTuple):
+    """A request joined to the work for a key."""
+
+    key: str
+    # Result of the leader, None if this request has to do the work itself
+    result: Optional[bytes]
+    leader: bool = False
+    token: Optional[str] = None
+    future: Optional[asyncio.Future] = None
+
+
+class SingleFlight:
+    """Let one request per key do the work and hand its result to the others.
+
+    ``join`` returns a flight with the result of the leader, or without a result if the
+    caller has to do the work itself. A leader must call ``done`` with its result, or
+    None if it failed; a leader that never does is given up after timeout seconds. Followers
+    stop waiting after timeout seconds, which is also how long the lock of a crashed leader
+    lives. Followers in this process of a leader in another one share a single subscription.
+    Counters ``<namespace>.lead``, ``<namespace>.follow``
+    and ``<namespace>.fallback`` are kept in :mod:`chatbot.metrics`.
+    """
+
+    def __init__(self, namespace: str, timeout: int) -> None:
+        """Create a group of flights whose followers wait at most timeout seconds."""
+        self.namespace = namespace
+        self.timeout = timeout
+        self._leading: Dict[str, asyncio.Future] = {}
+        self._following: Dict[str, asyncio.Future] = {}
+        self._redis_down_until = 0.0
+
+    def _redis_available(self) -> bool:
+        return bool(settings.REDIS_URL) and time.monotonic() >= self._redis_down_until
+
+    def _redis_failed(self, error: Exception) -> None:
+        logger.warning("Redis unavailable for single flight %s: %s", self.namespace, error)
+        self._redis_down_until = time.monotonic() + REDIS_BACKOFF
+
+    def _lead(self, key: str, token: Optional[str] = None) -> Flight:
+        metrics.incr(f"{self.namespace}.lead")
+        loop = asyncio.get_running_loop()
+        future = self._leading[key] = loop.create_future()
+        loop.call_later(self.timeout, self._expire, key, future)
+        return Flight(key, None, leader=True, token=token, future=future)
+
+    def _expire(self, key: str, future: asyncio.Future) -> None:
+        """Give up on a leader that never called done, so later requests don't wait for it."""
+        if not future.done():
+            future.set_result(None)
+        if self._leading.get(key) is future:
+            del self._leading[key]
+
+    async def join(self, key: str) -> Flight:
+        """Wait for the result of the leader of key, or become the leader."""
+        if not self.timeout:
+            return Flight(key, None)
+
+        future = self._leading.get(key)
+        if future is not None:
+            metrics.incr(f"{self.namespace}.follow")
+            try:
+                value = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                value = None
+            if value is None:
+                metrics.incr(f"{self.namespace}.fallback")
+            return Flight(key, value)
+
+        if not self._redis_available():
+            return self._lead(key)
+
+        token = uuid.uuid4().hex
+        try:
+            following = self._following.get(key)
+            if following is None:
+                if await get_redis().set(f"{self.namespace}:{key}:lock", token, nx=True, ex=self.timeout):
+                    return self._lead(key, token)
+                following = self._subscribe(key)
+            metrics.incr(f"{self.namespace}.follow")
+            value = await asyncio.shield(following)
+        except (RedisError, OSError) as e:
+            self._redis_failed(e)
+            value = None
+
+        if value is None:
+            metrics.incr(f"{self.namespace}.fallback")
+        return Flight(key, value)
+
+    def _subscribe(self, key: str) -> asyncio.Future:
+        """Start waiting for the leader in another process, once for all followers in this one."""
+        following = self._following.get(key)
+        if following is None:
+            following = self._following[key] = asyncio.ensure_future(self._follow(key))
+
+            def forget(task: asyncio.Future) -> None:
+                if self._following.get(key) is task:
+                    del self._following[key]
+                if not task.cancelled():
+                    task.exception()
+
+            following.add_done_callback(forget)
+        return following
+
+    async def _follow(self, key: str) -> Optional[bytes]:
+        """Wait for the leader in another process to publish its result."""
+        redis = get_redis()
+        deadline = time.monotonic() + self.timeout
+        async with redis.pubsub() as pubsub:
+            await pubsub.subscribe(f"{self.namespace}:{key}")
+            # The leader may have finished before the subscription
+            value = await redis.get(f"{self.namespace}:{key}:result")
+            while value is None and time.monotonic() < deadline:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    value = message["data"]
+                elif not await redis.exists(f"{self.namespace}:{key}:lock"):
+                    # The leader finished between the two checks or gave up without a result
+                    value = await redis.get(f"{self.namespace}:{key}:result")
+                    break
+        return value or None
+
+    async def done(self, flight: Flight, value: Optional[bytes]) -> None:
+        """Hand the result of the leader to its followers, None if there is none.
+
+        Does nothing for followers and if called again.
+        """
+        if flight.future is None or flight.future.done():
+            return
+        flight.future.set_result(value)
+        if self._leading.get(flight.key) is flight.future:
+            del self._leading[flight.key]
+
+        if flight.token is None:
+            return
+        key, token = flight.key, flight.token
+        try:
+            redis = get_redis()
+            if value is not None:
+                await redis.set(f"{self.namespace}:{key}:result", value, ex=self.timeout)
+            await redis.publish(f"{self.namespace}:{key}", value or b"")
+            await redis.eval(RELEASE_SCRIPT, 1, f"{self.namespace}:{key}:lock", token)
+        except (RedisError, OSError) as e:
+            self._redis_failed(e)
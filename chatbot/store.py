@@ -0,0 +1,245 @@
+"""Append-only, memory-mapped embedding store used by the local vector backend.
+
+A store is a directory holding a small ``meta.json`` and raw arrays of one generation:
+the embeddings (``vectors``), their text ids (``ids``), the precomputed squared norms
+(``norms``) and the positions of deleted rows (``deleted``). Rows are only ever appended
+and the meta file is replaced atomically after the data is written, so readers in other
+processes always see a consistent prefix. Readers map the files read-only, which lets
+every worker share the same pages of the OS cache instead of holding its own copy.
+"""
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+META = "meta.json"
+BLOCK_ROWS = 65_536
+
+
+class Snapshot(NamedTuple):
+    """Consistent view of a store at one point in time."""
+
+    meta: Dict[str, Any]
+    vectors: np.ndarray
+    ids: np.ndarray
+    norms: np.ndarray
+    deleted: Optional[np.ndarray]
+
+    @property
+    def live(self) -> int:
+        """Return the number of entries that are not deleted."""
+        return int(self.meta["count"] - self.meta["deleted"])
+
+
+class EmbeddingStore:
+    """Embeddings of one collection, stored on disk and mapped into memory."""
+
+    def __init__(self, path: Path) -> None:
+        """Open the store in the directory, the files are mapped on first use."""
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._snapshot: Optional[Snapshot] = None
+
+    @classmethod
+    def create(cls, path: Path, dim: int, dtype: str = "float32") -> "EmbeddingStore":
+        """Create an empty store, an existing store in the directory is kept."""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        store = cls(path)
+        if not store.exists():
+            store._write_meta({"dim": dim, "dtype": np.dtype(dtype).name, "generation": 0, "count": 0, "deleted": 0})
+        return store
+
+    def exists(self) -> bool:
+        """Indicate whether the store was created."""
+        return (self.path / META).exists()
+
+    def _file(self, kind: str, generation: int) -> Path:
+        return self.path / f"{kind}.{generation}.bin"
+
+    def _write_meta(self, meta: Dict[str, Any]) -> None:
+        tmp = self.path / f".{META}.tmp"
+        with open(tmp, "w") as fp:
+            json.dump(meta, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.path / META)
+
+    def _map(self, kind: str, meta: Dict[str, Any], dtype: Any, count: int, dim: Optional[int] = None) -> np.ndarray:
+        shape: Tuple[int, ...] = (count, dim) if dim is not None else (count, )
+        if count == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self._file(kind, meta["generation"]), dtype=dtype, mode="r", shape=shape)
+
+    def snapshot(self) -> Snapshot:
+        """Return the current view, remapping the files only if the store changed since the last call."""
+        with self._lock:
+            try:
+                return self._read()
+            except FileNotFoundError:
+                # A compaction removed the generation of the meta just read, read the new meta once more
+                return self._read()
+
+    def _read(self) -> Snapshot:
+        try:
+            stat = os.stat(self.path / META)
+        except FileNotFoundError:
+            raise ValueError(f"Embedding store {self.path} does not exist!")
+        stamp = (stat.st_ino, stat.st_mtime_ns)
+        if stamp == self._stamp and self._snapshot is not None:
+            return self._snapshot
+
+        with open(self.path / META) as fp:
+            meta = json.load(fp)
+        self._snapshot = self._load(meta)
+        self._stamp = stamp
+        return self._snapshot
+
+    def _load(self, meta: Dict[str, Any]) -> Snapshot:
+        """Map the files of the generation of the meta."""
+        count, dim = meta["count"], meta["dim"]
+        deleted = None
+        if meta["deleted"]:
+            deleted = np.zeros(count, dtype=bool)
+            deleted[self._map("deleted", meta, np.int64, meta["deleted"])] = True
+
+        return Snapshot(
+            meta=meta,
+            vectors=self._map("vectors", meta, meta["dtype"], count, dim),
+            ids=self._map("ids", meta, np.int64, count),
+            norms=self._map("norms", meta, np.float32, count),
+            deleted=deleted,
+        )
+
+    def __len__(self) -> int:
+        """Return the number of live entries."""
+        return self.snapshot().live
+
+    @contextmanager
+    def _locked(self) -> Iterator[Snapshot]:
+        """Serialize writers of this store, also across processes."""
+        with open(self.path / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self.snapshot()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _positions_of(snapshot: Snapshot, ids: np.ndarray) -> np.ndarray:
+        """Return the live positions holding one of the ids."""
+        if len(snapshot.ids) == 0 or len(ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        mask = np.isin(snapshot.ids, ids)
+        if snapshot.deleted is not None:
+            mask &= ~snapshot.deleted
+        return np.flatnonzero(mask).astype(np.int64)
+
+    @staticmethod
+    def _append(path: Path, array: np.ndarray, length: int) -> None:
+        """Append the array after the first length bytes, dropping leftovers of a crashed writer."""
+        with open(path, "ab") as fp:
+            fp.truncate(length)
+            fp.write(np.ascontiguousarray(array).tobytes())
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def _tombstone(self, snapshot: Snapshot, positions: np.ndarray) -> int:
+        if len(positions):
+            meta = snapshot.meta
+            self._append(self._file("deleted", meta["generation"]), positions, meta["deleted"] * 8)
+        return len(positions)
+
+    def append(self, ids: Sequence[int], embeddings: Any) -> None:
+        """Append embeddings, older entries with the same ids are replaced."""
+        ids_array = np.asarray(ids, dtype=np.int64)
+        with self._locked() as snapshot:
+            meta = snapshot.meta
+            dim, dtype, count, generation = meta["dim"], np.dtype(meta["dtype"]), meta["count"], meta["generation"]
+            matrix = np.asarray(embeddings, dtype=np.float32).reshape(-1, dim)
+            if len(matrix) != len(ids_array):
+                raise ValueError("Number of ids and embeddings differ.")
+
+            replaced = self._tombstone(snapshot, self._positions_of(snapshot, ids_array))
+
+            self._append(self._file("vectors", generation), matrix.astype(dtype), count * dim * dtype.itemsize)
+            self._append(self._file("ids", generation), ids_array, count * 8)
+            self._append(self._file("norms", generation), np.einsum("ij,ij->i", matrix, matrix), count * 4)
+
+            self._write_meta({**meta, "count": count + len(ids_array), "deleted": meta["deleted"] + replaced})
+
+    def delete(self, ids: Sequence[int]) -> None:
+        """Mark the entries with the given ids as deleted, the space is reclaimed by compact."""
+        with self._locked() as snapshot:
+            deleted = self._tombstone(snapshot, self._positions_of(snapshot, np.asarray(ids, dtype=np.int64)))
+            if deleted:
+                self._write_meta({**snapshot.meta, "deleted": snapshot.meta["deleted"] + deleted})
+
+    def deleted_ratio(self) -> float:
+        """Return the share of rows that are deleted but still take up space."""
+        meta = self.snapshot().meta
+        if not meta["count"]:
+            return 0.0
+        return float(meta["deleted"] / meta["count"])
+
+    def compact(self) -> None:
+        """Rewrite the live rows into a new generation and remove the old files.
+
+        Processes still mapping the old generation keep a valid mapping until they remap,
+        because unlinking a mapped file does not invalidate the mapping. Readers that read
+        the old meta but didn't map its files yet read the new meta again.
+        """
+        with self._locked() as snapshot:
+            if snapshot.deleted is None:
+                return
+            old = snapshot.meta["generation"]
+            keep = np.flatnonzero(~snapshot.deleted)
+
+            for kind, array in (("vectors", snapshot.vectors), ("ids", snapshot.ids), ("norms", snapshot.norms)):
+                with open(self._file(kind, old + 1), "wb") as fp:
+                    for start in range(0, len(keep), BLOCK_ROWS):
+                        fp.write(np.ascontiguousarray(array[keep[start:start + BLOCK_ROWS]]).tobytes())
+                    fp.flush()
+                    os.fsync(fp.fileno())
+
+            self._write_meta({**snapshot.meta, "generation": old + 1, "count": len(keep), "deleted": 0})
+            for kind in ("vectors", "ids", "norms", "deleted"):
+                self._file(kind, old).unlink(missing_ok=True)
+
+    def search(self, embedding: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return ids and squared L2 distances of the n closest live entries, closest first."""
+        snapshot = self.snapshot()
+        query = np.asarray(embedding, dtype=np.float32)
+        n = min(n, snapshot.live)
+        if n <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2, float16 blocks are widened for BLAS
+        distances = np.empty(len(snapshot.ids), dtype=np.float32)
+        for start in range(0, len(distances), BLOCK_ROWS):
+            block = snapshot.vectors[start:start + BLOCK_ROWS]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            distances[start:start + len(block)] = block @ query
+        distances *= -2
+        distances += snapshot.norms
+        distances += query @ query
+        if snapshot.deleted is not None:
+            distances[snapshot.deleted] = np.inf
+
+        positions = np.argpartition(distances, n - 1)[:n]
+        positions = positions[np.argsort(distances[positions])]
+        return np.asarray(snapshot.ids[positions]), distances[positions]
+
+    def live_ids(self) -> np.ndarray:
+        """Return the ids of all live entries."""
+        snapshot = self.snapshot()
+        if snapshot.deleted is None:
+            return np.asarray(snapshot.ids)
+        return np.asarray(snapshot.ids)[~snapshot.deleted]
@@ -0,0 +1,65 @@
+"""Celery tasks of the chatbot app."""
+from typing import List, Optional
+
+from celery import shared_task
+from django.conf import settings
+
+from chatbot import services
+from chatbot.backends import get_backend
+from chatbot.models import IndexJob, IndexShard, Realm
+
+
+def dispatch_index_job(job: IndexJob, shard_ids: Optional[List[int]] = None) -> None:
+    """Queue the pending shards of the job, or build the index right away if there are none."""
+    if job.status == IndexJob.Status.BUILDING:
+        build_job_index.delay(job.pk)
+        return
+    if shard_ids is None:
+        shard_ids = list(job.shards.filter(status=IndexShard.Status.PENDING).values_list("id", flat=True))
+    for shard_id in shard_ids:
+        index_shard.delay(shard_id)
+
+
+@shared_task(bind=True, max_retries=settings.INDEX_SHARD_RETRIES)
+def index_shard(self, shard_id: int) -> None:
+    """Index a shard, retrying with growing delays, and build the index after the last shard."""
+    try:
+        last = services.run_index_shard(shard_id)
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            services.fail_index_shard(shard_id, e)
+            raise
+        raise self.retry(exc=e, countdown=min(600, 10 * 2**self.request.retries))
+
+    if last:
+        job_id = IndexShard.objects.values_list("job_id", flat=True).get(pk=shard_id)
+        build_job_index.delay(job_id)
+
+
+@shared_task
+def build_job_index(job_id: int) -> None:
+    """Build the index of the realm of a finished job."""
+    services.finish_index_job(job_id)
+
+
+@shared_task
+def drop_collections(realm_id: int, names: List[str]) -> None:
+    """Drop collections the realm no longer uses."""
+    backend = get_backend(Realm.objects.get(pk=realm_id))
+    for name in names:
+        backend.drop(name)
+
+
+@shared_task(autoretry_for=(Exception, ), retry_backoff=True, max_retries=5)
+def sync_realm_texts(realm_id: int, text_ids: Optional[List[int]] = None) -> None:
+    """Sync the given texts, or the texts queued for the realm, into its vector index.
+
+    Texts of a deleted realm are dropped instead of retried.
+    """
+    try:
+        if text_ids is None:
+            services.sync_queued_texts(realm_id)
+        else:
+            services.sync_texts(realm_id, text_ids)
+    except Realm.DoesNotExist:
+        return
@@ -1,20 +1,80 @@
 """Tests for the chatbot application."""
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
 from os import environ
+from unittest import mock
 
 import numpy as np
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.core.management import call_command
+from django.db.models.signals import post_delete
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from pymilvus.client.types import LoadState
 
+from chatbot import limits, metrics, services, tokenizer
+from chatbot.apps import should_warm, warm_realm_collections
+from chatbot.backends import (
+    LocalBackend,
+    MilvusBackend,
+    SearchFilter,
+    SearchResult,
+    SharedMilvusBackend,
+    TextAttributes,
+)
+from chatbot.cache import TwoTierCache, normalize_text
+from chatbot.chunking import Chunk, Chunker, chunk_texts
+from chatbot.pipeline import Pipeline, Stage
+from chatbot.singleflight import SingleFlight
+from chatbot.store import EmbeddingStore
+from chatbot.tasks import dispatch_index_job, sync_realm_texts
+from chatbot.tokenizer import count_tokens
 from chatbot.collections import (
+    LoadedCollections,
     build_index,
     collection_exists,
     count_entries,
     create_collection,
+    delete_embeddings_from,
     drop_collection,
+    drop_partition,
     insert_embeddings_into,
     list_collections,
     search_in_collection,
 )
-from chatbot.embeddings import batch_embedding, single_embedding
+from chatbot.embeddings import (
+    EmbeddingBatcher,
+    batch_embedding,
+    content_hash,
+    query_cache_key,
+    query_embeddings,
+    single_embedding,
+)
+from chatbot.models import Chatbot, CollectionIndex, IndexJob, IndexShard, Question, Realm, StoredEmbedding, Text
+from chatbot.services import (
+    _format_context,
+    _index_texts,
+    answer_flights,
+    create_index_job,
+    fail_index_shard,
+    find_similar_question,
+    find_texts,
+    forget_chatbot,
+    hydrate_texts,
+    index_realm,
+    migrate_realm_model,
+    moderation_verdicts,
+    run_index_shard,
+    store_question,
+)
+from chatbot.views import _FlightStream
+from core.rates import parse_rate
 
 openai_key = environ.get('OPENAI_API_KEY', '')
 openai_user = 'testing'
@@ -37,6 +97,152 @@ class TestEmbedding(TestCase):
         self.assertEqual(len(batch_texts), len(embeddings))
 
 
+class TestStoredEmbeddings(TestCase):
+    """Test embeddings are stored by model and content and reused."""
+
+    @staticmethod
+    def _response(**kwargs):
+        return {
+            'model': kwargs['model'],
+            'usage': {'total_tokens': 1},
+            'data': [{'index': i, 'embedding': [float(len(text)), 1.0]} for i, text in enumerate(kwargs['input'])],
+        }
+
+    def test_only_missing_texts_are_requested(self):
+        """Test stored texts are not sent to OpenAI again, also for another key."""
+        with mock.patch('chatbot.embeddings._create_embeddings', side_effect=self._response) as create:
+            first = batch_embedding(['a', 'bb'], 'key', 'model', 'user')
+            second = batch_embedding(['bb', 'ccc', 'a', 'ccc'], 'other', 'model', 'user')
+
+        self.assertEqual([['a', 'bb'], ['ccc']], [call.kwargs['input'] for call in create.call_args_list])
+        self.assertEqual([[1, 1], [2, 1]], first.tolist())
+        self.assertEqual([[2, 1], [3, 1], [1, 1], [3, 1]], second.tolist())
+        self.assertEqual(3, StoredEmbedding.objects.filter(model='model').count())
+
+    def test_long_texts_are_requested_alone(self):
+        """Test a text over the token limit gets the mean of its parts and the others are requested once."""
+        long_text = ' '.join(['word'] * 30)
+        with mock.patch('chatbot.embeddings._create_embeddings', side_effect=self._response) as create, \
+                mock.patch('chatbot.embeddings.MAX_TOKENS', 10):
+            embeddings = batch_embedding(['a', long_text, 'bb'], 'key', 'model', 'user')
+
+        inputs = [call.kwargs['input'] for call in create.call_args_list]
+        self.assertEqual(['a', 'bb'], inputs[0])
+        self.assertTrue(all(len(part) == 1 for part in inputs[1:]))
+        self.assertEqual(3, len(embeddings))
+        self.assertAlmostEqual(1.0, float(np.linalg.norm(embeddings[1])), places=5)
+        self.assertEqual(3, StoredEmbedding.objects.filter(model='model').count())
+
+    def test_missing_embeddings_raise(self):
+        """Test a response with fewer embeddings than texts isn't stored."""
+        response = self._response(model='model', input=['a'])
+        with mock.patch('chatbot.embeddings._create_embeddings', return_value=response):
+            with self.assertRaises(ValueError):
+                batch_embedding(['a', 'bb'], 'key', 'model', 'user')
+        self.assertFalse(StoredEmbedding.objects.exists())
+
+    def test_models_are_separate(self):
+        """Test an embedding is only reused for the same model."""
+        with mock.patch('chatbot.embeddings._create_embeddings', side_effect=self._response) as create:
+            batch_embedding(['a'], 'key', 'model', 'user')
+            batch_embedding(['a'], 'key', 'other-model', 'user')
+        self.assertEqual(2, create.call_count)
+
+
+class TestImportTexts(TestCase):
+    """Test importing texts from jsonl files."""
+
+    def _import(self, lines, *args):
+        with tempfile.NamedTemporaryFile(suffix='.jsonl.gz') as f:
+            with gzip.open(f.name, 'wt') as out:
+                out.writelines(json.dumps(line) + '\n' for line in lines)
+            call_command('import_texts', 'test', f.name, *args, stdout=StringIO())
+
+    def test_gzip_and_duplicates(self):
+        """Test a compressed file is imported once per content, also across imports."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        lines = [
+            {'text': 'Tom is a dog.', 'url': 'https://example.com/1', 'page': 1},
+            {'text': 'Tom is a dog.', 'url': 'https://example.com/2', 'page': 1},
+            {'text': 'Garfield is a cat.', 'url': '', 'page': 2, 'internal': True},
+        ]
+        self._import(lines, '--batch_size', '2')
+        self._import(lines)
+
+        texts = Text.objects.filter(realm=realm).order_by('id')
+        self.assertEqual(['Tom is a dog.', 'Garfield is a cat.'], [text.content for text in texts])
+        self.assertEqual([False, True], [text.internal for text in texts])
+        self.assertEqual(content_hash('Tom is a dog.'), texts[0].content_hash)
+        self.assertTrue(all(text.token_count for text in texts))
+
+        self._import(lines, '--keep_duplicates')
+        self.assertEqual(5, Text.objects.filter(realm=realm).count())
+
+    def test_long_texts_are_split(self):
+        """Test texts over the target are imported as snippets with their token counts."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        text = ' '.join(f'Sentence number {i} is here.' for i in range(40))
+        self._import([{'text': text, 'url': '', 'page': 1}], '--chunk_tokens', '50', '--processes', '1')
+
+        texts = Text.objects.filter(realm=realm)
+        self.assertGreater(len(texts), 4)
+        for snippet in texts:
+            self.assertEqual(count_tokens(snippet.content, memoize=False), snippet.token_count)
+            self.assertLessEqual(snippet.token_count, 50)
+
+    def test_stdin_stays_open(self):
+        """Test texts read from stdin are imported without closing it, duplicates across batches are skipped."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        with tempfile.TemporaryFile() as f:
+            f.writelines(json.dumps({'text': text, 'url': '', 'page': 1}).encode() + b'\n'
+                         for text in ['Tom is a dog.', 'Garfield is a cat.', 'Tom is a dog.'])
+            f.seek(0)
+            stdin = mock.Mock(buffer=f)
+            with mock.patch('sys.stdin', stdin):
+                call_command('import_texts', 'test', '-', '--batch_size', '1', stdout=StringIO())
+            self.assertFalse(f.closed)
+
+        self.assertEqual(['Tom is a dog.', 'Garfield is a cat.'],
+                         list(Text.objects.filter(realm=realm).order_by('id').values_list('content', flat=True)))
+
+
+class TestChunking(TestCase):
+    """Test splitting documents into snippets."""
+
+    document = '\n\n'.join(' '.join(f'Paragraph {p} has sentence {i}.' for i in range(6)) for p in range(8))
+
+    def test_short_texts_are_kept(self):
+        """Test texts within the target stay unchanged."""
+        self.assertEqual([[Chunk('Tom is a dog. ', count_tokens('Tom is a dog. '))]],
+                         chunk_texts(['Tom is a dog. '], 50))
+        self.assertEqual(1, len(chunk_texts([self.document], 0)[0]))
+
+    def test_boundaries_and_overlap(self):
+        """Test snippets end after a sentence, stay below the target and overlap."""
+        chunks = chunk_texts([self.document], 60, 10)[0]
+
+        self.assertGreater(len(chunks), 3)
+        for chunk, following in zip(chunks, chunks[1:]):
+            self.assertLessEqual(chunk.tokens, 60)
+            self.assertTrue(chunk.text.endswith('.'))
+            self.assertIn(chunk.text.split('. ')[-1], following.text)
+        joined = ' '.join(chunk.text for chunk in chunks)
+        for p in range(8):
+            self.assertIn(f'Paragraph {p} has sentence 5.', joined)
+
+    def test_long_sentences(self):
+        """Test a sentence over the target is cut between words."""
+        chunks = chunk_texts(['word ' * 200], 30)[0]
+        self.assertTrue(all(chunk.tokens <= 30 for chunk in chunks))
+        self.assertEqual(200, sum(chunk.text.count('word') for chunk in chunks))
+
+    def test_process_pool(self):
+        """Test the pool returns the chunks of every document in order."""
+        documents = [self.document, 'Short text.'] * 3
+        with Chunker(60, 10, processes=2) as chunker:
+            self.assertEqual(chunk_texts(documents, 60, 10), chunker.chunk(documents))
+
+
 class TestCollection(TestCase):
     """Test collection methods."""
 
@@ -85,3 +291,1085 @@ class TestCollection(TestCase):
 
         result = search_in_collection(query_embedding, 'test_search', n=1)
         self.assertEqual(2, result.ids[0])
+
+
+class TestLocalBackend(TestCase):
+    """Test the NumPy backend, which needs neither Milvus nor OpenAI."""
+
+    def setUp(self):
+        """Use a temporary directory for the collections."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(LOCAL_VECTOR_ROOT=self.tmp.name)
+        self.settings.enable()
+        self.backend = LocalBackend()
+        self.embeddings = np.random.default_rng(0).normal(size=(50, 8)).astype(np.float32)
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def test_create_collection(self):
+        """Test creating an empty collection."""
+        self.assertFalse(self.backend.exists('test_create'))
+        self.backend.create('test_create', 8)
+        self.assertTrue(self.backend.exists('test_create'))
+        self.assertEqual(0, self.backend.count('test_create'))
+
+    def test_search(self):
+        """Test the closest entries are returned in order of distance."""
+        self.backend.create('test_search', 8)
+        self.backend.insert('test_search', range(100, 150), self.embeddings)
+
+        result = self.backend.search('test_search', self.embeddings[7] + 0.01, n=3)
+
+        self.assertEqual(3, len(result.ids))
+        self.assertEqual(107, result.ids[0])
+        self.assertEqual(sorted(result.distances), result.distances)
+
+    def test_delete_and_drop(self):
+        """Test deleting entries and dropping the collection."""
+        self.backend.create('test_delete', 8)
+        self.backend.insert('test_delete', range(50), self.embeddings)
+        self.backend.delete('test_delete', [7])
+
+        self.assertEqual(49, self.backend.count('test_delete'))
+        self.assertNotIn(7, self.backend.search('test_delete', self.embeddings[7], n=3).ids)
+
+        self.backend.drop('test_delete')
+        self.assertFalse(self.backend.exists('test_delete'))
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestMigrateRealmModel(TransactionTestCase):
+    """Test switching a realm to another embedding model with the local backend."""
+
+    def setUp(self):
+        """Use a temporary directory for the collections."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(LOCAL_VECTOR_ROOT=self.tmp.name)
+        self.settings.enable()
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    @staticmethod
+    def _fake_embedding(texts, openai_key, model, *args):
+        dim = 4 if model == 'new-model' else 8
+        return np.array([np.random.default_rng(sum(text.encode())).normal(size=dim) for text in texts])
+
+    def test_migrate(self):
+        """Test the realm switches to a complete new collection and keeps the old one until it is dropped."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(12)])
+        backend = LocalBackend()
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding):
+            index_realm('test', batch_size=5)
+            replaced = migrate_realm_model('test', 'new-model', 4, batch_size=5)
+
+        realm.refresh_from_db()
+        self.assertEqual(('new-model', 4), (realm.embedding_model, realm.embedding_dim))
+        self.assertNotEqual('test', realm.collection)
+        self.assertEqual(['test'], replaced)
+        self.assertEqual(12, backend.count(realm.collection))
+        self.assertEqual(12, backend.count('test'))
+        self.assertFalse(Text.objects.filter(indexed=False).exists())
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding):
+            call_command('migrate_realm_model', 'test', 'other-model', 8, stdout=StringIO())
+        self.assertFalse(backend.exists(realm.collection))
+
+    @override_settings(REDIS_URL='')
+    def test_edits_during_migration(self):
+        """Test texts edited or deleted while the new collection is built are synced into both collections."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(6)])
+        backend = LocalBackend()
+        edited, deleted = Text.objects.order_by('id')[:2]
+        deleted_pk = deleted.pk
+        validate = services._validate_collection
+
+        def edit_then_validate(*args):
+            edited.content = 'changed'
+            edited.save()
+            deleted.delete()
+            validate(*args)
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding) as embed, \
+                mock.patch('chatbot.services._validate_collection', side_effect=edit_then_validate):
+            index_realm('test', batch_size=10)
+            migrate_realm_model('test', 'new-model', 4, batch_size=10)
+
+        self.assertIn(mock.call(['changed'], '', 'new-model', 'test', ''), embed.call_args_list)
+        realm.refresh_from_db()
+        self.assertEqual('', realm.pending_collection_suffix)
+        for collection in ['test', realm.collection]:
+            self.assertEqual(5, backend.count(collection))
+            self.assertEqual({edited.pk}, backend.existing_ids(collection, [edited.pk, deleted_pk]))
+
+    def test_incomplete(self):
+        """Test the realm isn't switched when the new collection misses texts."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(3)])
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding):
+            with mock.patch('chatbot.services._index_texts'):
+                with self.assertRaises(ValueError):
+                    migrate_realm_model('test', 'new-model', 4)
+
+        realm.refresh_from_db()
+        self.assertEqual(('text-embedding-ada-002', 'test'), (realm.embedding_model, realm.collection))
+        self.assertEqual([], os.listdir(self.tmp.name))
+
+
+class TestMilvusIndex(TestCase):
+    """Test when the Milvus backend rebuilds the index, with the collection calls mocked."""
+
+    def setUp(self):
+        """Mock a collection with a current index."""
+        patcher = mock.patch('chatbot.backends.collections')
+        self.collections = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.collections.count_entries.return_value = 100
+        self.collections.has_current_index.return_value = True
+        self.collections.fragmentation.return_value = 0.0
+        self.backend = MilvusBackend()
+
+    def test_incremental(self):
+        """Test inserts are only flushed while the collection grows little."""
+        CollectionIndex.objects.create(name='test', entities=60)
+        self.backend.build_index('test')
+        self.collections.count_entries.assert_called_with('test', flush=True)
+        self.collections.build_index.assert_not_called()
+        self.collections.compact.assert_not_called()
+
+    def test_rebuild(self):
+        """Test the index is rebuilt when forced, outdated or the collection doubled."""
+        CollectionIndex.objects.create(name='test', entities=40)
+        self.backend.build_index('test')
+        self.assertEqual(100, CollectionIndex.objects.get(name='test').entities)
+
+        self.backend.build_index('test', force=True)
+        self.collections.has_current_index.return_value = False
+        self.backend.build_index('test')
+        self.assertEqual(3, self.collections.build_index.call_count)
+
+    def test_compact(self):
+        """Test a fragmented collection is compacted instead of rebuilt."""
+        self.collections.fragmentation.return_value = 0.8
+        self.backend.build_index('test')
+        self.collections.compact.assert_called_once_with('test')
+        self.collections.build_index.assert_not_called()
+        self.assertEqual(100, CollectionIndex.objects.get(name='test').entities)
+
+
+class TestSearchFilter(TestCase):
+    """Test filtering searches by the scalar fields of texts."""
+
+    def test_expression(self):
+        """Test the filter is translated to a Milvus expression."""
+        where = SearchFilter(exclude_urls=('https://a.ch', 'https://b.ch'), internal=False)
+        self.assertEqual('internal == false and url not in ["https://a.ch", "https://b.ch"]', where.expression())
+        self.assertFalse(SearchFilter())
+
+    def test_shared_backend(self):
+        """Test the shared backend stores attributes and searches with the filter in the partition."""
+        backend = SharedMilvusBackend()
+        with mock.patch('chatbot.backends.collections') as collections:
+            collections.collection_exists.return_value = False
+            backend.create('my-realm', 4)
+            attributes = [TextAttributes(url='a'), TextAttributes(True, 'b', 3)]
+            backend.insert('my-realm', [1, 2], np.zeros((2, 4)), attributes)
+            backend.search('my-realm', np.zeros(4), n=3, where=SearchFilter(exclude_urls=('a', )))
+
+        collections.create_shared_collection.assert_called_once_with('texts_4', 4)
+        collections.create_partition.assert_called_once_with('texts_4', 'my_realm')
+        fields = collections.insert_embeddings_into.call_args.args[4]
+        self.assertEqual([[False, True], ['a', 'b'], [0, 3]], fields)
+        self.assertEqual('url not in ["a"]', collections.search_in_collection.call_args.kwargs['expr'])
+        self.assertEqual('my_realm', collections.search_in_collection.call_args.kwargs['partition_name'])
+
+    def test_shared_backend_keeps_collection(self):
+        """Test building and dropping a partition leave the index and the loaded shared collection alone."""
+        backend = SharedMilvusBackend()
+        with mock.patch('chatbot.backends.collections') as collections:
+            collections.collection_exists.return_value = False
+            backend.create('my-realm', 4)
+            backend.build_index('my-realm', force=True)
+            backend.drop('my-realm')
+
+        collections.ensure_index.assert_called_once_with('texts_4')
+        collections.build_index.assert_not_called()
+        collections.drop_partition.assert_called_once_with('texts_4', 'my_realm')
+
+        with mock.patch('chatbot.collections.get_collection') as get_collection:
+            drop_partition('texts_4', 'my_realm')
+        partition = get_collection.return_value.partition.return_value
+        partition.release.assert_called_once_with()
+        partition.drop.assert_called_once_with()
+        get_collection.return_value.release.assert_not_called()
+
+    def test_shared_delete_needs_partition(self):
+        """Test ids aren't deleted across the partitions of a shared collection, where they repeat."""
+        with mock.patch('chatbot.collections.get_collection') as get_collection:
+            with self.assertRaises(ValueError):
+                delete_embeddings_from([1], 'texts_4')
+            delete_embeddings_from([1], 'texts_4', 'bot_questions')
+        get_collection.return_value.delete.assert_called_once_with('text_id in [1]', partition_name='bot_questions')
+
+    async def test_post_filter(self):
+        """Test backends without filters fetch more texts and leave out the excluded ones."""
+        realm = await Realm.objects.acreate(slug='test', openai_key='', vector_backend=Realm.Backend.LOCAL)
+        texts = await Text.objects.abulk_create(
+            [Text(realm=realm, content=f'text {i}', url=f'https://{i % 2}.ch') for i in range(10)]
+        )
+        result = SearchResult([text.pk for text in texts], [0.1 * i for i in range(10)])
+
+        with mock.patch.object(LocalBackend, 'search', return_value=result) as search:
+            found = await find_texts('q', realm, np.zeros(4), SearchFilter(exclude_urls=('https://0.ch', )))
+
+        self.assertEqual(80, search.call_args.kwargs['n'])
+        self.assertEqual([text.pk for text in texts[1::2]], [text.pk for text in found])
+
+
+class TestEmbeddingStore(TestCase):
+    """Test the memory-mapped store behind the local backend."""
+
+    def setUp(self):
+        """Create a store in a temporary directory."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = EmbeddingStore.create(self.tmp.name, 4)
+        self.embeddings = np.eye(4, dtype=np.float32)
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.tmp.cleanup()
+
+    def test_append_is_visible_to_other_readers(self):
+        """Test a second handle on the same files sees appended rows."""
+        reader = EmbeddingStore(self.tmp.name)
+        self.store.append([1, 2], self.embeddings[:2])
+        self.assertEqual(2, len(reader))
+        self.store.append([3], self.embeddings[2:3])
+        self.assertEqual([3], reader.search(self.embeddings[2], 1)[0].tolist())
+
+    def test_append_replaces_existing_ids(self):
+        """Test appending an existing id replaces the old embedding."""
+        self.store.append([1, 2], self.embeddings[:2])
+        self.store.append([1], self.embeddings[3:4])
+        self.assertEqual(2, len(self.store))
+        ids, distances = self.store.search(self.embeddings[3], 1)
+        self.assertEqual([1], ids.tolist())
+        self.assertAlmostEqual(0, distances[0])
+
+    def test_compact(self):
+        """Test compacting removes deleted rows and keeps the rest searchable."""
+        self.store.append([1, 2, 3, 4], self.embeddings)
+        self.store.delete([2, 3])
+        self.assertEqual(0.5, self.store.deleted_ratio())
+
+        self.store.compact()
+
+        self.assertEqual(0, self.store.deleted_ratio())
+        self.assertEqual([1, 4], sorted(self.store.live_ids().tolist()))
+        self.assertEqual([4], self.store.search(self.embeddings[3], 1)[0].tolist())
+
+    def test_compact_while_reading(self):
+        """Test a reader that read the meta just before a compaction reads the new generation."""
+        self.store.append([1, 2, 3, 4], self.embeddings)
+        self.store.delete([2])
+        reader = EmbeddingStore(self.tmp.name)
+        load = reader._load
+
+        def compact_then_load(meta):
+            if meta['generation'] == 0:
+                self.store.compact()
+            return load(meta)
+
+        with mock.patch.object(reader, '_load', side_effect=compact_then_load):
+            self.assertEqual([1, 3, 4], sorted(reader.live_ids().tolist()))
+        self.assertEqual(1, reader.snapshot().meta['generation'])
+
+    def test_float16(self):
+        """Test stores with half precision embeddings."""
+        store = EmbeddingStore.create(f'{self.tmp.name}/half', 4, 'float16')
+        store.append([1, 2, 3, 4], self.embeddings)
+        self.assertEqual([2, 1], store.search(self.embeddings[1] + [0.1, 0, 0, 0], 2)[0].tolist())
+
+
+@override_settings(REDIS_URL='')
+@mock.patch('chatbot.collections.utility.load_state', return_value=LoadState.NotLoad)
+@mock.patch('chatbot.collections.estimate_memory', lambda collection: 100)
+@mock.patch('chatbot.collections.get_collection')
+class TestLoadedCollections(TestCase):
+    """Test releasing the least recently searched collections."""
+
+    def test_count_budget(self, get_collection, load_state):
+        """Test the least recently used collection is released first."""
+        manager = LoadedCollections(max_count=2)
+        evictions = metrics.get('milvus.load.evict')
+
+        manager.acquire('a')
+        manager.acquire('b')
+        manager.acquire('a')
+        manager.acquire('c')
+
+        self.assertIn('a', manager)
+        self.assertNotIn('b', manager)
+        self.assertIn('c', manager)
+        self.assertEqual(evictions + 1, metrics.get('milvus.load.evict'))
+
+    def test_pinned_and_memory_budget(self, get_collection, load_state):
+        """Test pinned collections stay loaded when the memory budget is exceeded."""
+        manager = LoadedCollections(max_bytes=300, pinned=['a'])
+
+        for name in 'abcd':
+            manager.acquire(name)
+
+        self.assertIn('a', manager)
+        self.assertEqual(['a', 'c', 'd'], sorted(manager.stats()['loaded']))
+
+    def test_loaded_by_others(self, get_collection, load_state):
+        """Test collections another process loaded are not released without a shared budget."""
+        manager = LoadedCollections(max_count=1)
+        load_state.return_value = LoadState.Loaded
+        manager.acquire('a')
+        load_state.return_value = LoadState.NotLoad
+        manager.acquire('b')
+        manager.acquire('c')
+
+        self.assertEqual(['a', 'c'], sorted(manager.stats()['loaded']))
+        get_collection.return_value.release.assert_called_once()
+
+    @override_settings(REDIS_URL='redis://redis:6379')
+    def test_shared_budget(self, get_collection, load_state):
+        """Test the collections to release are decided in Redis for all processes."""
+        manager = LoadedCollections(max_count=1)
+        redis = mock.Mock(eval=mock.Mock(side_effect=[[], [b'a']]))
+        with mock.patch('chatbot.collections.get_sync_redis', return_value=redis):
+            manager.acquire('a')
+            manager.acquire('b')
+            manager.acquire('b')
+
+        self.assertEqual(['b'], sorted(manager.stats()['loaded']))
+        self.assertEqual(2, redis.eval.call_count)
+        self.assertEqual(('a', 'b'), (redis.eval.call_args_list[0].args[4], redis.eval.call_args.args[4]))
+        get_collection.return_value.release.assert_called_once()
+
+
+class TestWarmCollections(TestCase):
+    """Test which processes warm which collections."""
+
+    def test_server_processes(self):
+        """Test only processes serving requests warm collections."""
+        self.assertTrue(should_warm(['/usr/local/bin/gunicorn', '--workers', '4']))
+        self.assertTrue(should_warm(['uvicorn', 'core.asgi:application']))
+        self.assertTrue(should_warm(['manage.py', 'runserver', '--noreload']))
+        with mock.patch.dict(environ, {'RUN_MAIN': 'true'}):
+            self.assertTrue(should_warm(['manage.py', 'runserver']))
+        for argv in (['manage.py', 'migrate'], ['manage.py', 'test'], ['manage.py', 'runserver'],
+                     ['celery', '-A', 'core', 'worker'], []):
+            self.assertFalse(should_warm(argv))
+
+    @override_settings(MILVUS_WARM_COLLECTIONS=False)
+    def test_disabled(self):
+        """Test the setting turns warming off for servers too."""
+        self.assertFalse(should_warm(['gunicorn']))
+
+    @override_settings(MILVUS_SHARED_COLLECTION='texts')
+    def test_realms_with_chatbots(self):
+        """Test the collections of Milvus realms used by a chatbot are warmed."""
+        for slug, backend in [('milvus', Realm.Backend.MILVUS), ('shared', Realm.Backend.MILVUS_SHARED),
+                              ('local', Realm.Backend.LOCAL)]:
+            realm = Realm.objects.create(slug=slug, openai_key='', embedding_dim=8, vector_backend=backend)
+            Chatbot.objects.create(slug=slug, name=slug, realm=realm, openai_key='', prompt_template='')
+        Realm.objects.create(slug='unused', openai_key='', vector_backend=Realm.Backend.MILVUS)
+
+        with mock.patch('chatbot.collections.warm_collections') as warm:
+            warm_realm_collections()
+        self.assertEqual(['milvus', 'texts_8'], sorted(warm.call_args.args[0]))
+
+
+class TestHydrateTexts(TestCase):
+    """Test loading the texts of a search result."""
+
+    def setUp(self):
+        """Create texts in a realm."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        self.texts = [Text.objects.create(realm=realm, content=f'Text {i}', url=f'https://{i}') for i in range(3)]
+
+    def test_keeps_ranking(self):
+        """Test the texts are returned in the order of the search with their distances."""
+        ids = [self.texts[2].pk, self.texts[0].pk, 999_999, self.texts[1].pk]
+
+        texts = hydrate_texts(ids, [0.1, 0.2, 0.3, 0.4])
+
+        self.assertEqual(['Text 2', 'Text 0', 'Text 1'], [text.content for text in texts])
+        self.assertEqual([0.1, 0.2, 0.4], [text.distance for text in texts])
+
+    @override_settings(
+        TEXT_CACHE_TIMEOUT=60,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    def test_read_through_cache(self):
+        """Test cached texts are served without a query and invalidated on save."""
+        ids = [text.pk for text in self.texts]
+        hydrate_texts(ids, [0, 0, 0])
+
+        with self.assertNumQueries(0):
+            self.assertEqual('Text 1', hydrate_texts(ids, [0, 0, 0])[1].content)
+
+        self.texts[1].content = 'Changed'
+        self.texts[1].save()
+        self.assertEqual('Changed', hydrate_texts(ids, [0, 0, 0])[1].content)
+
+
+@override_settings(REDIS_URL='')
+class TestQueryEmbeddingCache(TestCase):
+    """Test caching the embeddings of questions."""
+
+    def test_normalize_text(self):
+        """Test case, whitespace and punctuation don't change the key."""
+        self.assertEqual(normalize_text('What are your  opening hours?'), normalize_text('what are your opening hours'))
+        self.assertEqual(
+            query_cache_key('Opening hours?', openai_model),
+            query_cache_key(' opening HOURS', openai_model),
+        )
+        self.assertNotEqual(query_cache_key('Opening hours', openai_model), query_cache_key('Opening hours', 'other'))
+
+    async def test_lru(self):
+        """Test the local tier evicts the least recently used entry."""
+        cache = TwoTierCache('test', maxsize=2, timeout=60)
+        await cache.set('a', b'1')
+        await cache.set('b', b'2')
+        await cache.get('a')
+        await cache.set('c', b'3')
+
+        self.assertEqual(b'1', await cache.get('a'))
+        self.assertIsNone(await cache.get('b'))
+        self.assertEqual(2 / 3, cache.hit_rate())
+
+    async def test_cached_embedding_skips_openai(self):
+        """Test a cached question is answered without calling OpenAI."""
+        embedding = np.arange(4, dtype=np.float32)
+        await query_embeddings.set(query_cache_key('Where do birds go?', openai_model), embedding.tobytes())
+
+        result = await single_embedding('where do birds go', 'invalid-key', openai_model, openai_user)
+
+        np.testing.assert_array_equal(embedding, result)
+
+
+class TestAnswerCache(TestCase):
+    """Test reusing answers of similar questions."""
+
+    def setUp(self):
+        """Create a bot whose realm uses the local backend."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(LOCAL_VECTOR_ROOT=self.tmp.name, ANSWER_CACHE_MIN_COUNT=3)
+        self.settings.enable()
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=4, vector_backend='local')
+        self.bot = Chatbot.objects.create(
+            slug='test', name='Test', realm=realm, openai_key='', prompt_template='', answer_cache_distance=0.1
+        )
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    async def test_similar_question(self):
+        """Test only approved or frequent questions within the distance are reused."""
+        embedding = np.array([1, 0, 0, 0], dtype=np.float32)
+        question = await store_question('Opening hours?', 'Always', '', [], self.bot, embedding)
+
+        self.assertIsNone(await find_similar_question(embedding, self.bot))
+
+        question.approved = True
+        await sync_to_async(question.save)()
+
+        self.assertEqual(question, await find_similar_question(embedding + [0, 0.2, 0, 0], self.bot))
+        self.assertIsNone(await find_similar_question(embedding + [0, 0.5, 0, 0], self.bot))
+
+
+class TestEmbeddingBatcher(TestCase):
+    """Test combining concurrent embedding requests."""
+
+    @staticmethod
+    async def fake_embeddings(input, **kwargs):
+        """Answer like the OpenAI API with an embedding derived from the text length."""
+        return {'data': [{'index': i, 'embedding': [len(text), i]} for i, text in enumerate(input)]}
+
+    async def test_concurrent_requests_share_one_call(self):
+        """Test concurrent requests are sent as one batch and answered individually."""
+        batcher = EmbeddingBatcher(window=0.01, max_size=10)
+        texts = ['a', 'bb', 'ccc', 'bb']
+
+        with mock.patch('openai.Embedding.acreate', side_effect=self.fake_embeddings) as acreate:
+            results = await asyncio.gather(
+                *[batcher.embed(text, 'key', openai_model, openai_user, '') for text in texts])
+
+        acreate.assert_called_once()
+        self.assertEqual(['a', 'bb', 'ccc'], acreate.call_args.kwargs['input'])
+        self.assertEqual([1, 2, 3, 2], [int(result[0]) for result in results])
+
+    async def test_full_batch_is_sent_immediately(self):
+        """Test a batch reaching the maximum size doesn't wait for the window."""
+        batcher = EmbeddingBatcher(window=60, max_size=2)
+
+        with mock.patch('openai.Embedding.acreate', side_effect=self.fake_embeddings):
+            results = await asyncio.wait_for(
+                asyncio.gather(batcher.embed('a', 'key', openai_model, openai_user, ''),
+                               batcher.embed('b', 'key', openai_model, openai_user, '')),
+                timeout=1,
+            )
+
+        self.assertEqual(2, len(results))
+
+
+@override_settings(REDIS_URL='')
+class TestStreaming(TestCase):
+    """Test streaming answers as server-sent events."""
+
+    def setUp(self):
+        """Create a public bot that answers without context."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        Chatbot.objects.create(
+            slug='test', name='Test', realm=realm, openai_key='', prompt_template='',
+            public=True, restricted=False, skip_context=True,
+        )
+
+    async def test_stream_answer(self):
+        """Test the answer is sent in parts and stored once complete."""
+        async def fake_completion(*args):
+            for part in ['Hel', 'lo']:
+                yield part
+
+        with mock.patch('chatbot.views.stream_completion', fake_completion):
+            response = await AsyncClient().get('/bot/test/', {'question': 'Hi', 'stream': '1'})
+            body = ''.join([part.decode() async for part in response.streaming_content])
+
+        self.assertEqual('text/event-stream', response['Content-Type'])
+        events = [block.split('\n')[0] for block in body.strip().split('\n\n')]
+        self.assertEqual(['event: sources', 'event: token', 'event: token', 'event: done'], events)
+        self.assertTrue(await Question.objects.filter(question='Hi', answer='Hello').aexists())
+
+
+@override_settings(REDIS_URL='')
+class TestAsyncViews(TestCase):
+    """Test the async request path of the bot views."""
+
+    def setUp(self):
+        """Create a private bot."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        self.bot = Chatbot.objects.create(
+            slug='test', name='Test', realm=realm, openai_key='', prompt_template='',
+            public=False, restricted=False, skip_context=True,
+        )
+        forget_chatbot('test')
+
+    def test_parse_rate(self):
+        """Test rates are split into requests and seconds."""
+        self.assertEqual((20, 60), parse_rate('20/m'))
+        self.assertEqual((100, 600), parse_rate('100/10m'))
+        with self.assertRaises(ValueError):
+            parse_rate('20 per minute')
+
+    async def test_bot_name_cached(self):
+        """Test the chatbot is queried once and forgotten when it is saved."""
+        response = await AsyncClient().get('/bot/test/name/')
+        self.assertEqual({'name': 'Test'}, response.json())
+
+        await Chatbot.objects.filter(slug='test').aupdate(name='Changed')
+        response = await AsyncClient().get('/bot/test/name/')
+        self.assertEqual({'name': 'Test'}, response.json())
+
+        self.bot.name = 'Saved'
+        await sync_to_async(self.bot.save)()
+        response = await AsyncClient().get('/bot/test/name/')
+        self.assertEqual({'name': 'Saved'}, response.json())
+
+    async def test_private_bot_denied(self):
+        """Test anonymous users can't ask a private bot."""
+        response = await AsyncClient().get('/bot/test/', {'question': 'Hi'})
+        self.assertEqual(403, response.status_code)
+
+    async def test_ratelimited(self):
+        """Test requests over the rate are answered with 429."""
+        with mock.patch('core.rates.is_ratelimited', mock.AsyncMock(return_value=True)):
+            response = await AsyncClient().get('/bot/test/', {'question': 'Hi'})
+        self.assertEqual(429, response.status_code)
+
+
+class TestOpenAILimits(TestCase):
+    """Test the rate limits per OpenAI key and model."""
+
+    @override_settings(OPENAI_RATE_LIMITS={'gpt-4': '200/40000'}, OPENAI_DEFAULT_RATE_LIMIT='3500/90000')
+    def test_limits_per_model(self):
+        """Test models without own limits use the default."""
+        self.assertEqual((200, 40000), limits.get_limits('gpt-4'))
+        self.assertEqual((3500, 90000), limits.get_limits('gpt-3.5-turbo'))
+
+    @override_settings(REDIS_URL='redis://redis:6379', OPENAI_RATE_LIMIT_WAIT=0)
+    def test_capacity_exceeded(self):
+        """Test a key without capacity fails instead of waiting past the limit, counted under its own keys."""
+        redis = mock.Mock(eval=mock.AsyncMock(return_value=0))
+        with mock.patch('chatbot.limits.get_redis', return_value=redis):
+            with self.assertRaises(limits.CapacityExceeded):
+                asyncio.run(limits.acquire('sk-secret', 'gpt-4', 1000))
+            redis.eval.return_value = 1
+            asyncio.run(limits.acquire('sk-other', 'gpt-4', 1000))
+
+        first, second = [call.args[2] for call in redis.eval.call_args_list]
+        self.assertNotEqual(first, second)
+        self.assertNotIn('sk-secret', first)
+        self.assertIn(':gpt-4:', first)
+
+
+@override_settings(REDIS_URL='')
+class TestSingleFlight(TestCase):
+    """Test coalescing of identical questions."""
+
+    def setUp(self):
+        """Create a public bot that answers without context."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        Chatbot.objects.create(
+            slug='test', name='Test', realm=realm, openai_key='', prompt_template='',
+            public=True, restricted=False, skip_context=True,
+        )
+        forget_chatbot('test')
+
+    def test_followers_get_result(self):
+        """Test followers wait for the result of the leader and only the leader may publish it."""
+        flights = SingleFlight('test_flight', timeout=5)
+
+        async def run():
+            leader = await flights.join('key')
+            follower = asyncio.ensure_future(flights.join('key'))
+            await asyncio.sleep(0)
+            await flights.done(await flights.join('other'), b'other')
+            await flights.done(leader, b'42')
+            await flights.done(leader, b'43')
+            return leader, await follower
+
+        leader, follower = asyncio.run(run())
+        self.assertTrue(leader.leader)
+        self.assertIsNone(leader.result)
+        self.assertFalse(follower.leader)
+        self.assertEqual(b'42', follower.result)
+
+    async def test_identical_questions_answered_once(self):
+        """Test concurrent identical questions only generate one completion."""
+        calls = []
+
+        async def fake_completion(*args):
+            calls.append(args)
+            await asyncio.sleep(0.1)
+            return 'Hello'
+
+        with mock.patch('chatbot.views.generate_completion', fake_completion):
+            responses = await asyncio.gather(
+                AsyncClient().get('/bot/test/', {'question': 'Hi there'}),
+                AsyncClient().get('/bot/test/', {'question': 'hi there?'}),
+            )
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(['Hello', 'Hello'], [response.json()['answer'] for response in responses])
+
+    async def test_abandoned_leader_expires(self):
+        """Test a leader that never calls done is given up after the timeout."""
+        flights = SingleFlight('test_flight', timeout=0.05)
+        await flights.join('key')
+        await asyncio.sleep(0.1)
+
+        flight = await flights.join('key')
+        self.assertTrue(flight.leader)
+
+    async def test_unread_stream_releases_flight(self):
+        """Test closing a streamed answer that was never sent hands its flight on."""
+        flight = await answer_flights.join('unread')
+
+        async def events():
+            yield 'never sent'
+
+        _FlightStream(events(), flight).close()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertTrue(flight.future.done())
+        self.assertNotIn('unread', answer_flights._leading)
+
+    @override_settings(REDIS_URL='redis://redis:6379')
+    async def test_followers_share_subscription(self):
+        """Test followers of a leader in another process wait on one subscription."""
+        flights = SingleFlight('test_flight', timeout=5)
+        redis = mock.Mock(set=mock.AsyncMock(return_value=False))
+
+        async def follow(key):
+            await asyncio.sleep(0.05)
+            return b'42'
+
+        with mock.patch('chatbot.singleflight.get_redis', return_value=redis), \
+                mock.patch.object(flights, '_follow', side_effect=follow) as subscribe:
+            results = await asyncio.gather(*[flights.join('key') for _ in range(3)])
+
+        self.assertEqual([b'42'] * 3, [flight.result for flight in results])
+        self.assertEqual(1, subscribe.call_count)
+        self.assertEqual(1, redis.set.await_count)
+
+
+@override_settings(REDIS_URL='')
+class TestModeration(TestCase):
+    """Test moderation running next to retrieval."""
+
+    def setUp(self):
+        """Create a restricted bot."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        Chatbot.objects.create(
+            slug='test', name='Test', realm=realm, openai_key='', prompt_template='',
+            public=True, restricted=True, skip_context=True,
+        )
+        forget_chatbot('test')
+        moderation_verdicts.clear_local()
+
+    async def test_flagged_cancels_retrieval(self):
+        """Test retrieval is cancelled for flagged questions and verdicts are cached."""
+        cancelled = []
+
+        async def slow_retrieve(*args):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(args)
+                raise
+
+        moderation = mock.AsyncMock(return_value={'results': [{'flagged': True}]})
+        with mock.patch('openai.Moderation.acreate', moderation), \
+                mock.patch('chatbot.views._retrieve', slow_retrieve):
+            first = await AsyncClient().get('/bot/test/', {'question': 'Bad words'})
+            second = await AsyncClient().get('/bot/test/', {'question': 'bad words!'})
+
+        self.assertEqual([451, 451], [first.status_code, second.status_code])
+        self.assertEqual(1, moderation.await_count)
+        self.assertEqual(2, len(cancelled))
+
+
+class TestPromptContext(TestCase):
+    """Test packing texts into the context."""
+
+    def setUp(self):
+        """Create texts with known token counts."""
+        realm = Realm.objects.create(slug='test', openai_key='')
+        self.texts = [Text(id=pk, realm=realm, content=f'text {pk}', token_count=10) for pk in (1, 2, 3)]
+
+    def test_stored_counts_used(self):
+        """Test texts are added while their stored counts fit, without tokenizing them."""
+        with mock.patch('chatbot.services.count_tokens') as count:
+            context = _format_context(self.texts, 35)
+        count.assert_not_called()
+        self.assertEqual('[1] text 1\n[2] text 2\n', context)
+
+    def test_truncate_last_text(self):
+        """Test the last text is cut to the remaining tokens if enabled."""
+        with mock.patch('chatbot.services.truncate_tokens', return_value='te') as truncate:
+            context = _format_context(self.texts, 38, truncate=True)
+        truncate.assert_called_once_with('text 3', 6, None)
+        self.assertEqual('[1] text 1\n[2] text 2\n[3] te\n', context)
+
+    def test_count_on_save(self):
+        """Test the token count is stored when a text is saved."""
+        text = Text.objects.create(realm=Realm.objects.get(slug='test'), content='some text')
+        self.assertEqual(count_tokens('some text'), Text.objects.get(pk=text.pk).token_count)
+
+
+class TestTokenizer(TestCase):
+    """Test the tokenizer service."""
+
+    def setUp(self):
+        """Start without memoized counts."""
+        tokenizer.counts.clear()
+
+    def test_batch_matches_single(self):
+        """Test counting a batch gives the counts of the single texts."""
+        texts = ['Hello world.', 'A longer sentence with more tokens in it.', 'Hello world.']
+        self.assertEqual([count_tokens(text, memoize=False) for text in texts], tokenizer.count_tokens_batch(texts))
+
+    def test_memoized(self):
+        """Test repeated strings are only tokenized once and long or unmemoized ones never stored."""
+        encoding = tokenizer.get_encoding()
+        with mock.patch.object(encoding, 'encode_batch', wraps=encoding.encode_batch) as encode:
+            tokenizer.count_tokens_batch(['one two', 'three'])
+            tokenizer.count_tokens_batch(['one two', 'three', 'four'])
+            tokenizer.count_tokens('five', memoize=False)
+            with override_settings(TOKEN_COUNT_CACHE_MAX_LENGTH=3):
+                tokenizer.count_tokens('six seven')
+
+        self.assertEqual([['one two', 'three'], ['four'], ['five'], ['six seven']],
+                         [call.args[0] for call in encode.call_args_list])
+        self.assertIsNone(tokenizer.counts.get((encoding.name, 'five')))
+        self.assertIsNone(tokenizer.counts.get((encoding.name, 'six seven')))
+
+
+class TestPipeline(TestCase):
+    """Test the staged pipeline."""
+
+    def test_stages(self):
+        """Test every item passes all stages and is counted."""
+        results = []
+        pipeline = Pipeline(
+            [Stage('double', lambda batch: [x * 2 for x in batch], workers=3), Stage('collect', results.append)],
+            queue_size=1,
+        )
+        stats = pipeline.run([[i, i] for i in range(20)])
+
+        self.assertEqual(sorted([i * 2, i * 2] for i in range(20)), sorted(results))
+        self.assertEqual([20, 20], [stage.items for stage in stats])
+        self.assertEqual([40, 40], [stage.texts for stage in stats])
+
+    def test_error_stops_pipeline(self):
+        """Test the first error of a stage is raised and stops the others."""
+        def fail(batch):
+            if batch[0] == 3:
+                raise ValueError('broken')
+            return batch
+
+        seen = []
+        pipeline = Pipeline([Stage('fail', fail), Stage('collect', seen.append)], queue_size=1)
+        with self.assertRaisesMessage(ValueError, 'broken'):
+            pipeline.run([i] for i in range(1000))
+        self.assertLess(len(seen), 1000)
+
+
+class TestIndexRealm(TransactionTestCase):
+    """Test indexing a realm with the local backend."""
+
+    def setUp(self):
+        """Use a temporary directory for the collections."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(LOCAL_VECTOR_ROOT=self.tmp.name)
+        self.settings.enable()
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def test_index_realm(self):
+        """Test all texts are embedded, inserted and marked as indexed."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(25)])
+
+        def fake_embedding(texts, *args):
+            return np.random.default_rng(len(texts)).normal(size=(len(texts), 8)).astype(np.float32)
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=fake_embedding):
+            stats = index_realm('test', batch_size=10, concurrency=2)
+
+        self.assertEqual([3, 3, 3], [stage.items for stage in stats])
+        self.assertFalse(Text.objects.filter(indexed=False).exists())
+        self.assertEqual(25, LocalBackend().count('test'))
+
+    def _fake_embedding(self, texts, *args):
+        return np.random.default_rng(len(texts)).normal(size=(len(texts), 8)).astype(np.float32)
+
+    def test_backfill_token_counts(self):
+        """Test texts indexed before token counts were stored get one."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}', indexed=True) for i in range(5)])
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding):
+            index_realm('test', batch_size=2)
+
+        self.assertEqual([count_tokens('text 0')] * 5, list(Text.objects.values_list('token_count', flat=True)))
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_distributed(self):
+        """Test the shards of a job are indexed by tasks and the job finishes."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(25)])
+
+        job = create_index_job('test', shard_size=10)
+        self.assertEqual([10, 10, 5], list(job.shards.order_by('first_id').values_list('text_count', flat=True)))
+        with self.assertRaises(ValueError):
+            create_index_job('test')
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding):
+            dispatch_index_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(IndexJob.Status.DONE, job.status)
+        self.assertEqual((3, 25), (job.finished_shards, job.indexed_count))
+        self.assertFalse(Text.objects.filter(indexed=False).exists())
+        self.assertEqual(25, LocalBackend().count('test'))
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_retry_skipped_shards(self):
+        """Test retrying a failed job also queues the shards that were skipped while it had failed."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(10)])
+        job = create_index_job('test', shard_size=5)
+        failed, skipped = job.shards.order_by('first_id')
+
+        fail_index_shard(failed.pk, RuntimeError('unavailable'))
+        self.assertFalse(run_index_shard(skipped.pk))
+        self.assertEqual(IndexShard.Status.PENDING, IndexShard.objects.get(pk=skipped.pk).status)
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding):
+            call_command('index_realm', 'test', '--retry_failed', stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual((IndexJob.Status.DONE, 2, 10), (job.status, job.finished_shards, job.indexed_count))
+        self.assertEqual(10, LocalBackend().count('test'))
+
+    def test_shard_rerun(self):
+        """Test a shard delivered twice is only counted and inserted once."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(5)])
+        job = create_index_job('test')
+        shard = job.shards.get()
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding) as embed:
+            self.assertTrue(run_index_shard(shard.pk))
+            self.assertFalse(run_index_shard(shard.pk))
+        self.assertEqual(1, embed.call_count)
+
+        job.refresh_from_db()
+        self.assertEqual((IndexJob.Status.BUILDING, 1), (job.status, job.finished_shards))
+        self.assertEqual(IndexShard.Status.DONE, IndexShard.objects.get(pk=shard.pk).status)
+        self.assertEqual(5, LocalBackend().count('test'))
+
+    @override_settings(REDIS_URL='', CELERY_TASK_ALWAYS_EAGER=True)
+    def test_sync_edits(self):
+        """Test edited texts are embedded again and deleted texts are removed from the index."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(5)])
+        backend = LocalBackend()
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding) as embed:
+            index_realm('test', batch_size=10)
+            edited, deleted = Text.objects.order_by('id')[:2]
+            deleted_pk = deleted.pk
+            edited.content = 'changed'
+            edited.save()
+            deleted.delete()
+            # Saving only the indexed flag doesn't embed the text again
+            Text.objects.get(pk=edited.pk).save(update_fields=['indexed'])
+
+        self.assertEqual(['changed'], embed.call_args_list[-1].args[0])
+        self.assertEqual(2, embed.call_count)
+        self.assertEqual(4, backend.count('test'))
+        self.assertEqual({edited.pk}, backend.existing_ids('test', [edited.pk, deleted_pk]))
+
+    @override_settings(REDIS_URL='', CELERY_TASK_ALWAYS_EAGER=True)
+    def test_delete_realm(self):
+        """Test texts deleted with their realm aren't synced and syncs of a deleted realm aren't retried."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(5)])
+        realm_id = realm.pk
+        LocalBackend().create('test', 8)
+
+        with mock.patch('chatbot.signals.queue_text_sync') as queue:
+            realm.delete()
+        queue.assert_not_called()
+        self.assertFalse(LocalBackend().exists('test'))
+
+        with mock.patch('chatbot.tasks.sync_realm_texts.retry') as retry:
+            sync_realm_texts.delay(realm_id, [1])
+        retry.assert_not_called()
+
+    def test_sync_receivers(self):
+        """Test texts are only synced with TEXT_SYNC, which keeps fast deletes otherwise."""
+        self.assertTrue(post_delete.has_listeners(Text))
+        with override_settings(TEXT_SYNC=False, TEXT_CACHE_TIMEOUT=0):
+            self.assertFalse(post_delete.has_listeners(Text))
+        self.assertTrue(post_delete.has_listeners(Text))
+
+    @override_settings(REDIS_URL='')
+    def test_sync_broker_error(self):
+        """Test an unavailable broker doesn't fail a committed edit."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        with mock.patch('chatbot.tasks.sync_realm_texts.delay', side_effect=ConnectionError) as delay:
+            Text.objects.create(realm=realm, content='text')
+        delay.assert_called_once()
+
+    def test_resume(self):
+        """Test running an interrupted job again only embeds the texts missing from the backend."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(25)])
+        job = IndexJob.objects.create(realm=realm, status=IndexJob.Status.FAILED, error='killed')
+
+        # The run inserted 19 texts without marking them, the last text is marked without an entry
+        ids = list(Text.objects.order_by('id').values_list('id', flat=True))
+        backend = LocalBackend()
+        backend.create('test', 8)
+        backend.insert('test', ids[:19], self._fake_embedding(ids[:19]))
+        Text.objects.filter(pk=ids[-1]).update(indexed=True)
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding) as embed:
+            index_realm('test', batch_size=10)
+        self.assertEqual([6], [len(call.args[0]) for call in embed.call_args_list])
+
+        job.refresh_from_db()
+        self.assertEqual((IndexJob.Status.DONE, 25, 25), (job.status, job.indexed_count, job.text_count))
+        self.assertEqual(ids[-1], job.checkpoint_id)
+        self.assertEqual(1, IndexJob.objects.count())
+        self.assertFalse(Text.objects.filter(indexed=False).exists())
+        self.assertEqual(25, backend.count('test'))
+
+    def test_new_job_skips_reconcile(self):
+        """Test a new job doesn't look up texts in the backend and records the last id."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(5)])
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding), \
+                mock.patch('chatbot.services.reconcile_texts') as reconcile:
+            index_realm('test', batch_size=2)
+        reconcile.assert_not_called()
+
+        job = IndexJob.objects.get()
+        last_id = Text.objects.order_by('-id').values_list('id', flat=True).first()
+        self.assertEqual((IndexJob.Status.DONE, last_id, last_id), (job.status, job.last_id, job.checkpoint_id))
+
+    def test_stale_job_taken_over(self):
+        """Test a job without a heartbeat is taken over while a live one blocks new runs."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(5)])
+        job = IndexJob.objects.create(realm=realm, distributed=True)
+
+        with self.assertRaises(ValueError):
+            index_realm('test')
+
+        IndexJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        with mock.patch('chatbot.services.batch_embedding', side_effect=self._fake_embedding):
+            index_realm('test', batch_size=2)
+
+        job.refresh_from_db()
+        self.assertEqual(IndexJob.Status.FAILED, job.status)
+        self.assertEqual(IndexJob.Status.DONE, IndexJob.objects.exclude(pk=job.pk).get().status)
+        self.assertEqual(5, LocalBackend().count('test'))
+
+    def test_checkpoint_contiguous(self):
+        """Test the checkpoint doesn't move past a batch that is still being embedded."""
+        realm = Realm.objects.create(slug='test', openai_key='', embedding_dim=8, vector_backend=Realm.Backend.LOCAL)
+        Text.objects.bulk_create([Text(realm=realm, content=f'text {i}') for i in range(6)])
+        ids = list(Text.objects.order_by('id').values_list('id', flat=True))
+        job = IndexJob.objects.create(realm=realm)
+        LocalBackend().create('test', 8)
+        checkpoints = []
+
+        def embed(texts, *args):
+            if texts == ['text 0', 'text 1']:
+                # The first batch finishes after the others are marked
+                deadline = time.monotonic() + 5
+                while Text.objects.filter(pk=ids[-1], indexed=False).exists() and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                checkpoints.append(IndexJob.objects.get(pk=job.pk).checkpoint_id)
+            return self._fake_embedding(texts)
+
+        with mock.patch('chatbot.services.batch_embedding', side_effect=embed):
+            _index_texts(realm, Text.objects.filter(realm=realm), 2, concurrency=3, job=job)
+
+        job.refresh_from_db()
+        self.assertEqual([None], checkpoints)
+        self.assertEqual((ids[-1], 6), (job.checkpoint_id, job.indexed_count))
@@ -0,0 +1,150 @@
+"""Token counting for the models of the chatbots.
+
+Encodings are loaded on first use. tiktoken provides the encoding of the model; if it
+isn't installed or its encoding can't be loaded, the fast GPT-2 tokenizer of transformers
+is used instead. Counts of repeated strings are memoized per process.
+"""
+import functools
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    import tiktoken.model
+except ImportError:  # pragma: no cover
+    tiktoken = None
+
+# Encoding of the chat and embedding models, used for models tiktoken doesn't know
+DEFAULT_ENCODING = 'cl100k_base'
+
+
+class Encoding:
+    """Encode and decode texts with tiktoken or a transformers tokenizer."""
+
+    def __init__(self, name: str, backend: Any, is_tiktoken: bool) -> None:
+        """Wrap the loaded backend."""
+        self.name = name
+        self._backend = backend
+        self._is_tiktoken = is_tiktoken
+
+    def encode(self, text: str) -> List[int]:
+        """Return the tokens of the text."""
+        if self._is_tiktoken:
+            return self._backend.encode(text, disallowed_special=())
+        return self._backend(text)['input_ids']
+
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        """Return the tokens of each text, tokenized in one call."""
+        if not texts:
+            return []
+        if self._is_tiktoken:
+            return self._backend.encode_batch(list(texts), disallowed_special=())
+        return self._backend(list(texts))['input_ids']
+
+    def decode(self, tokens: List[int]) -> str:
+        """Return the text of the tokens."""
+        return self._backend.decode(tokens)
+
+
+def _encoding_name(model: str) -> str:
+    """Look up the name of the encoding of the model without loading it."""
+    if tiktoken is None:
+        return 'gpt2'
+    if model in tiktoken.model.MODEL_TO_ENCODING:
+        return tiktoken.model.MODEL_TO_ENCODING[model]
+    for prefix, name in getattr(tiktoken.model, 'MODEL_PREFIX_TO_ENCODING', {}).items():
+        if model.startswith(prefix):
+            return name
+    return DEFAULT_ENCODING
+
+
+@functools.lru_cache(maxsize=None)
+def _load(name: str) -> Encoding:
+    """Load the encoding with the given name, once per process."""
+    if tiktoken is not None and name != 'gpt2':
+        try:
+            return Encoding(name, tiktoken.get_encoding(name), is_tiktoken=True)
+        except Exception as e:
+            logger.warning("Couldn't load encoding %s, falling back to GPT-2: %s", name, e)
+
+    from transformers import GPT2TokenizerFast
+    return Encoding('gpt2', GPT2TokenizerFast.from_pretrained('gpt2'), is_tiktoken=False)
+
+
+def get_encoding(model: Optional[str] = None) -> Encoding:
+    """Return the encoding of the model, TOKENIZER_DEFAULT_MODEL if none is given."""
+    return _load(_encoding_name(model or settings.TOKENIZER_DEFAULT_MODEL))
+
+
+class CountCache:
+    """LRU of token counts by encoding and text."""
+
+    def __init__(self, maxsize: int) -> None:
+        """Create an empty cache."""
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._counts: OrderedDict[Tuple[str, str], int] = OrderedDict()
+
+    def get(self, key: Tuple[str, str]) -> Optional[int]:
+        """Return the count or None."""
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+            return count
+
+    def set(self, key: Tuple[str, str], count: int) -> None:
+        """Store the count."""
+        with self._lock:
+            self._counts[key] = count
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+
+    def clear(self) -> None:
+        """Forget all counts."""
+        with self._lock:
+            self._counts.clear()
+
+
+counts = CountCache(settings.TOKEN_COUNT_CACHE_SIZE)
+
+
+def count_tokens(text: str, model: Optional[str] = None, memoize: bool = True) -> int:
+    """Count the tokens of the text in the encoding of the model."""
+    return count_tokens_batch([text], model, memoize)[0]
+
+
+def count_tokens_batch(texts: Sequence[str], model: Optional[str] = None, memoize: bool = True) -> List[int]:
+    """Count the tokens of every text, tokenizing the ones not counted before in one batch.
+
+    Texts that are counted once, like imported texts, should pass memoize=False to keep
+    them out of the memory of the process. Texts longer than TOKEN_COUNT_CACHE_MAX_LENGTH
+    characters are never memoized.
+    """
+    encoding = get_encoding(model)
+    max_length = settings.TOKEN_COUNT_CACHE_MAX_LENGTH
+    result: List[Optional[int]] = [
+        counts.get((encoding.name, text)) if memoize and len(text) <= max_length else None for text in texts
+    ]
+    missing = list(dict.fromkeys(text for text, count in zip(texts, result) if count is None))
+
+    computed = {text: len(tokens) for text, tokens in zip(missing, encoding.encode_batch(missing))}
+    if memoize:
+        for text, count in computed.items():
+            if len(text) <= max_length:
+                counts.set((encoding.name, text), count)
+
+    return [count if count is not None else computed[text] for text, count in zip(texts, result)]
+
+
+def truncate_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """Cut the text after the given number of tokens."""
+    encoding = get_encoding(model)
+    return encoding.decode(encoding.encode(text)[:max_tokens])
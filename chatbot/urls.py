@@ -8,6 +8,7 @@ from chatbot.views import (
     autocomplete_questions,
     bot_endpoint,
     bot_name,
+    metrics_view,
     readme,
 )
 
@@ -20,6 +21,7 @@ urlpatterns = [
     path("bot/<slug:slug>/", bot_endpoint, name="chatbot"),
     path("bot/<slug:slug>/name/", bot_name, name="chatbot-name"),
     path("questions/", autocomplete_questions, name="question-autocomplete"),
+    path("metrics/", metrics_view, name="metrics"),
     path("api/questions/<slug:slug>/", QuestionGlobalViewSet.as_view({"get": "list"})),
     path("", readme, name="readme"),
 ]
@@ -1,9 +1,15 @@
 """Views to access the chabot functionality."""
+import asyncio
+import json
+import logging
+import os
 import pathlib
-from typing import Optional
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, List, Optional, Tuple
 
 import markdown
-from asgiref.sync import async_to_sync, sync_to_async
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.exceptions import PermissionDenied
 from django.http import (
     Http404,
@@ -11,44 +17,53 @@ from django.http import (
     HttpResponse,
     HttpResponseBadRequest,
     JsonResponse,
+    StreamingHttpResponse,
 )
-from django.views.decorators.cache import cache_page
-from django.views.decorators.csrf import csrf_exempt
-from django_ratelimit.decorators import ratelimit
+from django.http.response import HttpResponseBase
 from pygments.formatters import HtmlFormatter
 
-from chatbot.completion import generate_completion
-from chatbot.models import Chatbot
+from chatbot import metrics
+from chatbot.collections import loaded_collections
+from chatbot.completion import generate_completion, stream_completion
+from chatbot.limits import CapacityExceeded
+from chatbot.models import Chatbot, Question, Text
+from chatbot.singleflight import Flight
 from chatbot.services import (
+    TEXT_FIELDS,
+    answer_flight_key,
+    answer_flights,
+    embed_question,
     find_question,
+    find_similar_question,
     find_texts,
     generate_prompt_context,
+    get_chatbot,
     is_input_flagged,
+    search_filter,
     similair_questions,
     store_question,
 )
 from core import rates
+from core.auth import aget_user
+from core.rates import aratelimit
 
+logger = logging.getLogger(__name__)
 
-@sync_to_async
-@ratelimit(key="user_or_ip", rate=rates.get_ratelimit)
-@csrf_exempt
-@async_to_sync
-async def bot_endpoint(request: HttpRequest, slug: str) -> HttpResponse:
-    """View to ask questions."""
-    chatbot: Optional[Chatbot] = await Chatbot.objects.filter(slug=slug).afirst()
+
+@aratelimit(rate=rates.get_ratelimit)
+async def bot_endpoint(request: HttpRequest, slug: str) -> HttpResponseBase:
+    """View to ask questions.
+
+    With ``stream=1`` the response is a stream of server-sent events: ``sources`` with the
+    texts used as context, ``token`` for every part of the answer as it is generated and
+    ``done`` with the complete answer (or ``error``).
+    """
+    chatbot = await get_chatbot(slug)
 
     if chatbot is None:
         raise Http404("Chatbot not found")
 
-    if not chatbot.public:
-        if await sync_to_async(lambda: request.user.is_anonymous)():
-            raise PermissionDenied("You need to log in to use this bot.")
-
-        if await sync_to_async(lambda chatbot: request.user not in chatbot.users.all())(
-            chatbot
-        ):
-            raise PermissionDenied("You are not allowed to use this bot.")
+    await _check_access(request, chatbot)
 
     question = request.GET.get("question", None)
 
@@ -57,67 +72,208 @@ async def bot_endpoint(request: HttpRequest, slug: str) -> HttpResponse:
 
     question = question.strip()[:200]
 
-    if await is_input_flagged(question, chatbot):
-        return HttpResponse("The question was flagged as inappropriate", status=451)
-
-    if existing_answer := await find_question(question, chatbot):
-        answer = existing_answer.answer
-
-        text_list = [
-            {
-                "id": text.id,
-                "content": text.content,
-                "url": text.url,
-                "page": text.page,
-            }
-            async for text in existing_answer.context.filter(internal=False)
-        ]
-
-        existing_answer.count += 1
-        await sync_to_async(existing_answer.save)()
-
-        return JsonResponse(
-            {
-                "answer": answer,
-                "texts": text_list,
-            }
-        )
-
-    if chatbot.skip_context:
-        texts = []
-        context = ""
-    else:
-        texts = await find_texts(
-            question, await sync_to_async(lambda chatbot: chatbot.realm)(chatbot)
-        )
-
-        context = generate_prompt_context(question, texts, chatbot)
-
-    answer = await generate_completion(
-        chatbot.prompt_template, context, question, chatbot
+    stream = request.GET.get("stream", "") not in ("", "0", "false")
+
+    # Moderation, the answer lookup and retrieval run concurrently, the speculative work is
+    # dropped if the question is flagged or answered without it
+    moderation = asyncio.ensure_future(is_input_flagged(question, chatbot))
+    lookup = asyncio.ensure_future(find_question(question, chatbot))
+    retrieval = asyncio.ensure_future(_retrieve(question, chatbot))
+    try:
+        if await moderation:
+            return HttpResponse("The question was flagged as inappropriate", status=451)
+
+        existing_answer = await lookup
+        if existing_answer is not None:
+            return await _cached_answer_response(existing_answer, stream)
+
+        # Identical questions asked while the answer is generated wait for it instead of generating their own
+        flight = await answer_flights.join(answer_flight_key(question, chatbot))
+        if flight.result is not None:
+            if (leader_answer := await Question.objects.filter(pk=int(flight.result)).afirst()) is not None:
+                return await _cached_answer_response(leader_answer, stream)
+
+        try:
+            return await _answer(question, chatbot, stream, flight, retrieval)
+        except BaseException:
+            await answer_flights.done(flight, None)
+            raise
+    finally:
+        _discard(moderation, lookup, retrieval)
+
+
+# csrf_exempt() of Django 4.2 wraps async views in a sync function, so set its marker directly
+bot_endpoint.csrf_exempt = True  # type: ignore[attr-defined]
+
+
+Retrieval = Tuple[Optional[np.ndarray], List[Text]]
+
+
+def _discard(*tasks: asyncio.Future) -> None:
+    """Cancel tasks that are no longer needed and ignore errors of finished ones."""
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()
+
+
+async def _retrieve(question: str, chatbot: Chatbot) -> Retrieval:
+    """Embed the question if needed for the answer cache or the context and find the texts of the context."""
+    embedding = None
+    if not chatbot.skip_context or chatbot.answer_cache_distance:
+        embedding = await embed_question(question, chatbot.realm)
+
+    texts: List[Text] = []
+    if not chatbot.skip_context:
+        texts = await find_texts(question, chatbot.realm, embedding, search_filter(chatbot))
+    return embedding, texts
+
+
+async def _answer(
+    question: str, chatbot: Chatbot, stream: bool, flight: Flight, retrieval: "asyncio.Future[Retrieval]"
+) -> HttpResponseBase:
+    """Answer a new question and hand the stored question to the requests waiting on the flight."""
+    embedding, texts = await retrieval
+
+    if similar_question := await find_similar_question(embedding, chatbot):
+        await answer_flights.done(flight, str(similar_question.pk).encode())
+        return await _cached_answer_response(similar_question, stream)
+
+    context = "" if chatbot.skip_context else generate_prompt_context(question, texts, chatbot)
+
+    if stream:
+        events = _stream_answer(question, texts, context, chatbot, embedding, flight)
+        return _event_stream(_FlightStream(events, flight))
+
+    try:
+        answer = await generate_completion(chatbot.prompt_template, context, question, chatbot)
+    except CapacityExceeded:
+        await answer_flights.done(flight, None)
+        return HttpResponse("The bot is busy, please try again later.", status=429)
+
+    question_obj = await store_question(question, answer, chatbot.prompt_template, texts, chatbot, embedding)
+    await answer_flights.done(flight, str(question_obj.pk).encode())
+
+    return JsonResponse(
+        {
+            "answer": answer,
+            "texts": _text_data(texts),
+        }
     )
 
-    await store_question(question, answer, chatbot.prompt_template, texts, chatbot)
 
-    text_list = [
+async def _check_access(request: HttpRequest, chatbot: Chatbot) -> None:
+    """Raise PermissionDenied if the user of the request may not use the bot."""
+    if chatbot.public:
+        return
+
+    user = await aget_user(request)
+    if user.is_anonymous:
+        raise PermissionDenied("You need to log in to use this bot.")
+
+    if not await chatbot.users.filter(pk=user.pk).aexists():
+        raise PermissionDenied("You are not allowed to use this bot.")
+
+
+def _text_data(texts: Iterable[Text]) -> List[Dict[str, Any]]:
+    """Represent the texts that may be shown to users."""
+    return [
         {
             "id": text.pk,
             "content": text.content,
             "url": text.url,
             "page": text.page,
+            "distance": getattr(text, "distance", None),
         }
         for text in texts
         if not text.internal
     ]
 
+
+async def _cached_answer_response(existing_answer: Question, stream: bool = False) -> HttpResponseBase:
+    """Respond with the stored answer and context of a question and count it as asked again."""
+    texts = [text async for text in existing_answer.context.filter(internal=False).only(*TEXT_FIELDS)]
+
+    existing_answer.count += 1
+    await sync_to_async(existing_answer.save)()
+
+    if stream:
+        return _event_stream(_stream_cached_answer(existing_answer.answer, texts))
+
     return JsonResponse(
         {
-            "answer": answer,
-            "texts": text_list,
+            "answer": existing_answer.answer,
+            "texts": _text_data(texts),
         }
     )
 
 
+def _sse(event: str, data: Any) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _event_stream(events: AsyncIterable[str]) -> StreamingHttpResponse:
+    """Respond with a stream of server-sent events."""
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+class _FlightStream:
+    """Events of a new answer whose flight is handed on when the response is closed, also if it was never iterated."""
+
+    def __init__(self, events: AsyncIterator[str], flight: Flight) -> None:
+        """Wrap the events."""
+        self._events = events
+        self._flight = flight
+        self._loop = asyncio.get_running_loop()
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        """Iterate the wrapped events."""
+        return self._events
+
+    def close(self) -> None:
+        """Release the flight if the events didn't, Django calls this from a thread after the response."""
+        if not self._loop.is_closed():
+            asyncio.run_coroutine_threadsafe(answer_flights.done(self._flight, None), self._loop)
+
+
+async def _stream_cached_answer(answer: str, texts: List[Text]) -> AsyncIterator[str]:
+    """Send a stored answer in the same events as a generated one."""
+    yield _sse("sources", _text_data(texts))
+    yield _sse("token", {"content": answer})
+    yield _sse("done", {"answer": answer})
+
+
+async def _stream_answer(
+    question: str, texts: List[Text], context: str, chatbot: Chatbot, embedding: Optional[np.ndarray], flight: Flight
+) -> AsyncIterator[str]:
+    """Send the sources, then the answer while it is generated, and store it once complete."""
+    question_id = None
+    try:
+        yield _sse("sources", _text_data(texts))
+
+        parts = []
+        try:
+            async for part in stream_completion(chatbot.prompt_template, context, question, chatbot):
+                parts.append(part)
+                yield _sse("token", {"content": part})
+        except Exception:
+            logger.exception("Streaming the answer of %s failed", chatbot.slug)
+            yield _sse("error", {"message": "The answer couldn't be generated."})
+            return
+
+        answer = "".join(parts)
+        question_obj = await store_question(question, answer, chatbot.prompt_template, texts, chatbot, embedding)
+        question_id = str(question_obj.pk).encode()
+        yield _sse("done", {"answer": answer})
+    finally:
+        await answer_flights.done(flight, question_id)
+
+
 async def autocomplete_questions(request: HttpRequest) -> HttpResponse:
     question = request.GET.get("q", "").strip()
     return JsonResponse(
@@ -127,12 +283,9 @@ async def autocomplete_questions(request: HttpRequest) -> HttpResponse:
     )
 
 
-@sync_to_async
-@cache_page(60 * 10)
-@async_to_sync
 async def bot_name(request: HttpRequest, slug: str) -> HttpResponse:
     """Get name of chatbot."""
-    chatbot = await Chatbot.objects.filter(slug=slug).afirst()
+    chatbot = await get_chatbot(slug)
 
     if chatbot is None:
         raise Http404("Chatbot not found.")
@@ -140,6 +293,19 @@ async def bot_name(request: HttpRequest, slug: str) -> HttpResponse:
     return JsonResponse({"name": chatbot.name})
 
 
+@staff_member_required
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """Show the counters of the worker process that handles the request."""
+    return JsonResponse(
+        {
+            "pid": os.getpid(),
+            "counters": metrics.snapshot(),
+            "hit_rates": metrics.hit_rates(),
+            "milvus": loaded_collections.stats(),
+        }
+    )
+
+
 def readme(request: HttpRequest) -> HttpResponse:
     """Render the README.MD as index view."""
     path = pathlib.Path(__file__).parent.resolve() / "../README.md"
@@ -1,2 +1,4 @@
+"""Django project, loading the Celery app with it so tasks use it."""
+from core.celery import app as celery_app
 
-
+__all__ = ("celery_app",)
@@ -0,0 +1,23 @@
+"""Authentication helpers for async views."""
+from typing import Union
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.contrib.auth.base_user import AbstractBaseUser
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpRequest
+
+
+async def aget_user(request: HttpRequest) -> Union[AbstractBaseUser, AnonymousUser]:
+    """Resolve the user of the request and store it on ``request.user``.
+
+    Requests without a session cookie are anonymous, so they are answered without
+    touching the session store. Afterwards ``request.user`` is safe to use in async code.
+    """
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        user: Union[AbstractBaseUser, AnonymousUser] = AnonymousUser()
+    else:
+        user = await sync_to_async(get_user)(request)
+    request.user = user
+    return user
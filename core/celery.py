@@ -1,2 +1,10 @@
+"""Celery app running background tasks like distributed indexing."""
+import os
 
+from celery import Celery
 
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+
+app = Celery("core")
+app.config_from_object("django.conf:settings", namespace="CELERY")
+app.autodiscover_tasks()
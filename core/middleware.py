@@ -0,0 +1,40 @@
+"""Middleware usable by async views."""
+from typing import Any
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.http import HttpRequest, HttpResponse
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise that keeps async requests in the event loop.
+
+    Sync-only middleware makes Django run the rest of the chain for every request in
+    its single thread for sync code, which serializes all async views behind it. Static
+    files are served in a thread, everything else is passed on directly.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response: Any = None, *args: Any, **kwargs: Any) -> None:
+        """Mark the middleware as async if the rest of the chain is."""
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest) -> Any:
+        """Serve static files or pass the request on."""
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Serve static files or pass the request on, without leaving the event loop for the latter."""
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
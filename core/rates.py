@@ -1,8 +1,25 @@
 """Rate limiting."""
+import functools
+import logging
+import re
+import time
+from typing import Any, Callable, Coroutine, Tuple
 
 from django.conf import settings
 from django.http import HttpRequest
-from redis.asyncio import Redis as AsyncRedis    # pip install redis
+from django.http.response import HttpResponseBase
+from django_ratelimit.core import user_or_ip
+from django_ratelimit.exceptions import Ratelimited
+from redis.exceptions import RedisError
+
+from core.auth import aget_user
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+AsyncView = Callable[..., Coroutine[Any, Any, HttpResponseBase]]
 
 
 def get_ratelimit(group: str, request: HttpRequest) -> str:
@@ -12,4 +29,50 @@ def get_ratelimit(group: str, request: HttpRequest) -> str:
     return settings.ANON_RATE_LIMIT
 
 
-redis = AsyncRedis.from_url('redis://localhost:6379')
+def parse_rate(rate: str) -> Tuple[int, int]:
+    """Split a rate like ``20/m`` or ``100/10m`` into the number of requests and seconds."""
+    match = re.fullmatch(r"(\d+)/(\d*)([smhd])", rate)
+    if match is None:
+        raise ValueError(f"Invalid rate {rate}")
+    count, multiplier, period = match.groups()
+    return int(count), int(multiplier or 1) * PERIODS[period]
+
+
+async def is_ratelimited(group: str, key: str, rate: str) -> bool:
+    """Count a request in the current window of the key and tell whether it exceeds the rate.
+
+    The counters live in Redis, so all workers share them. Without Redis or if it is
+    unreachable, requests are let through.
+    """
+    limit, period = parse_rate(rate)
+    if not settings.REDIS_URL:
+        return False
+    window = int(time.time() // period)
+    redis_key = f"ratelimit:{group}:{key}:{window}"
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            count, _ = await pipe.incr(redis_key).expire(redis_key, period).execute()
+    except (RedisError, OSError) as e:
+        logger.warning("Couldn't check rate limit: %s", e)
+        return False
+    return int(count) > limit
+
+
+def aratelimit(rate: Callable[[str, HttpRequest], str] = get_ratelimit) -> Callable[[AsyncView], AsyncView]:
+    """Limit requests per user or ip to an async view, without leaving the event loop.
+
+    Raises ``Ratelimited`` like django_ratelimit, which ``handler403`` turns into a 429.
+    """
+    def decorator(view: AsyncView) -> AsyncView:
+        group = f"{view.__module__}.{view.__qualname__}"
+
+        @functools.wraps(view)
+        async def wrapper(request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponseBase:
+            await aget_user(request)
+            if await is_ratelimited(group, user_or_ip(request), rate(group, request)):
+                raise Ratelimited()
+            return await view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,46 @@
+"""Shared Redis clients."""
+import asyncio
+import threading
+import weakref
+from typing import Optional
+
+import redis
+from django.conf import settings
+from redis.asyncio import BlockingConnectionPool
+from redis.asyncio import Redis as AsyncRedis
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncRedis]" = weakref.WeakKeyDictionary()
+_sync_lock = threading.Lock()
+_sync_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> AsyncRedis:
+    """Return the client of this process for the running event loop.
+
+    Connections of redis.asyncio are bound to the loop they were opened in,
+    so there is one client, with its own connection pool, per event loop. Under
+    ASGI that is a single pool for the lifetime of the worker, requests wait for
+    a free connection when all REDIS_MAX_CONNECTIONS are in use.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncRedis(connection_pool=BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            health_check_interval=30,
+        ))
+    return client
+
+
+def get_sync_redis() -> redis.Redis:
+    """Return the blocking client of this process, for code outside of an event loop like signals and tasks."""
+    global _sync_client
+    with _sync_lock:
+        if _sync_client is None:
+            _sync_client = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+                settings.REDIS_URL,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                health_check_interval=30,
+            ))
+        return _sync_client
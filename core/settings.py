@@ -63,7 +63,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "corsheaders.middleware.CorsMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "core.middleware.AsyncWhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -103,6 +103,85 @@ CACHES = {
     "default": env.cache(default="dummycache://"),
 }
 
+# Seconds texts found by a search stay in the default cache (0 = don't cache)
+TEXT_CACHE_TIMEOUT = env.int("TEXT_CACHE_TIMEOUT", default=0)
+
+# Redis shared by all workers, an empty url disables the shared cache tiers
+REDIS_URL = env("REDIS_URL", default="redis://redis:6379")
+# Connections each worker may open to Redis
+REDIS_MAX_CONNECTIONS = env.int("REDIS_MAX_CONNECTIONS", default=50)
+
+# Requests/tokens per minute allowed for each OpenAI key and model, e.g. "gpt-4=200/40000"
+OPENAI_RATE_LIMITS = env.dict("OPENAI_RATE_LIMITS", default={"gpt-3.5-turbo": "3500/90000", "gpt-4": "200/40000"})
+OPENAI_DEFAULT_RATE_LIMIT = env("OPENAI_DEFAULT_RATE_LIMIT", default="3500/90000")
+# Seconds a completion waits for capacity before it fails
+OPENAI_RATE_LIMIT_WAIT = env.int("OPENAI_RATE_LIMIT_WAIT", default=60)
+
+# Cache of question embeddings, per worker (size) and in Redis (timeout in seconds)
+EMBEDDING_CACHE_SIZE = env.int("EMBEDDING_CACHE_SIZE", default=10_000)
+EMBEDDING_CACHE_TIMEOUT = env.int("EMBEDDING_CACHE_TIMEOUT", default=7 * 24 * 60 * 60)
+EMBEDDING_CACHE_DTYPE = env("EMBEDDING_CACHE_DTYPE", default="float32")
+# Keep the embeddings of all indexed texts in the database, so unchanged texts are never embedded twice
+EMBEDDING_STORE = env.bool("EMBEDDING_STORE", default=True)
+
+# Cache of moderation verdicts by normalized text, per worker (size) and in Redis (timeout in seconds)
+MODERATION_CACHE_SIZE = env.int("MODERATION_CACHE_SIZE", default=10_000)
+MODERATION_CACHE_TIMEOUT = env.int("MODERATION_CACHE_TIMEOUT", default=24 * 60 * 60)
+
+# Concurrent question embeddings are collected for this many seconds and sent as one request
+EMBEDDING_BATCH_WINDOW = env.float("EMBEDDING_BATCH_WINDOW", default=0.005)
+EMBEDDING_BATCH_SIZE = env.int("EMBEDDING_BATCH_SIZE", default=64)
+
+# Questions asked at least this often are reused by the answer cache even if not approved
+ANSWER_CACHE_MIN_COUNT = env.int("ANSWER_CACHE_MIN_COUNT", default=3)
+
+# Backends that can't filter searches fetch this many times the texts and filter them afterwards
+SEARCH_OVERFETCH = env.int("SEARCH_OVERFETCH", default=4)
+
+# Seconds identical questions wait for the answer already being generated (0 = don't wait)
+ANSWER_FLIGHT_TIMEOUT = env.int("ANSWER_FLIGHT_TIMEOUT", default=90)
+
+# Batches of texts embedded at the same time by index_realm, and batches waiting between its stages
+INDEX_EMBEDDING_CONCURRENCY = env.int("INDEX_EMBEDDING_CONCURRENCY", default=4)
+INDEX_QUEUE_SIZE = env.int("INDEX_QUEUE_SIZE", default=8)
+
+# Texts per Celery task of distributed indexing, and attempts before a shard fails
+INDEX_SHARD_SIZE = env.int("INDEX_SHARD_SIZE", default=10_000)
+INDEX_SHARD_RETRIES = env.int("INDEX_SHARD_RETRIES", default=5)
+INDEX_SHARD_BATCH_SIZE = env.int("INDEX_SHARD_BATCH_SIZE", default=1000)
+
+# Seconds between heartbeats of a running index job, and without one after which it is taken over
+INDEX_JOB_HEARTBEAT = env.int("INDEX_JOB_HEARTBEAT", default=60)
+INDEX_JOB_TIMEOUT = env.int("INDEX_JOB_TIMEOUT", default=900)
+
+# Sync edited and deleted texts into the vector index, changes are collected for TEXT_SYNC_DELAY seconds
+TEXT_SYNC = env.bool("TEXT_SYNC", default=True)
+TEXT_SYNC_DELAY = env.int("TEXT_SYNC_DELAY", default=10)
+TEXT_SYNC_BATCH_SIZE = env.int("TEXT_SYNC_BATCH_SIZE", default=1000)
+
+# Seconds the collections of a realm are kept after switching it to another embedding model,
+# workers that cached the realm keep searching them (longer than CHATBOT_CACHE_TIMEOUT)
+REALM_MIGRATION_GRACE = env.int("REALM_MIGRATION_GRACE", default=300)
+
+# Model whose encoding counts tokens when no model is given, e.g. for stored texts
+TOKENIZER_DEFAULT_MODEL = env("TOKENIZER_DEFAULT_MODEL", default="gpt-3.5-turbo")
+# Token counts of strings up to the given length are memoized per worker
+TOKEN_COUNT_CACHE_SIZE = env.int("TOKEN_COUNT_CACHE_SIZE", default=10_000)
+TOKEN_COUNT_CACHE_MAX_LENGTH = env.int("TOKEN_COUNT_CACHE_MAX_LENGTH", default=4000)
+
+# Imported texts longer than the given tokens are split into snippets (0 = don't split)
+IMPORT_CHUNK_TOKENS = env.int("IMPORT_CHUNK_TOKENS", default=400)
+# Tokens at the end of a snippet repeated at the start of the next one
+IMPORT_CHUNK_OVERLAP = env.int("IMPORT_CHUNK_OVERLAP", default=50)
+# Processes splitting the imported texts (0 = one per CPU)
+IMPORT_PROCESSES = env.int("IMPORT_PROCESSES", default=0)
+
+# Celery, using Redis as broker by default
+CELERY_BROKER_URL = env("CELERY_BROKER_URL", default=REDIS_URL)
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_ALWAYS_EAGER = env.bool("CELERY_TASK_ALWAYS_EAGER", default=False)
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -189,6 +268,31 @@ LOGGING = {
 }
 
 MILVUS_HOST = env("MILVUS_HOST", default="standalone")
+# Load the collections of all realms with a chatbot when a server process starts
+MILVUS_WARM_COLLECTIONS = env.bool("MILVUS_WARM_COLLECTIONS", default=True)
+# Budget of collections loaded in Milvus, shared by all workers through Redis; the least recently
+# searched are released (0 = no limit)
+MILVUS_MAX_LOADED_COLLECTIONS = env.int("MILVUS_MAX_LOADED_COLLECTIONS", default=0)
+MILVUS_MAX_LOADED_BYTES = env.int("MILVUS_MAX_LOADED_BYTES", default=0)
+# Collections that always stay loaded
+MILVUS_PINNED_COLLECTIONS = env.list("MILVUS_PINNED_COLLECTIONS", default=[])
+# Prefix of the collections shared by the realms using the milvus_shared backend
+MILVUS_SHARED_COLLECTION = env("MILVUS_SHARED_COLLECTION", default="texts")
+# Keep the index of a collection after inserts, Milvus indexes new segments in the background
+MILVUS_INCREMENTAL_INDEX = env.bool("MILVUS_INCREMENTAL_INDEX", default=True)
+# Rebuild the index from scratch once a collection grew by this share since the last rebuild
+MILVUS_REBUILD_GROWTH = env.float("MILVUS_REBUILD_GROWTH", default=1.0)
+# Compact a collection once this share of its segments is less than half full
+MILVUS_COMPACT_FRAGMENTATION = env.float("MILVUS_COMPACT_FRAGMENTATION", default=0.5)
+# Maximum size of a segment in MB, as configured in Milvus (dataCoord.segment.maxSize)
+MILVUS_SEGMENT_SIZE = env.int("MILVUS_SEGMENT_SIZE", default=512)
+
+# Directory for realms using the local (NumPy) vector backend
+LOCAL_VECTOR_ROOT = env("LOCAL_VECTOR_ROOT", default=str(BASE_DIR / "vectors"))
+# float16 halves memory and disk usage of the stores at a small loss of precision
+LOCAL_VECTOR_DTYPE = env("LOCAL_VECTOR_DTYPE", default="float32")
+# Share of deleted rows after which build_index compacts a store
+LOCAL_VECTOR_COMPACT_RATIO = env.float("LOCAL_VECTOR_COMPACT_RATIO", default=0.2)
 
 DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
 
@@ -202,6 +306,9 @@ AWS_S3_CUSTOM_DOMAIN = env("S3_CUSTOM_DOMAIN", default=None)
 USER_RATE_LIMIT = env("USER_RATE_LIMIT", default="20/m")
 ANON_RATE_LIMIT = env("ANON_RATE_LIMIT", default="20/m")
 
+# Seconds a worker keeps chatbot settings in memory instead of querying them per request
+CHATBOT_CACHE_TIMEOUT = env.int("CHATBOT_CACHE_TIMEOUT", default=30)
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,